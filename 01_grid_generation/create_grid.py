@@ -3,18 +3,45 @@ import math
 import time
 import logging
 from preprocess_tools.licensemanager import *
+from preprocess_tools.featureio import read_crs_bounds, read_layer
+from preprocess_tools.grid import RegularGrid
 
 class Fishnet(object):
-    def __init__(self, inventory, resolution_degrees, ProgressPrinter):
+    def __init__(self, inventory, resolution_degrees, ProgressPrinter, engine="arcpy", materialize=True, selection="location",
+                 grid_cell_ids=False):
         logging.info("Initializing class {}".format(self.__class__.__name__))
         self.ProgressPrinter = ProgressPrinter
         self.inventory = inventory
         self.resolution_degrees = resolution_degrees
+        # "arcpy" uses CreateFishnet + CalculateField, "numpy" computes the
+        # grid as arrays and writes it in one bulk pass
+        if engine not in ("arcpy", "numpy"):
+            raise ValueError("Invalid fishnet engine '{}'. Use 'arcpy' or 'numpy'.".format(engine))
+        self.engine = engine
+        # With materialize=False the numpy engine only defines the implicit
+        # grid (see getGrid) and no XYgrid polygons are written
+        self.materialize = materialize
+        # Cells kept in XYgrid: "location" selects by vector intersection
+        # with the inventory, "mask" (numpy engine only) rasterizes the
+        # inventory footprint once onto the grid and selects by mask
+        if selection not in ("location", "mask"):
+            raise ValueError("Invalid cell selection '{}'. Use 'location' or 'mask'.".format(selection))
+        if selection == "mask" and engine != "numpy":
+            raise ValueError("Mask cell selection requires the numpy engine.")
+        self.selection = selection
+        # The arcpy engine numbers CELL_ID by object id unless grid_cell_ids
+        # is set, in which case the ids are the row-major ids of the implicit
+        # RegularGrid and getGrid returns it. The numpy engine always uses
+        # the RegularGrid ids.
+        self.grid_cell_ids = grid_cell_ids
+        self.grid = None
 
         self.XYgrid = "XYgrid"
         self.XYgrid_temp = "XYgrid_temp"
 
     def createFishnet(self):
+        if self.engine == "numpy":
+            return self._createFishnetNumpy()
         with arc_license(Products.ARC) as arcpy:
             arcpy.env.workspace = self.inventory.getWorkspace()
             arcpy.env.overwriteOutput=True
@@ -24,6 +51,12 @@ class Fishnet(object):
             tCorner = self.inventory.getTopRightCorner()
             self.blc_x, self.blc_y = self.roundCorner(oCorner[0], oCorner[1], -1, self.resolution_degrees)
             self.trc_x, self.trc_y = self.roundCorner(tCorner[0], tCorner[1], 1, self.resolution_degrees)
+            if self.grid_cell_ids:
+                # The grid carries the inventory's CRS, as with the numpy
+                # engine, for the rasters and layers written against it
+                crs, _ = read_crs_bounds(self.inventory.getWorkspace(), self.inventory.getLayerName())
+                self.grid = RegularGrid.fromBounds([oCorner[0], oCorner[1], tCorner[0], tCorner[1]],
+                    self.resolution_degrees, crs)
 
             self.inventory_template = self.inventory.getLayerName()
 
@@ -44,6 +77,34 @@ class Fishnet(object):
                 pp.updateProgressV()
         pp.finish()
 
+    def _createFishnetNumpy(self):
+        workspace = self.inventory.getWorkspace()
+        crs, bounds = read_crs_bounds(workspace, self.inventory.getLayerName())
+        self.grid = RegularGrid.fromBounds(bounds, self.resolution_degrees, crs)
+        self.blc_x, self.blc_y, self.trc_x, self.trc_y = self.grid.getBounds()
+        logging.info('Creating {0} with {1}x{1} degree cell size in box bounded by ({2},{3})({4},{5})'.format(
+            self.grid, self.resolution_degrees, self.blc_x, self.blc_y, self.trc_x, self.trc_y))
+        if not self.materialize:
+            return
+        if self.selection == "mask":
+            tasks = [
+                lambda:self._selectByMask()
+            ]
+        else:
+            tasks = [
+                # CELL_ID and Shape_Area_Ha are written with the geometry
+                lambda:self.grid.materialize(workspace, self.XYgrid_temp),
+                lambda:self._selectIntersecting()
+            ]
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], len(tasks)).start()
+        for t in tasks:
+            t()
+            pp.updateProgressV()
+        pp.finish()
+
+    def getGrid(self):
+        return self.grid
+
     def roundCorner(self, x, y, ud, res):
         if ud==1:
             rx = math.ceil(float(x)/res)*res
@@ -76,11 +137,16 @@ class Fishnet(object):
 
     def _calculateFields(self):
         with arc_license(Products.ARC) as arcpy:
+            cell_id_expression = "!OID!"
+            if self.grid is not None:
+                # Row-major id from the cell centre so CELL_ID matches RegularGrid.cellIds
+                cell_id_expression = "int((!shape.centroid.Y! - {1}) / {2}) * {3} + int((!shape.centroid.X! - {0}) / {2}) + 1".format(
+                    self.blc_x, self.blc_y, self.resolution_degrees, self.grid.getShape()[1])
             functions = [
                 lambda:arcpy.MakeFeatureLayer_management(self.XYgrid_temp, 'XYgrid_intersect'),
                 # Only calculates grid cells that are intersecting with inventory
                 lambda:arcpy.SelectLayerByLocation_management('XYgrid_intersect', 'INTERSECT', self.inventory.getFilter(), "", "NEW_SELECTION", "NOT_INVERT"),
-                lambda:arcpy.CalculateField_management('XYgrid_intersect', "CELL_ID", "!OID!", "PYTHON_9.3"),
+                lambda:arcpy.CalculateField_management('XYgrid_intersect', "CELL_ID", cell_id_expression, "PYTHON_9.3"),
                 lambda:arcpy.CalculateField_management('XYgrid_intersect', "Shape_Area_Ha", "!shape.area@hectares!", "PYTHON_9.3"),
                 lambda:arcpy.CopyFeatures_management('XYgrid_intersect', self.XYgrid)
             ]
@@ -91,3 +157,31 @@ class Fishnet(object):
                 pp.updateProgressP()
 
         pp.finish()
+
+    def _selectIntersecting(self):
+        with arc_license(Products.ARC) as arcpy:
+            arcpy.env.workspace = self.inventory.getWorkspace()
+            arcpy.env.overwriteOutput = True
+            functions = [
+                lambda:arcpy.MakeFeatureLayer_management(self.XYgrid_temp, 'XYgrid_intersect'),
+                # Only keeps grid cells that are intersecting with inventory
+                lambda:arcpy.SelectLayerByLocation_management('XYgrid_intersect', 'INTERSECT', self.inventory.getFilter(), "", "NEW_SELECTION", "NOT_INVERT"),
+                lambda:arcpy.CopyFeatures_management('XYgrid_intersect', self.XYgrid)
+            ]
+
+            pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], len(functions), 1).start()
+            for f in functions:
+                f()
+                pp.updateProgressP()
+
+        pp.finish()
+
+    def _selectByMask(self):
+        # Only the occupied cells are ever turned into polygons
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
+        workspace = self.inventory.getWorkspace()
+        inv = read_layer(workspace, self.inventory.getLayerName(), columns=[])
+        cell_ids = self.grid.footprintCellIds(inv["geometry"])
+        logging.info("Inventory footprint covers {} of {} grid cells".format(len(cell_ids), self.grid.getCellCount()))
+        self.grid.materialize(workspace, self.XYgrid, cell_ids)
+        pp.finish()
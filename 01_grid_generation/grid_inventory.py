@@ -15,28 +15,53 @@ import os
 import inspect
 import sys
 import logging
-from dbfread import DBF
+import numpy as np
 from preprocess_tools.licensemanager import *
+from preprocess_tools.featureio import read_layer
+from preprocess_tools.overlay import largest_overlap_tiled, largest_by_group, centroid_join, write_gridded
+from preprocess_tools.tableio import FORMATS, write_table
+from preprocess_tools.attribute_raster import rasterize_attributes, feature_to_raster
 
 class GridInventory(object):
-    def __init__(self, inventory, outputDBF, ProgressPrinter, area_majority_rule=True):
+    def __init__(self, inventory, outputDBF, ProgressPrinter, area_majority_rule=True, regular_grid=None,
+                 processes=None, tile_size=256):
         logging.info("Initializing class {}".format(self.__class__.__name__))
         self.ProgressPrinter = ProgressPrinter
         self.inventory = inventory
         self.output_dbf_dir = outputDBF
         self.area_majority_rule = area_majority_rule
+        # Optional implicit grid (preprocess_tools.grid.RegularGrid); when
+        # given, cells are located arithmetically instead of through XYgrid
+        self.regular_grid = regular_grid
+        # Worker processes and tile edge (in cells) for the grid join
+        self.processes = processes
+        self.tile_size = tile_size
 
         self.inventory_layer = r"in_memory\inventory_layer"
         self.inventory_layer2 = r"in_memory\inventory_layer2"
         self.grid = "XYgrid"
         self.gridded_inventory = "inventory_gridded"
+        self.export_fields = ['age','X','Y','THEME1','THEME2','THEME3','THEME4','Shape_Area']
 
     def gridInventory(self):
+        self.invAge_fieldName = self.inventory.getFieldNames()['age']
+        if self.regular_grid is not None:
+            # No arcpy needed: the age filter is applied while reading
+            if self.area_majority_rule==True:
+                tasks = [lambda:self.spatialJoinLargestOverlapGrid()]
+            else:
+                tasks = [lambda:self.spatialJoinCentroidGrid()]
+            pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], len(tasks)).start()
+            for t in tasks:
+                t()
+                pp.updateProgressV()
+            pp.finish()
+            return
+
         with arc_license(Products.ARC) as arcpy:
             arcpy.env.workspace = self.inventory.getWorkspace()
             arcpy.env.overwriteOutput = True
             arcpy.Delete_management("in_memory")
-            self.invAge_fieldName = self.inventory.getFieldNames()['age']
 
         if self.area_majority_rule==True:
             spatial_join = lambda:self.SpatialJoinLargestOverlap(self.grid, self.inventory_layer2, self.gridded_inventory, False, "largest_overlap")
@@ -97,17 +122,13 @@ class GridInventory(object):
             fields = ["FID_{0}".format(os.path.splitext(os.path.basename(target_features))[0]),
                       "FID_{0}".format(os.path.splitext(os.path.basename(join_features))[0]),
                       "SHAPE@{0}".format(geom)]
-            overlap_dict = {}
-            with arcpy.da.SearchCursor(intersect, fields) as scur:
-                pp2 = self.ProgressPrinter.newProcess("search for overlap", 1, 2).start()
-                for row in scur:
-                    row = (row[0], row[1], round(row[2]*1000000,6))
-                    try:
-                        if row[2] > overlap_dict[row[0]][1]:
-                            overlap_dict[row[0]] = [row[1], row[2]]
-                    except:
-                        overlap_dict[row[0]] = [row[1], row[2]]
-                pp2.finish()
+            # Collect the (target, join, area) triples as typed arrays and keep
+            # the largest overlap per target in one vectorized pass
+            pp2 = self.ProgressPrinter.newProcess("search for overlap", 1, 2).start()
+            triples = arcpy.da.FeatureClassToNumPyArray(intersect, fields)
+            targets, joins, _ = largest_by_group(triples[fields[0]], triples[fields[1]], triples[fields[2]], 12)
+            del triples
+            pp2.finish()
             arcpy.Delete_management("intersect")
             # Copy the target features and write the largest overlap join feature ID to each record
             # Set up all fields from the target features + ORIG_FID
@@ -121,19 +142,18 @@ class GridInventory(object):
             fieldmappings.addFieldMap(fieldmap)
             # Perform the copy
             arcpy.conversion.FeatureClassToFeatureClass(target_features, self.inventory.getWorkspace(), os.path.basename(out_fc), "", fieldmappings)
-            # Add a new field JOIN_FID to contain the fid of the join feature with the largest overlap
-            arcpy.management.AddField(out_fc, "JOIN_FID", "LONG")
-            # Calculate the JOIN_FID field
-            with arcpy.da.UpdateCursor(out_fc, ["ORIG_FID", "JOIN_FID"]) as ucur:
-                pp2 = self.ProgressPrinter.newProcess("update rows", 1, 2).start()
-                for row in ucur:
-                    try:
-                        row[1] = overlap_dict[row[0]][0]
-                        ucur.updateRow(row)
-                    except:
-                        if not keep_all:
-                            ucur.deleteRow()
-                pp2.finish()
+            # Write JOIN_FID, the fid of the join feature with the largest
+            # overlap, to all targets at once
+            pp2 = self.ProgressPrinter.newProcess("update rows", 1, 2).start()
+            join_fid = np.empty(len(targets), dtype=[("ORIG_FID", np.int32), ("JOIN_FID", np.int32)])
+            join_fid["ORIG_FID"] = targets
+            join_fid["JOIN_FID"] = joins
+            arcpy.da.ExtendTable(out_fc, "ORIG_FID", join_fid, "ORIG_FID")
+            if not keep_all:
+                arcpy.management.MakeFeatureLayer(out_fc, "unjoined", "JOIN_FID IS NULL")
+                arcpy.management.DeleteFeatures("unjoined")
+                arcpy.management.Delete("unjoined")
+            pp2.finish()
             # Join all attributes from the join features to the output
             pp2 = self.ProgressPrinter.newProcess("join fields", 1, 2).start()
             joinfields = [x.name for x in arcpy.ListFields(join_features) if not x.required]
@@ -141,6 +161,35 @@ class GridInventory(object):
             pp2.finish()
         pp1.finish()
 
+    def spatialJoinLargestOverlapGrid(self):
+        # Largest overlap join against the implicit grid, partitioned into
+        # tiles joined in parallel: only cells touched by an inventory polygon
+        # are ever turned into geometry
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
+        workspace = self.inventory.getWorkspace()
+        cell_ids, join_fids, _ = largest_overlap_tiled(self.regular_grid, workspace, self.inventory.getLayerName(),
+            self.invAge_fieldName, self.tile_size, self.processes)
+        # Attributes only, the geometry stays in the workers
+        inv = read_layer(workspace, self.inventory.getLayerName(), geometry=False,
+            where=lambda p: p[self.invAge_fieldName] is not None and p[self.invAge_fieldName] > 0)
+        order = np.argsort(inv["fid"])
+        join_index = order[np.searchsorted(inv["fid"], join_fids, sorter=order)]
+        logging.info("Joined {} inventory polygons to {} grid cells".format(len(inv["fid"]), len(cell_ids)))
+        write_gridded(workspace, self.gridded_inventory, self.regular_grid, cell_ids, join_index, inv)
+        pp.finish()
+
+    def spatialJoinCentroidGrid(self):
+        # Cell centers come from the grid definition, so the join is a single
+        # rasterization of the age > 0 polygons at the cell centers
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
+        workspace = self.inventory.getWorkspace()
+        inv = read_layer(workspace, self.inventory.getLayerName(),
+            where=lambda p: p[self.invAge_fieldName] is not None and p[self.invAge_fieldName] > 0)
+        cell_ids, join_index = centroid_join(self.regular_grid, inv["geometry"])
+        logging.info("Joined {} inventory polygons to {} grid cells".format(len(inv["fid"]), len(cell_ids)))
+        write_gridded(workspace, self.gridded_inventory, self.regular_grid, cell_ids, join_index, inv)
+        pp.finish()
+
     def spatialJoinCentroid(self, grid, inv, out):
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
         with arc_license(Products.ARC) as arcpy:
@@ -154,31 +203,46 @@ class GridInventory(object):
         pp.finish()
 
 
-    def exportGriddedInvDBF(self):
+    def exportFieldMap(self, inv_fields):
+        # (output field, input field) pairs of the exported inventory table;
+        # the input field is None where the gridded inventory has no match
+        field_map = []
+        for output_field in self.export_fields:
+            if output_field == 'THEME4':
+                input_field = 'CELL_ID'
+            else:
+                try:
+                    input_field = self.inventory.getFieldNames()[output_field]
+                except KeyError:
+                    if output_field in inv_fields:
+                        input_field = output_field
+                    else:
+                        input_field = None
+            field_map.append((output_field, input_field))
+        return field_map
+
+    def exportGriddedInvDBF(self, table_format=None, legacy_dbf=True):
+        # table_format ("parquet" or "arrow") additionally writes the same
+        # columns to inventory.parquet / inventory.arrow; legacy_dbf=False
+        # skips inventory.dbf
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
         self.inventory.setLayerName(self.gridded_inventory)
+        if table_format is not None:
+            self.exportGriddedInvTable(table_format)
+        if not legacy_dbf:
+            pp.finish()
+            return
         with arc_license(Products.ARC) as arcpy:
             arcpy.env.workspace = self.inventory.getWorkspace()
             arcpy.env.overwriteOutput = True
 
             fms = arcpy.FieldMappings()
-            output_fields = ['age','X','Y','THEME1','THEME2','THEME3','THEME4','Shape_Area']
             inv_fields = [field.name for field in arcpy.ListFields(self.gridded_inventory)]
             if "NULL_FIELD" not in inv_fields:
                 arcpy.AddField_management(self.gridded_inventory, "NULL_FIELD", "TEXT", "", "", "10", "", "NULLABLE", "NON_REQUIRED", "")
 
-            for i, output_field in enumerate(output_fields):
+            for output_field, input_field in self.exportFieldMap(inv_fields):
                 fm = arcpy.FieldMap()
-                if output_field == 'THEME4':
-                    input_field = 'CELL_ID'
-                else:
-                    try:
-                        input_field = self.inventory.getFieldNames()[output_field]
-                    except KeyError:
-                        if output_field in inv_fields:
-                            input_field = output_field
-                        else:
-                            input_field = None
                 if input_field != None:
                     fm.addInputField(self.gridded_inventory, input_field)
                 else:
@@ -196,41 +260,91 @@ class GridInventory(object):
 
         pp.finish()
 
-    def exportInventory(self, inventory_raster_out, resolution, reportingIndicators):
+    def exportGriddedInvTable(self, table_format, batch_size=100000):
+        # Streams the gridded inventory to a columnar table in record batches
+        import fiona
+        from shapely.geometry import shape
+        path = os.path.join(self.output_dbf_dir, "inventory{}".format(FORMATS[table_format]))
+        with fiona.open(self.inventory.getWorkspace(), layer=self.gridded_inventory) as src:
+            inv_fields = list(src.schema["properties"].keys())
+            field_map = self.exportFieldMap(inv_fields)
+            # File geodatabase area fields are not exposed by every driver,
+            # so fall back to the geometry area in map units
+            area_from_geometry = dict(field_map).get("Shape_Area") is None
+            schema = [(o, "float" if o == "Shape_Area" and area_from_geometry else
+                       src.schema["properties"].get(i)) for o, i in field_map]
+            for output_field, input_field in field_map:
+                logging.info('\t\t{} -> {}'.format(input_field, output_field))
+
+            def batches():
+                batch = dict((o, []) for o, _ in field_map)
+                for f in src:
+                    p = f["properties"]
+                    for output_field, input_field in field_map:
+                        if output_field == "Shape_Area" and area_from_geometry:
+                            value = shape(f["geometry"]).area if f["geometry"] else None
+                        else:
+                            value = p[input_field] if input_field is not None else None
+                        batch[output_field].append(value)
+                    if len(batch["THEME4"]) >= batch_size:
+                        yield batch
+                        batch = dict((o, []) for o, _ in field_map)
+                if batch["THEME4"]:
+                    yield batch
+
+            write_table(path, schema, batches())
+
+    def exportInventory(self, inventory_raster_out, resolution, reportingIndicators, rasterize_once=False):
+        # rasterize_once rasterizes the inventory_gridded feature ids a single
+        # time and gathers every classifier/attribute raster from them
+        # instead of one FeatureToRaster per field
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
         print "\tExporting inventory to raster..."
+        reporting_indicators = reportingIndicators.getIndicators()
+        classifier_names = self.inventory.getClassifiers()
+        fields = {
+            "age": self.inventory.getFieldNames()["age"],
+            "species": self.inventory.getFieldNames()["species"]
+        }
+        for ri in reporting_indicators:
+            if reporting_indicators[ri]==None:
+                fields.update({ri:ri})
+        if rasterize_once:
+            rasters = [(classifier_name, self.inventory.getClassifierAttr(classifier_name))
+                       for classifier_name in classifier_names] + list(fields.items())
+            self.exportInventoryRasterizeOnce(inventory_raster_out, resolution, rasters)
+            pp.finish()
+            return
         with arc_license(Products.ARC) as arcpy:
             arcpy.env.overwriteOutput = True
-            reporting_indicators = reportingIndicators.getIndicators()
-            classifier_names = self.inventory.getClassifiers()
-            fields = {
-                "age": self.inventory.getFieldNames()["age"],
-                "species": self.inventory.getFieldNames()["species"]
-            }
-            for ri in reporting_indicators:
-                if reporting_indicators[ri]==None:
-                    fields.update({ri:ri})
+            if self.regular_grid is not None:
+                # Align the output rasters with the grid lattice
+                arcpy.env.extent = arcpy.Extent(*self.regular_grid.getBounds())
             for classifier_name in classifier_names:
                 field_name = self.inventory.getClassifierAttr(classifier_name)
                 file_path = os.path.join(inventory_raster_out, "{}.tif".format(classifier_name))
-                arcpy.FeatureToRaster_conversion(self.gridded_inventory, field_name, file_path, resolution)
-                self.inventory.addRaster(file_path, classifier_name, self.createAttributeTable(
-                    os.path.join(os.path.dirname(file_path), "{}.tif.vat.dbf".format(classifier_name)), field_name))
+                self.inventory.addRaster(file_path, classifier_name, feature_to_raster(
+                    arcpy, self.gridded_inventory, field_name, file_path, resolution))
             for attr in fields:
                 field_name = fields[attr]
                 file_path = os.path.join(inventory_raster_out,"{}.tif".format(attr))
-                arcpy.FeatureToRaster_conversion(self.gridded_inventory, field_name, file_path, resolution)
-                self.inventory.addRaster(file_path, attr, self.createAttributeTable(
-                    os.path.join(os.path.dirname(file_path), "{}.tif.vat.dbf".format(attr)), field_name))
+                self.inventory.addRaster(file_path, attr, feature_to_raster(
+                    arcpy, self.gridded_inventory, field_name, file_path, resolution))
         pp.finish()
 
-    def createAttributeTable(self, dbf_path, field_name):
-        # Creates an attribute table with the field name given
-        # to be used in the tiler along with the tif. This is
-        # necessary for fields that are not integers.
-        attr_table = {}
-        for row in DBF(dbf_path):
-            if len(row)<3:
-                return None
-            attr_table.update({row.items()[0][1]: [row.items()[-1][1]]})
-        return attr_table
+    def exportInventoryRasterizeOnce(self, inventory_raster_out, resolution, rasters):
+        # rasters is a list of (raster name, inventory field) pairs
+        inv = read_layer(self.inventory.getWorkspace(), self.gridded_inventory,
+            columns=sorted(set(field_name for _, field_name in rasters)))
+        if self.regular_grid is not None:
+            bounds = self.regular_grid.getBounds()
+        else:
+            extents = np.array([g.bounds for g in inv["geometry"]])
+            bounds = (extents[:, 0].min(), extents[:, 1].min(), extents[:, 2].max(), extents[:, 3].max())
+        columns = dict((name, (inv["properties"][field_name], inv["schema"]["properties"][field_name]))
+                       for name, field_name in rasters)
+        paths = dict((name, os.path.join(inventory_raster_out, "{}.tif".format(name))) for name, _ in rasters)
+        attr_tables = rasterize_attributes(inv["geometry"], columns, paths, bounds, float(resolution),
+            crs=inv["crs"], processes=self.processes)
+        for name, _ in rasters:
+            self.inventory.addRaster(paths[name], name, attr_tables[name])
@@ -11,17 +11,25 @@ Description:
      established during the rollup period intersect with the disturbances that occurred on
      those areas for disturbances that occured between inventory date and rollback start year.
 '''
+import os
 import inspect
 import logging
 from preprocess_tools.licensemanager import *
+from preprocess_tools.overlay import intersect_tiled
 
 class IntersectDisturbancesInventory(object):
-    def __init__(self, inventory, spatialBoundaries, rollback_range, ProgressPrinter):
+    def __init__(self, inventory, spatialBoundaries, rollback_range, ProgressPrinter, regular_grid=None,
+                 processes=None, tile_size=256):
         logging.info("Initializing class {}".format(self.__class__.__name__))
         self.ProgressPrinter = ProgressPrinter
         self.inventory = inventory
         self.spatialBoundaries = spatialBoundaries
         self.rollback_start = rollback_range[0]
+        # Optional implicit grid (preprocess_tools.grid.RegularGrid); the
+        # union then runs per tile of the grid in worker processes
+        self.regular_grid = regular_grid
+        self.processes = processes
+        self.tile_size = tile_size
 
         # Temp Layers
         self.disturbances_layer = r"in_memory\disturbances_layer"
@@ -53,14 +61,20 @@ class IntersectDisturbancesInventory(object):
         self.temp_overlay = r"{}\temp_DisturbedInventory".format(self.inv_workspace)
         self.output = r"{}\DisturbedInventory".format(self.inv_workspace)
 
-        tasks = [
-            lambda:self.addFields(),
-            lambda:self.selectInventoryRecords(),
-            lambda:self.makeFeatureLayer(),
-            lambda:self.selectDisturbanceRecords(),
-            lambda:self.intersectLayers(),
-            lambda:self.removeNonConcurring()
-        ]
+        if self.regular_grid is None:
+            tasks = [
+                lambda:self.addFields(),
+                lambda:self.selectInventoryRecords(),
+                lambda:self.makeFeatureLayer(),
+                lambda:self.selectDisturbanceRecords(),
+                lambda:self.intersectLayers(),
+                lambda:self.removeNonConcurring()
+            ]
+        else:
+            tasks = [
+                lambda:self.addFields(),
+                lambda:self.intersectLayersGrid()
+            ]
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], len(tasks)).start()
         for t in tasks:
             t()
@@ -126,6 +140,20 @@ class IntersectDisturbancesInventory(object):
             arcpy.Union_analysis([self.inventory_layer3,self.disturbances_layer2], self.temp_overlay, "ALL")
         pp.finish()
 
+    def intersectLayersGrid(self):
+        # Record selection, union and removal of non-concurring pieces in one
+        # pass per grid tile
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
+        logging.info('Intersecting disturbance and inventory layers on {}'.format(self.regular_grid))
+        intersect_tiled(self.regular_grid,
+            self.inv_workspace, os.path.basename(self.gridded_inventory),
+            self.inv_workspace, os.path.basename(self.disturbances),
+            self.inv_workspace, os.path.basename(self.output),
+            filters=[(self.invAge_fieldName, "lt", self.rolledback_years)],
+            overlay_filters=[(self.disturbance_fieldName, "lt", self.invVintage)],
+            tile_size=self.tile_size, processes=self.processes)
+        pp.finish()
+
     def removeNonConcurring(self):
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
         with arc_license(Products.ARC) as arcpy:
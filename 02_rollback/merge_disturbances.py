@@ -10,14 +10,26 @@ import os
 import inspect
 import glob
 import logging
+import numpy as np
 from preprocess_tools.licensemanager import *
+from preprocess_tools.featureio import read_layer, merge_layers
+from preprocess_tools.overlay import largest_overlap_tiled, largest_by_group, write_gridded
 
 class MergeDisturbances(object):
-    def __init__(self, inventory, disturbances, ProgressPrinter):
+    def __init__(self, inventory, disturbances, ProgressPrinter, regular_grid=None, processes=None,
+                 tile_size=256, streaming_merge=False):
         logging.info("Initializing class {}".format(self.__class__.__name__))
         self.ProgressPrinter = ProgressPrinter
         self.inventory = inventory
         self.disturbances = disturbances
+        # Optional implicit grid (preprocess_tools.grid.RegularGrid); the
+        # largest overlap join then runs on it without XYgrid or arcpy
+        self.regular_grid = regular_grid
+        self.processes = processes
+        self.tile_size = tile_size
+        # Read the disturbance sources in worker processes and stream them
+        # into MergedDisturbances_polys instead of using Merge_management
+        self.streaming_merge = streaming_merge
 
     def scan_for_layers(self, path, filter):
         return sorted(glob.glob(os.path.join(path, filter)),
@@ -29,11 +41,17 @@ class MergeDisturbances(object):
         self.output = r"{}\MergedDisturbances_polys".format(self.workspace)
         self.gridded_output = r"{}\MergedDisturbances".format(self.workspace)
 
-        tasks = [
-            lambda:self.spatialJoin(),
-            lambda:self.prepFieldMap(),
-            lambda:self.mergeLayers()
-        ]
+        if self.streaming_merge:
+            tasks = [
+                lambda:self.spatialJoin(),
+                lambda:self.streamMergeLayers()
+            ]
+        else:
+            tasks = [
+                lambda:self.spatialJoin(),
+                lambda:self.prepFieldMap(),
+                lambda:self.mergeLayers()
+            ]
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], len(tasks)).start()
         for t in tasks:
             t()
@@ -53,6 +71,23 @@ class MergeDisturbances(object):
             
         pp.finish()
 
+    def spatialJoinLargestOverlapGrid(self):
+        # Largest overlap of the merged disturbances on the implicit grid,
+        # limited to the cells of the gridded inventory like XYgrid was
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 2).start()
+        cell_ids, join_fids, _ = largest_overlap_tiled(self.regular_grid, self.workspace,
+            os.path.basename(self.output), tile_size=self.tile_size, processes=self.processes)
+        occupied = read_layer(self.workspace, "inventory_gridded", columns=["CELL_ID"], geometry=False)
+        keep = np.in1d(cell_ids, np.array(occupied["properties"]["CELL_ID"], dtype=np.int64))
+        cell_ids, join_fids = cell_ids[keep], join_fids[keep]
+
+        dist = read_layer(self.workspace, os.path.basename(self.output), geometry=False)
+        order = np.argsort(dist["fid"])
+        join_index = order[np.searchsorted(dist["fid"], join_fids, sorter=order)]
+        write_gridded(self.workspace, os.path.basename(self.gridded_output), self.regular_grid,
+            cell_ids, join_index, dist)
+        pp.finish()
+
     def prepFieldMap(self):
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
         with arc_license(Products.ARC) as arcpy:
@@ -94,10 +129,30 @@ class MergeDisturbances(object):
         with arc_license(Products.ARC) as arcpy:
             arcpy.env.workspace = self.workspace
             arcpy.Merge_management(self.vTab, self.output, self.fms)
-            self.SpatialJoinLargestOverlap(self.grid, self.output, self.gridded_output, False, "largest_overlap")
+            if self.regular_grid is None:
+                self.SpatialJoinLargestOverlap(self.grid, self.output, self.gridded_output, False, "largest_overlap")
+        if self.regular_grid is not None:
+            self.spatialJoinLargestOverlapGrid()
             
         pp.finish()
 
+    def streamMergeLayers(self):
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
+        sources = []
+        for dist in self.disturbances:
+            for fc in self.scan_for_layers(dist.getWorkspace(), dist.getFilter()):
+                # NBAC years are the start of a date string
+                sources.append((fc, None, dist.getYearField(), "NBAC" in fc))
+        logging.info('Mapping stand-replacing disturbance years to field DistYEAR')
+        merge_layers(sources, self.workspace, os.path.basename(self.output), "DistYEAR", self.processes)
+        if self.regular_grid is None:
+            with arc_license(Products.ARC) as arcpy:
+                arcpy.env.workspace = self.workspace
+                self.SpatialJoinLargestOverlap(self.grid, self.output, self.gridded_output, False, "largest_overlap")
+        else:
+            self.spatialJoinLargestOverlapGrid()
+        pp.finish()
+
     # Spatial Join tool--------------------------------------------------------------------
     # Main function, all functions run in SpatialJoinOverlapsCrossings
     def SpatialJoinLargestOverlap(self, target_features, join_features, out_fc, keep_all, spatial_rel):
@@ -114,17 +169,13 @@ class MergeDisturbances(object):
             fields = ["FID_{0}".format(os.path.splitext(os.path.basename(target_features))[0]),
                       "FID_{0}".format(os.path.splitext(os.path.basename(join_features))[0]),
                       "SHAPE@{0}".format(geom)]
-            overlap_dict = {}
-            with arcpy.da.SearchCursor(intersect, fields) as scur:
-                pp2 = self.ProgressPrinter.newProcess("search for overlap", 1, 3).start()
-                for row in scur:
-                    try:
-                        if row[2] > overlap_dict[row[0]][1]:
-                            overlap_dict[row[0]] = [row[1], row[2]]
-                    except:
-                        overlap_dict[row[0]] = [row[1], row[2]]
-                pp2.finish()
-
+            # Collect the (target, join, area) triples as typed arrays and keep
+            # the largest overlap per target in one vectorized pass
+            pp2 = self.ProgressPrinter.newProcess("search for overlap", 1, 3).start()
+            triples = arcpy.da.FeatureClassToNumPyArray(intersect, fields)
+            targets, joins, _ = largest_by_group(triples[fields[0]], triples[fields[1]], triples[fields[2]])
+            del triples
+            pp2.finish()
             # Copy the target features and write the largest overlap join feature ID to each record
             # Set up all fields from the target features + ORIG_FID
             fieldmappings = arcpy.FieldMappings()
@@ -137,19 +188,18 @@ class MergeDisturbances(object):
             fieldmappings.addFieldMap(fieldmap)
             # Perform the copy
             arcpy.conversion.FeatureClassToFeatureClass(target_features, os.path.dirname(out_fc), os.path.basename(out_fc), "", fieldmappings)
-            # Add a new field JOIN_FID to contain the fid of the join feature with the largest overlap
-            arcpy.management.AddField(out_fc, "JOIN_FID", "LONG")
-            # Calculate the JOIN_FID field
-            with arcpy.da.UpdateCursor(out_fc, ["ORIG_FID", "JOIN_FID"]) as ucur:
-                pp2 = self.ProgressPrinter.newProcess("update rows", 1, 3).start()
-                for row in ucur:
-                    try:
-                        row[1] = overlap_dict[row[0]][0]
-                        ucur.updateRow(row)
-                    except:
-                        if not keep_all:
-                            ucur.deleteRow()
-                pp2.finish()
+            # Write JOIN_FID, the fid of the join feature with the largest
+            # overlap, to all targets at once
+            pp2 = self.ProgressPrinter.newProcess("update rows", 1, 3).start()
+            join_fid = np.empty(len(targets), dtype=[("ORIG_FID", np.int32), ("JOIN_FID", np.int32)])
+            join_fid["ORIG_FID"] = targets
+            join_fid["JOIN_FID"] = joins
+            arcpy.da.ExtendTable(out_fc, "ORIG_FID", join_fid, "ORIG_FID")
+            if not keep_all:
+                arcpy.management.MakeFeatureLayer(out_fc, "unjoined", "JOIN_FID IS NULL")
+                arcpy.management.DeleteFeatures("unjoined")
+                arcpy.management.Delete("unjoined")
+            pp2.finish()
             # Join all attributes from the join features to the output
             pp2 = self.ProgressPrinter.newProcess("join fields", 1, 3).start()
             joinfields = [x.name for x in arcpy.ListFields(join_features) if not x.required]
@@ -0,0 +1,246 @@
+'''
+Raster-domain rollback. The gridded inventory and the merged disturbances are
+both keyed on CELL_ID, so they are placed on the grid lattice directly and
+the rollback attributes are computed per cell with numpy, a block of raster
+rows at a time. This replaces the polygon union, attribute calculation,
+update, dissolve and FeatureToRaster chain of IntersectDisturbancesInventory,
+CalculateRollbackAttributes and updateInvRollback, and writes the same
+rolled back inventory rasters and rollback disturbance layer.
+'''
+import os
+import inspect
+import logging
+from collections import OrderedDict
+import numpy as np
+from preprocess_tools.featureio import read_schema, iter_properties, write_features
+from preprocess_tools.attribute_raster import INT_NODATA, ColumnEncoder
+from preprocess_tools.randomstreams import RandomStreams, DEFAULT_SEED
+from preprocess_tools.slashburn import SLASHBURN_DIST_TYPE, slashburn_counts
+from preprocess_tools.rollback import load_age_distributors, rollback_attributes
+
+# Marks a null inventory age; such cells are nodata in the age raster
+INVALID_AGE = np.iinfo(np.int64).min
+# Rollback attributes kept for the disturbed cells
+DISTURBED_FIELDS = ["CELL_ID", "dist_type", "new_disturbance_yr", "regen_delay"]
+
+class RasterRollback(object):
+    def __init__(self, inventory, rollbackInvOut, rollbackDisturbances, rollback_range, harv_yr_field, sb_percent,
+                 reportingIndicators, regular_grid, ProgressPrinter, seed=DEFAULT_SEED, block_rows=1024):
+        logging.info("Initializing class {}".format(self.__class__.__name__))
+        self.ProgressPrinter = ProgressPrinter
+        self.inventory = inventory
+        self.rasterOutput = rollbackInvOut
+        self.rollbackDisturbanceOutput = rollbackDisturbances
+        self.rollback_range = rollback_range
+        self.rollback_start = rollback_range[0]
+        self.inv_vintage = inventory.getYear()
+        self.harv_yr_field = harv_yr_field
+        self.sb_percent = sb_percent
+        self.reporting_indicators = reportingIndicators.getIndicators()
+        self.regular_grid = regular_grid
+        # Pre disturbance ages and slashburn are drawn keyed on CELL_ID; None
+        # draws a new seed every run
+        self.seed = seed
+        self.streams = RandomStreams(seed)
+        self.block_rows = block_rows
+
+        #data
+        self.gridded_inventory = "inventory_gridded"
+        self.disturbances = "MergedDisturbances"
+
+    def runRasterRollback(self):
+        self.workspace = self.inventory.getWorkspace()
+        self.field_names = self.inventory.getFieldNames()
+        tasks = [
+            lambda:self.loadLayers(),
+            lambda:self.rollbackCells(),
+            lambda:self.generateSlashburn(),
+            lambda:self.exportRollbackDisturbances()
+        ]
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], len(tasks)).start()
+        for t in tasks:
+            t()
+            pp.updateProgressV()
+        pp.finish()
+
+    def getRasterFields(self):
+        # Output raster name -> inventory field, as exportRollbackInventory;
+        # "age" is the rolled back age computed here
+        fields = OrderedDict()
+        for classifier_name in self.inventory.getClassifiers():
+            fields[classifier_name] = self.inventory.getClassifierAttr(classifier_name)
+        fields["age"] = None
+        fields["species"] = self.field_names["species"]
+        for ri in self.reporting_indicators:
+            if self.reporting_indicators[ri]==None:
+                fields[ri] = ri
+        return fields
+
+    def loadLayers(self):
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
+        self.raster_fields = self.getRasterFields()
+        schema, inv_crs = read_schema(self.workspace, self.gridded_inventory)
+        # The grid's CRS, or the inventory's when the grid has none
+        self.crs = self.regular_grid.getCrs() or inv_crs
+        # Columns are read a feature at a time into typed arrays, so memory
+        # is a few bytes per cell and column rather than a Python object
+        age_field = self.field_names["age"]
+        fields = OrderedDict([("CELL_ID", "int"), (age_field, "int")])
+        fields.update((field, schema["properties"][field]) for field in self.raster_fields.values() if field)
+        encoders = OrderedDict((field, ColumnEncoder(field_type)) for field, field_type in fields.items())
+        for values in iter_properties(self.workspace, self.gridded_inventory, columns=list(encoders)):
+            for encoder, value in zip(encoders.values(), values):
+                encoder.append(value)
+        encoded = OrderedDict((field, encoder.finish()) for field, encoder in encoders.items())
+        cell_ids = encoded["CELL_ID"][0][1:].astype(np.int64)
+        cell_ids[cell_ids == INT_NODATA] = 0
+        self.inv_order = np.argsort(cell_ids, kind="mergesort")
+        self.inv_cells = cell_ids[self.inv_order]
+        self.inv_age = encoded[age_field][0][1:].astype(np.int64)
+        self.inv_age[self.inv_age == INT_NODATA] = INVALID_AGE
+        self.encoded = OrderedDict((name, encoded[field]) for name, field in self.raster_fields.items() if field)
+
+        # Disturbances before the inventory vintage; a null harvest year
+        # matches a null disturbance year as in CalculateRollbackAttributes
+        dist_yr_field = self.field_names["disturbance_yr"]
+        encoders = [ColumnEncoder("int") for _ in range(3)]
+        for values in iter_properties(self.workspace, self.disturbances, columns=["CELL_ID", dist_yr_field, self.harv_yr_field],
+                where=lambda p: p[dist_yr_field] is not None and p[dist_yr_field] < self.inv_vintage):
+            for encoder, value in zip(encoders, values):
+                encoder.append(value)
+        dist_cells, dist_year, harv_year = [e.finish()[0][1:].astype(np.int64) for e in encoders]
+        dist_cells[dist_cells == INT_NODATA] = 0
+        harv_year[harv_year == INT_NODATA] = -1
+        dist_cells, first = np.unique(dist_cells, return_index=True)
+        # A trailing sentinel cell keeps every lookup in range
+        self.dist_cells = np.append(dist_cells, np.iinfo(np.int64).max)
+        self.dist_year = np.append(dist_year[first], -1)
+        self.harv_year = np.append(harv_year[first], -1)
+        logging.info("Rolling back {} inventory cells with {} disturbed cells".format(len(self.inv_cells), len(dist_cells)))
+        pp.finish()
+
+    def rollbackBlock(self, cell0, cell1):
+        # Rollback attributes of the inventory cells with ids in [cell0, cell1).
+        # Returns (cell ids, inventory feature positions, rollback ages,
+        # rollback attributes of the disturbed cells).
+        lo, hi = np.searchsorted(self.inv_cells, [cell0, cell1])
+        cells = self.inv_cells[lo:hi]
+        positions = self.inv_order[lo:hi]
+        age = self.inv_age[positions]
+        valid = age != INVALID_AGE
+        rolledback_years = self.inv_vintage - self.rollback_start
+        rollback_age = np.where(valid, age - rolledback_years, INVALID_AGE)
+
+        # Stands younger than the rollback period are disturbed during it,
+        # with or without a disturbance record
+        disturbed = valid & (age < rolledback_years)
+        rows = np.flatnonzero(disturbed)
+        match = np.searchsorted(self.dist_cells, cells[rows])
+        has_dist = self.dist_cells[match] == cells[rows]
+        dist_year = np.where(has_dist, self.dist_year[match], -1)
+        harv_year = np.where(has_dist, self.harv_year[match], -1)
+        attributes = rollback_attributes(age[rows], dist_year, harv_year, self.inv_vintage, self.rollback_start,
+                                         self.age_distributors, cells[rows])
+        # Cells without an age distributor are rolled back like undisturbed
+        # stands, as rollbackAgeNonDistStands does
+        rollback_age[rows] = np.where(attributes["has_pre_dist_age"], attributes["rollback_age"], rollback_age[rows])
+        attributes["regen_delay"] = np.where(attributes["has_pre_dist_age"], attributes["regen_delay"], 0)
+        attributes["CELL_ID"] = cells[rows]
+        return cells, positions, rollback_age, attributes
+
+    def rollbackCells(self):
+        import rasterio
+        from rasterio.transform import Affine
+        from rasterio.windows import Window
+
+        nrows, ncols = self.regular_grid.getShape()
+        res = self.regular_grid.getResolution()
+        xmin, ymin, xmax, ymax = self.regular_grid.getBounds()
+        blocks = range(0, nrows, self.block_rows)
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], len(blocks), 1).start()
+        logging.info('Exporting rolled back inventory rasters to {}'.format(self.rasterOutput))
+        self.age_distributors = load_age_distributors(seed=self.seed)
+
+        # (lookup, nodata, attr_table) per raster; the age lookup is None as
+        # the rolled back age is written directly
+        layers = OrderedDict((name, self.encoded.get(name, (None, INT_NODATA, None))) for name in self.raster_fields)
+        transform = Affine(res, 0.0, xmin, 0.0, -res, ymax)
+        sinks = OrderedDict((name, rasterio.open(os.path.join(self.rasterOutput, "{}.tif".format(name)), "w",
+            driver="GTiff", width=ncols, height=nrows, count=1,
+            dtype="int32" if layer[0] is None else layer[0].dtype.name, nodata=layer[1],
+            crs=self.crs, transform=transform, tiled=True, compress="lzw"))
+            for name, layer in layers.items())
+        # Seeded with empty columns, as a study area may have no disturbed cells
+        disturbed = [dict((f, np.empty(0, np.int64)) for f in DISTURBED_FIELDS)]
+        try:
+            for row0 in blocks:
+                # Raster rows run top-down, cell id rows bottom-up
+                row1 = min(row0 + self.block_rows, nrows)
+                grid_row0 = nrows - row1
+                cells, positions, rollback_age, attributes = self.rollbackBlock(
+                    grid_row0 * ncols + 1, (nrows - row0) * ncols + 1)
+                disturbed.append(attributes)
+                flat = cells - 1 - grid_row0 * ncols
+                for name, (lookup, nodata, _) in layers.items():
+                    block = np.full((row1 - row0) * ncols, nodata, dtype=sinks[name].dtypes[0])
+                    block[flat] = np.where(rollback_age == INVALID_AGE, nodata, rollback_age) \
+                        if lookup is None else lookup[positions + 1]
+                    sinks[name].write(block.reshape(row1 - row0, ncols)[::-1], 1,
+                                      window=Window(0, row0, ncols, row1 - row0))
+                pp.updateProgressP()
+        finally:
+            for sink in sinks.values():
+                sink.close()
+
+        for name, (_, _, attr_table) in layers.items():
+            self.inventory.addRaster(os.path.join(self.rasterOutput, "{}.tif".format(name)), name, attr_table)
+        for dist_type, age_distributor in self.age_distributors.iteritems():
+            logging.info("Age picks for disturbance type {}:{}".format(dist_type,str(age_distributor)))
+        self.disturbed = dict((f, np.concatenate([a[f] for a in disturbed]).astype(np.int64))
+                              for f in DISTURBED_FIELDS)
+        pp.finish()
+
+    def generateSlashburn(self):
+        # Slashburn copies sb_percent of the harvested cells of each rollback
+        # year, as updateInvRollback.generateSlashburn does for records
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
+        logging.info('Selecting {}% of the harvest area in each year as slashburn and adding it to the rollback disturbances...'.format(self.sb_percent))
+        years = self.disturbed["new_disturbance_yr"]
+        candidates = np.flatnonzero((self.disturbed["dist_type"] == 2) &
+            (years >= self.rollback_range[0]) & (years <= self.rollback_range[1]))
+        candidate_cells = self.disturbed["CELL_ID"][candidates]
+        picks = candidates[np.in1d(candidate_cells, self.streams.sampleGroups("rollback_slashburn", years[candidates],
+            candidate_cells, slashburn_counts(years[candidates], self.sb_percent)))]
+        for f in self.disturbed:
+            self.disturbed[f] = np.concatenate([self.disturbed[f], self.disturbed[f][picks]])
+        self.disturbed["dist_type"][len(self.disturbed["dist_type"]) - len(picks):] = SLASHBURN_DIST_TYPE
+        logging.info("Selected {} of {} harvested cells as slashburn".format(len(picks), len(candidates)))
+        pp.finish()
+
+    def exportRollbackDisturbances(self):
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
+        print "\tExporting Rollback Disturbances..."
+        logging.info('Exporting rollback disturbances to {}'.format(self.rollbackDisturbanceOutput.getPath()))
+        # One cell polygon per disturbed cell and type, as the dissolve on
+        # type, year, regen delay and CELL_ID gave
+        fields = OrderedDict([
+            (self.field_names["dist_type"], "dist_type"),
+            (self.field_names["new_disturbance_yr"], "new_disturbance_yr"),
+            (self.field_names["regen_delay"], "regen_delay"),
+            ("CELL_ID", "CELL_ID")
+        ])
+        schema = {"geometry": "Polygon", "properties": OrderedDict((name, "int") for name in fields)}
+        order = np.lexsort((self.disturbed["dist_type"], self.disturbed["CELL_ID"]))
+        columns = dict((name, self.disturbed[f][order].tolist()) for name, f in fields.items())
+        x0, y0, x1, y1 = [a.tolist() for a in self.regular_grid.cellBounds(self.disturbed["CELL_ID"][order])]
+
+        def features():
+            for i in range(len(order)):
+                yield {
+                    "geometry": {"type": "Polygon", "coordinates": [[(x0[i], y0[i]), (x1[i], y0[i]),
+                        (x1[i], y1[i]), (x0[i], y1[i]), (x0[i], y0[i])]]},
+                    "properties": dict((name, columns[name][i]) for name in fields)
+                }
+
+        write_features(self.rollbackDisturbanceOutput.getPath(), schema, self.crs, features())
+        pp.finish()
@@ -1,12 +1,15 @@
 import csv
-import random
 import numpy as np
 import os
 import sys
 import inspect
 import logging
-from dbfread import DBF
 from preprocess_tools.licensemanager import *
+from preprocess_tools.attribute_raster import feature_to_raster
+from preprocess_tools.randomstreams import RandomStreams, DEFAULT_SEED
+from preprocess_tools.slashburn import generate_slashburn
+from preprocess_tools.dissolve import dissolve
+from preprocess_tools.rollback import load_age_distributors, rollback_attributes, RollbackDistributor
 
 class CalculateDistDEdifference(object):
     def __init__(self, inventory, ProgressPrinter):
@@ -66,13 +69,15 @@ class CalculateDistDEdifference(object):
         pp.finish()
 
 class CalculateNewDistYr(object):
-    def __init__(self, inventory, rollback_range, harv_yr_field, ProgressPrinter):
+    def __init__(self, inventory, rollback_range, harv_yr_field, ProgressPrinter, seed=DEFAULT_SEED):
         logging.info("Initializing class {}".format(self.__class__.__name__))
         self.ProgressPrinter = ProgressPrinter
         self.inventory = inventory
         self.rollback_start = rollback_range[0]
         self.inv_vintage = inventory.getYear()
         self.harv_yr_field = harv_yr_field
+        # Seed for the pre disturbance age picks; None draws a new one every run
+        self.seed = seed
 
         #Constants
         self.DisturbedInventory = "DisturbedInventory"
@@ -149,34 +154,33 @@ class CalculateNewDistYr(object):
 
     def calculatePreDistAge(self):
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
-        logging.info('Calculating pre disturbance age using {}\\02_rollback\\DistAgeProp.csv to select age'.format(sys.path[0]))
-        dist_age_props = {}
-        with open("{}\\02_rollback\\DistAgeProp.csv".format(sys.path[0]), "r") as age_prop_file:
-            reader = csv.reader(age_prop_file)
-            reader.next() # skip header
-            for dist_type, age, prop in reader:
-                dist_type = int(dist_type)
-                dist_ages = dist_age_props.get(dist_type)
-                if not dist_ages:
-                    dist_age_props[dist_type] = {}
-                    dist_ages = dist_age_props[dist_type]
-                dist_ages[age] = float(prop)
-
-        age_distributors = {}
-        for dist_type, age_props in dist_age_props.iteritems():
-            age_distributors[dist_type] = RollbackDistributor(**age_props)
+        age_distributors = load_age_distributors(seed=self.seed)
 
         with arc_license(Products.ARC) as arcpy:
-            cur = arcpy.UpdateCursor(self.disturbedInventory_layer)
-            for row in cur:
-                dist_type = int(row.getValue(self.dist_type_field))
+            oid = arcpy.Describe(self.disturbedInventory_layer).OIDFieldName
+            # The ages of each disturbance type are drawn in one call, keyed
+            # on the object id and new disturbance year as the per row draws were
+            dist_type_text = arcpy.ListFields(self.disturbedInventory_layer, self.dist_type_field)[0].type == "String"
+            table = arcpy.da.TableToNumPyArray(self.disturbedInventory_layer,
+                [oid, self.dist_type_field, self.new_disturbance_field],
+                null_value={self.dist_type_field: "-1" if dist_type_text else -1, self.new_disturbance_field: -1})
+            dist_types = table[self.dist_type_field].astype(np.int64)
+            pre_dist_ages = {}
+            for dist_type in np.unique(dist_types).tolist():
                 age_distributor = age_distributors.get(dist_type)
                 if not age_distributor:
                     print "No age distributor for layer disturbance type {} - skipping.".format(dist_type)
                     continue
+                rows = np.flatnonzero(dist_types == dist_type)
+                ages = age_distributor.sample(table[oid][rows], table[self.new_disturbance_field][rows])
+                pre_dist_ages.update(zip(table[oid][rows].tolist(), ages.tolist()))
+            del table
 
-                row.setValue(self.preDistAge, age_distributor.next())
-                cur.updateRow(row)
+            with arcpy.da.UpdateCursor(self.disturbedInventory_layer, [oid, self.preDistAge]) as cur:
+                for row in cur:
+                    if row[0] in pre_dist_ages:
+                        row[1] = pre_dist_ages[row[0]]
+                        cur.updateRow(row)
 
             for dist_type, age_distributor in age_distributors.iteritems():
                 logging.info("Age picks for disturbance type {}:{}".format(dist_type,str(age_distributor)))
@@ -196,28 +200,69 @@ class CalculateNewDistYr(object):
         pp.finish()
 
 
-class RollbackDistributor(object):
-    def __init__(self, **age_proportions):
+class CalculateRollbackAttributes(object):
+    '''
+    Single pass replacement for CalculateDistDEdifference followed by
+    CalculateNewDistYr: the DisturbedInventory attribute table is loaded
+    once, every rollback attribute is computed with rollback_attributes and
+    the results are written back in one cursor pass.
+    '''
+    def __init__(self, inventory, rollback_range, harv_yr_field, ProgressPrinter, seed=DEFAULT_SEED):
         logging.info("Initializing class {}".format(self.__class__.__name__))
-        self._rand = random.Random()
-        self._ages = []
-        for age, proportion in age_proportions.iteritems():
-            self._ages.extend([age] * int(100.00 * proportion))
+        self.ProgressPrinter = ProgressPrinter
+        self.inventory = inventory
+        self.rollback_start = rollback_range[0]
+        self.inv_vintage = inventory.getYear()
+        self.harv_yr_field = harv_yr_field
+        # Seed for the pre disturbance age picks; None draws a new one every run
+        self.seed = seed
 
-        self._rand.shuffle(self._ages)
-        self._choices = {age: 0 for age in age_proportions.keys()}
+        #Constants
+        self.DisturbedInventory = "DisturbedInventory"
 
-    def __str__(self):
-        return str(self._choices)
+    def calculateRollbackAttributes(self):
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
+        field_names = self.inventory.getFieldNames()
+        output_fields = ["establishment_date", "dist_date_diff", "dist_type", "regen_delay",
+                         "new_disturbance_yr", "pre_dist_age", "rollback_age"]
+        with arc_license(Products.ARC) as arcpy:
+            arcpy.env.workspace = self.inventory.getWorkspace()
+            oid = arcpy.Describe(self.DisturbedInventory).OIDFieldName
+            # A null disturbance year matches a null harvest year, as it did
+            # when the cursors compared None values
+            table = arcpy.da.TableToNumPyArray(self.DisturbedInventory,
+                [oid, field_names["age"], field_names["disturbance_yr"], self.harv_yr_field],
+                null_value={field_names["disturbance_yr"]: -1, self.harv_yr_field: -1})
+            logging.info("Calculating rollback attributes of {} disturbed inventory records".format(len(table)))
+            age_distributors = load_age_distributors(seed=self.seed)
+            attributes = rollback_attributes(table[field_names["age"]], table[field_names["disturbance_yr"]],
+                table[self.harv_yr_field], self.inv_vintage, self.rollback_start, age_distributors, table[oid])
+            for dist_type, age_distributor in age_distributors.iteritems():
+                logging.info("Age picks for disturbance type {}:{}".format(dist_type,str(age_distributor)))
 
-    def next(self):
-        age = self._rand.choice(self._ages)
-        self._choices[age] += 1
-        return int(age)
+            dist_type_text = arcpy.ListFields(self.DisturbedInventory, field_names["dist_type"])[0].type == "String"
+            columns = [attributes[f].tolist() for f in output_fields]
+            if dist_type_text:
+                columns[2] = [str(t) for t in columns[2]]
+            has_pre_dist_age = attributes["has_pre_dist_age"].tolist()
+            position = dict((o, i) for i, o in enumerate(table[oid].tolist()))
+            del table
+
+            with arcpy.da.UpdateCursor(self.DisturbedInventory, [oid] + [field_names[f] for f in output_fields]) as cur:
+                for row in cur:
+                    i = position[row[0]]
+                    # Rows without an age distributor keep their pre
+                    # disturbance and rollback ages
+                    n = len(output_fields) if has_pre_dist_age[i] else len(output_fields) - 2
+                    for j in range(n):
+                        row[j + 1] = columns[j][i]
+                    cur.updateRow(row)
+        pp.finish()
 
 
 class updateInvRollback(object):
-    def __init__(self, inventory, rollbackInvOut, rollbackDisturbances, rollback_range, resolution, sb_percent, reportingIndicators, ProgressPrinter):
+    def __init__(self, inventory, rollbackInvOut, rollbackDisturbances, rollback_range, resolution, sb_percent, reportingIndicators, ProgressPrinter,
+                 regular_grid=None, seed=DEFAULT_SEED, remerge_by_cell=False, parallel_dissolve=False, processes=None):
         logging.info("Initializing class {}".format(self.__class__.__name__))
         self.ProgressPrinter = ProgressPrinter
         self.inventory = inventory
@@ -226,6 +271,18 @@ class updateInvRollback(object):
         self.resolution = resolution
         self.sb_percent = sb_percent
         self.reporting_indicators = reportingIndicators.getIndicators()
+        # Optional implicit grid (preprocess_tools.grid.RegularGrid) used to
+        # align the exported rasters with the grid lattice
+        self.regular_grid = regular_grid
+        # Slashburn selection draws from keyed random streams
+        self.streams = RandomStreams(seed)
+        # Remerge the disturbed inventory by CELL_ID instead of with a
+        # geometric Update_analysis
+        self.remerge_by_cell = remerge_by_cell
+        # Dissolve the rollback disturbances in a process pool, grouped by
+        # disturbance year, type and regen delay
+        self.parallel_dissolve = parallel_dissolve
+        self.processes = processes
 
         #data
         self.gridded_inventory = "inventory_gridded"
@@ -278,11 +335,43 @@ class updateInvRollback(object):
     def remergeDistPolyInv(self):
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
         with arc_license(Products.ARC) as arcpy:
-            arcpy.Update_analysis(self.gridded_inventory_layer, self.disturbedInventory_layer,
-                self.RolledBackInventory, "BORDERS", "0.25 Meters")
+            if self.remerge_by_cell:
+                self.remergeDistCells(arcpy)
+            else:
+                arcpy.Update_analysis(self.gridded_inventory_layer, self.disturbedInventory_layer,
+                    self.RolledBackInventory, "BORDERS", "0.25 Meters")
         self.inventory.setLayerName(self.RolledBackInventory)
         pp.finish()
 
+    def remergeDistCells(self, arcpy, chunk_size=1000):
+        # Key-based Update: the DisturbedInventory pieces of a cell replace
+        # the whole gridded inventory record of that CELL_ID. Only the
+        # records of undisturbed cells are copied to the output, through a
+        # layer selection of the disturbed cells that is then switched, and
+        # the disturbed pieces appended. Those records are the output's own,
+        # so this is the one copy the remerge needs.
+        disturbed_cells = np.unique(arcpy.da.TableToNumPyArray(self.disturbedInventory, [self.CELL_ID],
+            skip_nulls=True)[self.CELL_ID])
+        layer = "remerge_inventory_layer"
+        arcpy.MakeFeatureLayer_management(self.gridded_inventory, layer)
+        try:
+            if len(disturbed_cells):
+                cell_field = arcpy.AddFieldDelimiters(self.gridded_inventory, self.CELL_ID)
+                # The selection is built in chunks to keep the IN lists short
+                for start in range(0, len(disturbed_cells), chunk_size):
+                    cells = ",".join(str(int(c)) for c in disturbed_cells[start:start + chunk_size])
+                    arcpy.SelectLayerByAttribute_management(layer,
+                        "NEW_SELECTION" if start == 0 else "ADD_TO_SELECTION", "{} IN ({})".format(cell_field, cells))
+                replaced = int(arcpy.GetCount_management(layer).getOutput(0))
+                arcpy.SelectLayerByAttribute_management(layer, "SWITCH_SELECTION")
+                logging.info('Replacing {} inventory records of {} disturbed cells with the disturbed inventory'.format(
+                    replaced, len(disturbed_cells)))
+            arcpy.CopyFeatures_management(layer, self.RolledBackInventory)
+        finally:
+            arcpy.Delete_management(layer)
+        # Fields are matched by name, as Update_analysis carries them over
+        arcpy.Append_management(self.disturbedInventory, self.RolledBackInventory, "NO_TEST")
+
     def makeLayers2(self):
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
         with arc_license(Products.ARC) as arcpy:
@@ -306,32 +395,17 @@ class updateInvRollback(object):
 
     def generateSlashburn(self):
         year_range = range(self.rollback_range[0], self.rollback_range[1]+1)
-        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], len(year_range), 1).start()
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1, 1).start()
         # print "Start of slashburn processing..."
         PercSBofCC = self.sb_percent
         with arc_license(Products.ARC) as arcpy:
-            arcpy.MakeFeatureLayer_management(self.RolledBackInventory_layer, "temp_rollback")
-            expression1 = '{} = {}'.format(arcpy.AddFieldDelimiters("temp_rollback", self.dist_type_field), 2)
+            expression1 = '{} = {}'.format(arcpy.AddFieldDelimiters(self.RolledBackInventory, self.dist_type_field), 2)
             logging.info('Making slashburn for the range {}-{}'.format(self.rollback_range[0],self.rollback_range[1]))
             logging.info('Selecting {}% of the harvest area in each year as slashburn and adding it to the rollback disturbances...'.format(PercSBofCC))
-            # Create SB records for each timestep
-            for year in range(self.rollback_range[0], self.rollback_range[1]+1):
-                expression2 = '{} = {}'.format(arcpy.AddFieldDelimiters("temp_rollback", self.new_disturbance_field), year)
-                arcpy.SelectLayerByAttribute_management("temp_rollback", "NEW_SELECTION", expression2)
-                arcpy.SelectLayerByAttribute_management("temp_rollback", "SUBSET_SELECTION", expression1)
-                if int(arcpy.GetCount_management("temp_rollback").getOutput(0)) > 0:
-                    number_features = [row[0] for row in arcpy.da.SearchCursor("temp_rollback", "OBJECTID")]
-                    temp_rollback_count = int(arcpy.GetCount_management("temp_rollback").getOutput(0))
-                    features2Bselected = random.sample(number_features,(int(np.ceil(round(float(temp_rollback_count * PercSBofCC)/100)))))
-                    features2Bselected.append(0)
-                    features2Bselected = str(tuple(features2Bselected)).rstrip(',)') + ')'
-                    selectExpression = '{} IN {}'.format(arcpy.AddFieldDelimiters("temp_rollback", "OBJECTID"), features2Bselected)
-                    arcpy.SelectLayerByAttribute_management("temp_rollback","NEW_SELECTION", selectExpression)
-                    arcpy.CopyFeatures_management("temp_rollback","temp_SB")
-                    arcpy.CalculateField_management("temp_SB", "DistType", 13, "PYTHON", "")
-                    arcpy.Append_management("temp_SB", self.RolledBackInventory_layer)
-                arcpy.SelectLayerByAttribute_management("temp_rollback", "CLEAR_SELECTION")
-                pp.updateProgressP()
+            # Create SB records for all timesteps at once
+            generate_slashburn(arcpy, self.streams, "rollback_slashburn", self.RolledBackInventory,
+                self.new_disturbance_field, expression1, year_range, PercSBofCC, "temp_SB")
+            arcpy.Append_management("temp_SB", self.RolledBackInventory_layer)
 
         pp.finish()
 
@@ -344,10 +418,15 @@ class updateInvRollback(object):
         dissolveFields = [self.dist_type_field, self.new_disturbance_field,self.regen_delay_field, self.CELL_ID]
         selectClause =  "{} IS NOT NULL".format(self.new_disturbance_field)
 
-        with arc_license(Products.ARC) as arcpy:
-            arcpy.SelectLayerByAttribute_management(self.RolledBackInventory_layer, "NEW_SELECTION", selectClause)
-            arcpy.Dissolve_management(self.RolledBackInventory_layer, self.rollbackDisturbanceOutput.getPath(),dissolveFields,
-                "","SINGLE_PART","DISSOLVE_LINES")
+        if self.parallel_dissolve:
+            dissolve(self.inventory.getWorkspace(), self.RolledBackInventory, self.rollbackDisturbanceOutput.getPath(),
+                dissolveFields, group_fields=dissolveFields[:3],
+                where=lambda p: p[self.new_disturbance_field] is not None, processes=self.processes)
+        else:
+            with arc_license(Products.ARC) as arcpy:
+                arcpy.SelectLayerByAttribute_management(self.RolledBackInventory_layer, "NEW_SELECTION", selectClause)
+                arcpy.Dissolve_management(self.RolledBackInventory_layer, self.rollbackDisturbanceOutput.getPath(),dissolveFields,
+                    "","SINGLE_PART","DISSOLVE_LINES")
 
         pp.finish()
 
@@ -357,6 +436,8 @@ class updateInvRollback(object):
         logging.info('Exporting rolled back inventory rasters to {}'.format(self.rasterOutput))
         with arc_license(Products.ARC) as arcpy:
             arcpy.env.overwriteOutput = True
+            if self.regular_grid is not None:
+                arcpy.env.extent = arcpy.Extent(*self.regular_grid.getBounds())
             classifier_names = self.inventory.getClassifiers()
             fields = {
                 "age": self.inventory.getFieldNames()["rollback_age"],
@@ -369,25 +450,12 @@ class updateInvRollback(object):
                 logging.info('Exporting classifer {} from {}'.format(classifier_name, os.path.join(self.inventory.getWorkspace(),self.RolledBackInventory)))
                 field_name = self.inventory.getClassifierAttr(classifier_name)
                 file_path = os.path.join(self.rasterOutput, "{}.tif".format(classifier_name))
-                arcpy.FeatureToRaster_conversion(self.RolledBackInventory, field_name, file_path, self.resolution)
-                self.inventory.addRaster(file_path, classifier_name, self.createAttributeTable(
-                    os.path.join(os.path.dirname(file_path), "{}.tif.vat.dbf".format(classifier_name)), field_name))
+                self.inventory.addRaster(file_path, classifier_name, feature_to_raster(
+                    arcpy, self.RolledBackInventory, field_name, file_path, self.resolution))
             for attr in fields:
                 logging.info('Exporting field {} from {}'.format(attr, os.path.join(self.inventory.getWorkspace(),self.RolledBackInventory)))
                 field_name = fields[attr]
                 file_path = os.path.join(self.rasterOutput,"{}.tif".format(attr))
-                arcpy.FeatureToRaster_conversion(self.RolledBackInventory, field_name, file_path, self.resolution)
-                self.inventory.addRaster(file_path, attr, self.createAttributeTable(
-                    os.path.join(os.path.dirname(file_path), "{}.tif.vat.dbf".format(attr)), field_name))
+                self.inventory.addRaster(file_path, attr, feature_to_raster(
+                    arcpy, self.RolledBackInventory, field_name, file_path, self.resolution))
         pp.finish()
-
-    def createAttributeTable(self, dbf_path, field_name):
-        # Creates an attribute table with the field name given
-        # to be used in the tiler along with the tif. This is
-        # necessary for fields that are not integers.
-        attr_table = {}
-        for row in DBF(dbf_path):
-            if len(row)<3:
-                return None
-            attr_table.update({row.items()[0][1]: [row.items()[-1][1]]})
-        return attr_table
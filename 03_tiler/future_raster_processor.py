@@ -69,7 +69,9 @@ class FutureRasterProcessor(object):
 
             random_subset.RandomSubset(input = harvest_raster_scenario_path,
                                        output = slashburn_path,
-                                       percent = percent)
+                                       percent = percent,
+                                       year = year,
+                                       stage = "projected_slashburn")
             result.append(
                 self.createProcessedRasterResult(
                     year = year,
@@ -94,7 +96,9 @@ class FutureRasterProcessor(object):
                 random_subset.RandomSubset(
                     input = harvest_raster_base_path,
                     output = harvest_raster_scenario_path,
-                    percent = activityPercent)
+                    percent = activityPercent,
+                    year = year,
+                    stage = "projected_harvest")
             else:
                 shutil.copy(harvest_raster_base_path,
                             harvest_raster_scenario_path)
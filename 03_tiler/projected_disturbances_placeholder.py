@@ -4,13 +4,15 @@ import os
 import glob
 import logging
 import numpy as np
-import random
 from itertools import count, groupby, izip_longest
 from preprocess_tools.licensemanager import *
+from preprocess_tools.randomstreams import RandomStreams
 
 class ProjectedDisturbancesPlaceholder(object):
-    def __init__(self, inventory, rollbackDisturbances, future_range, rollback_range, activity_start_year, ProgressPrinter, output_dir=None):
+    def __init__(self, inventory, rollbackDisturbances, future_range, rollback_range, activity_start_year, ProgressPrinter, output_dir=None,
+                 seed=None):
         self.ProgressPrinter = ProgressPrinter
+        self.streams = RandomStreams(seed)
         self.inventory = inventory
         self.rollbackDisturbances = rollbackDisturbances
         self.future_range = future_range
@@ -159,7 +161,7 @@ class ProjectedDisturbancesPlaceholder(object):
                 # beginning of GA replace
                 number_features = [row[0] for row in arcpy.da.SearchCursor("inventory_gridded_1990_layer", "OBJECTID")]
                 temp_inventory_count = int(arcpy.GetCount_management("inventory_gridded_1990_layer").getOutput(0))
-                features2Bselected = random.sample(number_features,int(round(fire_areaValue)))
+                features2Bselected = self.streams.sample("projected_fire", year, number_features, int(round(fire_areaValue))).tolist()
                 features2Bselected.append(0)
                 features2Bselected = str(tuple(features2Bselected)).rstrip(',)') + ')'
                 selectExpression = '{} IN {}'.format(arcpy.AddFieldDelimiters("inventory_gridded_1990_layer", "OBJECTID"), features2Bselected)
@@ -200,7 +202,7 @@ class ProjectedDisturbancesPlaceholder(object):
                 if harvest_records >= 1:
                     number_features = [row[0] for row in arcpy.da.SearchCursor("inventory_gridded_1990_layer", "OBJECTID")]
                     temp_inventory_count = int(arcpy.GetCount_management("inventory_gridded_1990_layer").getOutput(0))
-                    features2Bselected = random.sample(number_features,int(round(harvest_records)))
+                    features2Bselected = self.streams.sample("projected_harvest", year, number_features, int(round(harvest_records))).tolist()
                     features2Bselected.append(0)
                     features2Bselected = str(tuple(features2Bselected)).rstrip(',)') + ')'
                     selectExpression = '{} IN {}'.format(arcpy.AddFieldDelimiters("inventory_gridded_1990_layer", "OBJECTID"), features2Bselected)
@@ -248,7 +250,8 @@ class ProjectedDisturbancesPlaceholder(object):
                     arcpy.SelectLayerByAttribute_management(harvest_proj_dist_temp, "SUBSET_SELECTION", expression1)
                     number_features = [row[0] for row in arcpy.da.SearchCursor(harvest_proj_dist_temp, "OBJECTID")]
                     temp_harvest_count = int(arcpy.GetCount_management(harvest_proj_dist_temp).getOutput(0))
-                    features2Bselected = random.sample(number_features,(int(np.ceil(round(float(temp_harvest_count * PercSBofCC)/100)))))
+                    features2Bselected = self.streams.sample("projected_slashburn", year, number_features,
+                        int(np.ceil(round(float(temp_harvest_count * PercSBofCC)/100)))).tolist()
                     features2Bselected.append(0)
                     features2Bselected = str(tuple(features2Bselected)).rstrip(',)') + ')'
                     selectExpression = '{} IN {}'.format(arcpy.AddFieldDelimiters(harvest_proj_dist_temp, "OBJECTID"), features2Bselected)
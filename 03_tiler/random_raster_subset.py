@@ -1,13 +1,14 @@
 from osgeo import gdal
 import numpy as np
 import shutil
+from preprocess_tools.randomstreams import RandomStreams
 
 #used this as a reference
 #https://geohackweek.github.io/raster/04-workingwithrasters/
 
 class RandomRasterSubset(object):
-    def __init__(self):
-        pass
+    def __init__(self, seed=None):
+        self.streams = RandomStreams(seed)
 
     def readInput(self, input, band=1):
         """
@@ -25,10 +26,13 @@ class RandomRasterSubset(object):
         band.WriteArray(values)
         del ds
 
-    def RandomSubset(self, input, output, percent, default = 0, filter = [1], band=1):
+    def RandomSubset(self, input, output, percent, default = 0, filter = [1], band=1,
+                     year=None, stage="random_raster_subset"):
         """
         takes a random subset of the filtered values of the input
-        raster and writes the subset to the raster file specified by output
+        raster and writes the subset to the raster file specified by output.
+        Each pixel draws from the random stream of (stage, year, pixel index)
+        so the subset does not depend on how the raster is processed
         """
         if percent < 0 or percent > 100:
            raise ValueError("specified percent out of bounds")
@@ -44,7 +48,7 @@ class RandomRasterSubset(object):
         #it is faster to generate random numbers for every position
         #(filtered or not) than to attempt to generate for only the filtered
         #subset with a non numpy native method
-        rnd = np.random.rand(raster1.shape[0], raster1.shape[1])
+        rnd = self.streams.uniform(stage, year, np.arange(raster1.size)).reshape(raster1.shape)
 
         #filter the input raster values based on the specified filter
         filtered = np.isin(raster1, filter)
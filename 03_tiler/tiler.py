@@ -1,8 +1,12 @@
 ﻿import glob
 import os
+import json
 import inspect
 import logging
 import shutil
+import sys
+import cPickle
+import multiprocessing
 
 from projected_disturbances_placeholder import ProjectedDisturbancesPlaceholder
 from generate_historic_slashburn import GenerateSlashburn
@@ -19,10 +23,51 @@ from mojadata.layer.filter.slicevaluefilter import SliceValueFilter
 from mojadata.layer.gcbm.transitionrule import TransitionRule
 from mojadata.layer.gcbm.transitionrulemanager import SharedTransitionRuleManager
 from preprocess_tools.inputs import TransitionRules
+from preprocess_tools.tilecache import TileCache
+from preprocess_tools.featureio import partition_layer, normalize_year
+from preprocess_tools.yearstack import rasterize_years, split_years
+from preprocess_tools.ruleregistry import TransitionRuleRegistry
+
+def _link_or_copy(src, dst):
+    # Hard links share the tiled output without copying it; Python 2 on
+    # Windows has no os.link, and links cannot cross volumes
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copy2(src, dst)
+
+def _tile_scenario(tiler, layers, rule_manager, output_dir_scen, shared_dir, make_transition_rules):
+    # Worker: tiles the layers of one scenario into output_dir_scen and adds
+    # the general layers already tiled in shared_dir
+    if os.path.exists(output_dir_scen):
+        shutil.rmtree(output_dir_scen)
+    os.makedirs(output_dir_scen)
+    os.chdir(output_dir_scen)
+    with cleanup():
+        logging.info("Tiling layers: {}".format([l.name for l in layers]))
+        if layers:
+            tiler.tile(layers)
+        if make_transition_rules:
+            rule_manager.write_rules()
+
+    for path in glob.glob(os.path.join(shared_dir, "*_moja.zip")):
+        _link_or_copy(path, os.path.join(output_dir_scen, os.path.basename(path)))
+    # The study area lists the general layers first, as a single tiler run did
+    with open(os.path.join(shared_dir, "study_area.json"), "rb") as shared_file:
+        shared = json.load(shared_file)
+    study_area_path = os.path.join(output_dir_scen, "study_area.json")
+    study_area = dict(shared, layers=[])
+    if os.path.exists(study_area_path):
+        with open(study_area_path, "rb") as study_area_file:
+            study_area = json.load(study_area_file)
+    study_area["layers"] = shared.get("layers", []) + study_area.get("layers", [])
+    with open(study_area_path, "wb") as study_area_file:
+        json.dump(study_area, study_area_file, indent=4)
 
 class Tiler(object):
     def __init__(self, spatialBoundaries, inventory, rollbackDisturbances, NAmat, rollback_range,
-                 activity_start_year, historic_range, future_range, resolution, ProgressPrinter):
+                 activity_start_year, historic_range, future_range, resolution, ProgressPrinter, seed=None,
+                 tile_cache=None, partition_dir=None, year_raster_dir=None, local_transition_rules=False):
         logging.info("Initializing class {}".format(self.__class__.__name__))
         self.ProgressPrinter = ProgressPrinter
         self.spatial_boundaries = spatialBoundaries
@@ -34,16 +79,115 @@ class Tiler(object):
         self.historic_range = historic_range
         self.future_range = future_range
         self.resolution = resolution
-        self.mgr = SharedTransitionRuleManager()
-        self.mgr.start()
-        self.rule_manager = self.mgr.TransitionRuleManager("transition_rules.csv")
+        # Seed of the random streams used by the slashburn and projected
+        # disturbance steps; None draws a new one every run
+        self.seed = seed
+        # Transition rules are registered through a shared manager process,
+        # or with local_transition_rules by the tiling processes themselves
+        # through a TransitionRuleRegistry and its shared rule store
+        self.mgr = None
+        if not local_transition_rules:
+            self.mgr = SharedTransitionRuleManager()
+            self.mgr.start()
+        self.rule_manager = self.newRuleManager("transition_rules.csv")
         self.layers = []
         self.tiler = None
+        # Multi-scenario tiling: directory of the general layers tiled once,
+        # and the (scenario, output dir, layers, rule manager, make rules)
+        # queued to run side by side
+        self.shared_dir = None
+        self.scenarios = []
+        # Optional TileCache (or its directory) of tiled layer outputs, and
+        # the (sources, params) of the cacheable layers by id. Layers with
+        # transition rules are always tiled, as their rule ids are assigned
+        # while tiling.
+        self.tile_cache = TileCache(tile_cache) if isinstance(tile_cache, basestring) else tile_cache
+        self.layer_keys = {}
+        # Optional directory the rollback and projected disturbances are
+        # split into, one file per (year, disturbance type), so that each
+        # disturbance layer reads only its own records
+        self.partition_dir = partition_dir
+        # Optional directory of the year-coded rasters the historic fire and
+        # harvest layers are split from, instead of filtering
+        # MergedDisturbances by year once per layer
+        self.year_raster_dir = year_raster_dir
+
+    def newRuleManager(self, output_path):
+        if self.mgr is None:
+            return TransitionRuleRegistry(output_path)
+        return self.mgr.TransitionRuleManager(output_path)
 
     def scan_for_layers(self, path, filter):
         return sorted(glob.glob(os.path.join(path, filter)),
                       key=os.path.basename)
 
+    def addLayer(self, layer, sources, params):
+        # Adds a layer that the tile cache can key on the contents of its
+        # source files and on params
+        self.layers.append(layer)
+        self.layer_keys[id(layer)] = (sources, params)
+
+    def layerCacheKey(self, layer):
+        if id(layer) not in self.layer_keys:
+            return None
+        sources, params = self.layer_keys[id(layer)]
+        bbox_path = self.inventory.getRasters()[0].getPath()
+        return self.tile_cache.key(sources + [bbox_path], [layer.name, params, self.resolution])
+
+    def partitionDisturbances(self, path, prefix):
+        # Splits the disturbances at path on DistYEAR_n and DistType in one
+        # pass, keeping the records within the inventory extent. Returns
+        # {(year, dist_code): path} with integer keys, whatever the field
+        # types, or None when partitioning is off.
+        if self.partition_dir is None:
+            return None
+        out_dir = os.path.join(self.partition_dir, prefix)
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.makedirs(out_dir)
+        bounds = self.inventory.getBottomLeftCorner() + self.inventory.getTopRightCorner()
+        partitions = {}
+        for key, partition in sorted(partition_layer(path, out_dir, ["DistYEAR_n", "DistType"],
+                                                     bounds=bounds, prefix=prefix).items()):
+            int_key = tuple(normalize_year(value) for value in key)
+            if None in int_key:
+                logging.warning("Ignoring partition {}: DistYEAR_n, DistType {} are not integers".format(partition, key))
+            elif int_key in partitions:
+                logging.warning("Ignoring partition {}: DistYEAR_n, DistType {} already in {}".format(
+                    partition, key, partitions[int_key]))
+            else:
+                partitions[int_key] = partition
+        return partitions
+
+    def disturbanceSource(self, path, partitions, year, dist_code):
+        # Source of the (year, dist_code) disturbance layer: its partition, or
+        # None when it has no records
+        if partitions is None:
+            return path
+        source = partitions.get((int(year), int(dist_code)))
+        if source is None:
+            logging.debug("No {} disturbances of type {} in {}, skipping the layer".format(year, dist_code, path))
+        return source
+
+    def checkPartitions(self, path, partitions, added):
+        # Warns when no disturbance layer matched a partition of path
+        if partitions is not None and not added:
+            logging.warning("None of the {} partitions of {} matched a disturbance year and type: {}".format(
+                len(partitions), path, sorted(partitions)))
+
+    def yearRasters(self, name, bands, year_range):
+        # Rasterizes the (path, layer, year field, date string) sources in
+        # bands once into <name>_years.tif, aligned to the bounding box
+        # raster, and splits off an event raster per year in year_range.
+        # Returns one {year: path} per band.
+        if not os.path.exists(self.year_raster_dir):
+            os.makedirs(self.year_raster_dir)
+        stack = os.path.join(self.year_raster_dir, "{}_years.tif".format(name))
+        rasterize_years(self.inventory.getRasters()[0].getPath(), stack, [b[1:] for b in bands])
+        return [split_years(stack, band, year_range,
+                            os.path.join(self.year_raster_dir, "{}_{{}}.tif".format(bands[band - 1][0])))
+                for band in range(1, len(bands) + 1)]
+
     def defineBoundingBox(self, output_dir):
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1).start()
         bbox_path = self.inventory.getRasters()[0].getPath()
@@ -63,24 +207,26 @@ class Tiler(object):
         general_lyrs = []
         for raster in self.inventory.getRasters():
             if raster.getAttrTable() == None:
-                self.layers.append(RasterLayer(raster.getPath()))
+                self.addLayer(RasterLayer(raster.getPath()), [raster.getPath()], ["raster"])
             else:
-                self.layers.append(RasterLayer(raster.getPath(),
+                self.addLayer(RasterLayer(raster.getPath(),
                     nodata_value=255,
                     attributes = [raster.getAttr()],
-                    attribute_table = raster.getAttrTable()))
+                    attribute_table = raster.getAttrTable()),
+                    [raster.getPath()], ["raster", 255, raster.getAttr(), raster.getAttrTable()])
             general_lyrs.append(os.path.basename(raster.getPath()).split('.')[0])
 
         for attr in self.spatial_boundaries.getAttributes():
             attr_field = self.spatial_boundaries.getAttrField(attr)
-            self.layers.append(VectorLayer(
+            self.addLayer(VectorLayer(
                 attr,
                 self.spatial_boundaries.getPathRI(),
-                Attribute(attr_field)))
+                Attribute(attr_field)),
+                [self.spatial_boundaries.getPathRI()], ["vector", attr_field])
             
             general_lyrs.append(attr)
 
-        self.layers.append(RasterLayer(self.NAmat.getPath(), nodata_value=1.0e38))
+        self.addLayer(RasterLayer(self.NAmat.getPath(), nodata_value=1.0e38), [self.NAmat.getPath()], ["raster", 1.0e38])
         general_lyrs.append(os.path.basename(self.NAmat.getPath()).split('.')[0])
         pp.finish()
 
@@ -89,14 +235,20 @@ class Tiler(object):
     def processRollbackDisturbances(self, dist_lookup, name_lookup):
         pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1).start()
 
+        partitions = self.partitionDisturbances(self.rollback_disturbances.getPath(), "rollback")
+        added = 0
         for year in range(self.rollback_range[0], self.rollback_range[1] + 1):
             for dist_code in dist_lookup:
                 label = dist_lookup[dist_code]
                 name = name_lookup[dist_code]
+                source = self.disturbanceSource(self.rollback_disturbances.getPath(), partitions, year, dist_code)
+                if source is None:
+                    continue
+                added += 1
                 self.layers.append(DisturbanceLayer(
                     self.rule_manager,
                     VectorLayer("rollback_{}_{}".format(name, year),
-                                self.rollback_disturbances.getPath(),
+                                source,
                                 [
                                     Attribute("DistYEAR_n", filter=ValueFilter(year)),
                                     Attribute("DistType", filter=ValueFilter(dist_code), substitutions=dist_lookup),
@@ -107,6 +259,7 @@ class Tiler(object):
                     transition=TransitionRule(
                         regen_delay=Attribute("RegenDelay"),
                         age_after=0)))
+        self.checkPartitions(self.rollback_disturbances.getPath(), partitions, added)
         pp.finish()
 
     def processHistoricFireDisturbances(self, dist, dt):
@@ -115,6 +268,22 @@ class Tiler(object):
         _, rollback_end_year = self.rollback_range
         _, historic_end_year = self.historic_range
         workspace = self.inventory.getWorkspace()
+        if self.year_raster_dir is not None:
+            year_range = range(rollback_end_year + 1, historic_end_year + 1)
+            fire_rasters, = self.yearRasters("fire",
+                [("fire", workspace, "MergedDisturbances", dist.getYearField(), True)], year_range)
+            for year, path in fire_rasters.items():
+                self.layers.append(DisturbanceLayer(
+                    self.rule_manager,
+                    RasterLayer(path, attributes="event", attribute_table={1: [1]}),
+                    year=year,
+                    disturbance_type=dt,
+                    transition=TransitionRule(
+                        regen_delay=0,
+                        age_after=0)))
+            pp.finish()
+            return
+
         for year in range(rollback_end_year + 1, historic_end_year + 1):
             self.layers.append(DisturbanceLayer(
                 self.rule_manager,
@@ -138,9 +307,26 @@ class Tiler(object):
         year_range = range(rollback_end_year + 1, historic_end_year + 1)
         workspace = self.inventory.getWorkspace()
         if year_range:
-            sb = GenerateSlashburn(self.ProgressPrinter)
+            sb = GenerateSlashburn(self.ProgressPrinter, self.seed)
             sb_shp = sb.generateSlashburn(self.inventory, harvest_poly_shp, dist.getYearField(), year_range, sb_percent)
 
+        if self.year_raster_dir is not None and year_range:
+            harvest_rasters, slashburn_rasters = self.yearRasters("harvest", [
+                ("harvest", workspace, "MergedDisturbances", dist.getYearField(), False),
+                ("slashburn", sb_shp, None, dist.getYearField(), False)], year_range)
+            for rasters, dt in [(harvest_rasters, cc_dt), (slashburn_rasters, sb_dt)]:
+                for year, path in rasters.items():
+                    self.layers.append(DisturbanceLayer(
+                        self.rule_manager,
+                        RasterLayer(path, attributes="event", attribute_table={1: [1]}),
+                        year=year,
+                        disturbance_type=dt,
+                        transition=TransitionRule(
+                            regen_delay=0,
+                            age_after=0)))
+            pp.finish()
+            return
+
         for year in year_range:
             self.layers.append(DisturbanceLayer(
                 self.rule_manager,
@@ -196,11 +382,12 @@ class Tiler(object):
         
         for file_name in self.scan_for_layers(dist.getWorkspace(), dist.getFilter()):
             for year in year_range:
-                self.layers.append(DisturbanceLayer(
+                self.addLayer(DisturbanceLayer(
                     self.rule_manager,
                     VectorLayer("insect_{}".format(year), file_name, Attribute(dist_type_attr, substitutions=dist_type_lookup)),
                     year=Attribute(year_attr, filter=ValueFilter(year, True)),
-                    disturbance_type=Attribute(dist_type_attr)))
+                    disturbance_type=Attribute(dist_type_attr)),
+                    [file_name], ["disturbance", dist_type_attr, dist_type_lookup, year_attr, year])
         pp.finish()
 
     def processProjectedDisturbancesRasters(self, scenario, base_raster_dir, scenario_raster_dir, params):
@@ -247,17 +434,18 @@ class Tiler(object):
 
         result = []
         result.extend(f.processFire())
-        result.extend(f.processHarvest(self.activity_start_year, actv_percent_harv, RandomRasterSubset()))
-        result.extend(f.processSlashburn(percent_sb, self.activity_start_year, actv_percent_sb, RandomRasterSubset()))
+        result.extend(f.processHarvest(self.activity_start_year, actv_percent_harv, RandomRasterSubset(self.seed)))
+        result.extend(f.processSlashburn(percent_sb, self.activity_start_year, actv_percent_sb, RandomRasterSubset(self.seed)))
 
         for item in result:
-            self.layers.append(DisturbanceLayer(
+            self.addLayer(DisturbanceLayer(
                     self.rule_manager,
                     RasterLayer(item["Path"],
                                 attributes="event",
                                 attribute_table={1: [1]}),
                     year=item["Year"],
-                    disturbance_type=projected_dist_lookup[item["DisturbanceName"]]))
+                    disturbance_type=projected_dist_lookup[item["DisturbanceName"]]),
+                    [item["Path"]], ["disturbance", "event", item["Year"], projected_dist_lookup[item["DisturbanceName"]]])
 
 
         pp.finish()
@@ -272,7 +460,7 @@ class Tiler(object):
         actv_percent_sb = params[1]
         actv_percent_harv = params[2]
         placeholder = ProjectedDisturbancesPlaceholder(self.inventory, self.rollback_disturbances,
-            self.future_range, self.rollback_range, self.activity_start_year, self.ProgressPrinter)
+            self.future_range, self.rollback_range, self.activity_start_year, self.ProgressPrinter, seed=self.seed)
         projectedDisturbances = placeholder.generateProjectedDisturbances(scenario, percent_sb, actv_percent_sb, actv_percent_harv)
 
         projected_dist_lookup = {
@@ -287,14 +475,20 @@ class Tiler(object):
             13: "slashburn"
         }
         
+        partitions = self.partitionDisturbances(projectedDisturbances, "projected_{}".format(scenario))
+        added = 0
         for year in range(self.historic_range[1]+1, self.future_range[1]+1):
             for dist_code in projected_dist_lookup:
                 label = projected_dist_lookup[dist_code]
                 name = projected_name_lookup[dist_code]
+                source = self.disturbanceSource(projectedDisturbances, partitions, year, dist_code)
+                if source is None:
+                    continue
+                added += 1
                 self.layers.append(DisturbanceLayer(
                     self.rule_manager,
                     VectorLayer("projected_{}_{}".format(name, year),
-                                projectedDisturbances,
+                                source,
                                 [
                                     Attribute("DistYEAR_n", filter=ValueFilter(year)),
                                     Attribute("DistType", filter=ValueFilter(dist_code), substitutions=projected_dist_lookup),
@@ -305,6 +499,7 @@ class Tiler(object):
                     transition=TransitionRule(
                         regen_delay=Attribute("RegenDelay"),
                         age_after=0)))
+        self.checkPartitions(projectedDisturbances, partitions, added)
         pp.finish()
 
     def runTiler(self, output_dir, scenario, make_transition_rules):
@@ -319,9 +514,24 @@ class Tiler(object):
             
         cwd = os.getcwd()
         os.chdir(output_dir_scen)
+        layers = self.layers
+        cached = []
+        if self.tile_cache is not None:
+            layers = []
+            for layer in self.layers:
+                key = self.layerCacheKey(layer)
+                study_area = self.tile_cache.fetch(key, layer.name, output_dir_scen) if key else None
+                if study_area is None:
+                    layers.append(layer)
+                else:
+                    cached.append(study_area)
+            logging.info("Reused {} tiled layers from the tile cache".format(len(cached)))
         with cleanup():
-            logging.info("Tiling layers: {}".format([l.name for l in self.layers]))
-            self.tiler.tile(self.layers)
+            logging.info("Tiling layers: {}".format([l.name for l in layers]))
+            if layers or not cached:
+                self.tiler.tile(layers)
+            if self.tile_cache is not None:
+                self.updateTileCache(output_dir_scen, layers, cached)
             transitionRules = None
             if make_transition_rules:
                 self.rule_manager.write_rules()
@@ -333,6 +543,130 @@ class Tiler(object):
         
         os.chdir(cwd)
         self.layers = []
+        self.layer_keys = {}
         pp.finish()
         
         return transitionRules
+
+    def updateTileCache(self, output_dir_scen, tiled, cached):
+        # Stores the newly tiled cacheable layers, then lists the layers
+        # taken from the cache in study_area.json, in the order they were added
+        study_area_path = os.path.join(output_dir_scen, "study_area.json")
+        if os.path.exists(study_area_path):
+            with open(study_area_path, "rb") as study_area_file:
+                study_area = json.load(study_area_file)
+        else:
+            study_area = dict(cached[0], layers=[])
+        for layer in tiled:
+            key = self.layerCacheKey(layer)
+            if key:
+                self.tile_cache.store(key, layer.name, output_dir_scen, study_area)
+
+        entries = study_area.get("layers", []) + [l for c in cached for l in c.get("layers", [])]
+        order = dict((layer.name, i) for i, layer in reversed(list(enumerate(self.layers))))
+        study_area["layers"] = sorted(entries, key=lambda l: order.get(l.get("name"), len(order)))
+        with open(study_area_path, "wb") as study_area_file:
+            json.dump(study_area, study_area_file, indent=4)
+        self.tile_cache.logStats()
+
+    def tileGeneralLayers(self, output_dir):
+        """
+        Tiles the layers added so far (processGeneralLayers) once into
+        output_dir\\SHARED, to be shared by the scenarios run with
+        runScenarios.
+        """
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], 1).start()
+        self.shared_dir = os.path.join(output_dir, "SHARED")
+        if os.path.exists(self.shared_dir):
+            shutil.rmtree(self.shared_dir)
+        os.makedirs(self.shared_dir)
+        logging.info("Tiling general layers once into {}".format(self.shared_dir))
+        cwd = os.getcwd()
+        os.chdir(self.shared_dir)
+        with cleanup():
+            self.tiler.tile(self.layers)
+        os.chdir(cwd)
+        self.layers = []
+        self.layer_keys = {}
+        pp.finish()
+
+    def startScenario(self, output_dir, scenario):
+        """
+        Starts collecting the disturbance layers of a scenario for
+        runScenarios. Each scenario gets its own transition rule manager, so
+        the scenarios can write their rules concurrently.
+        """
+        output_dir_scen = r"{}\SCEN_{}".format(output_dir, scenario)
+        self.layers = []
+        self.layer_keys = {}
+        self.rule_manager = self.newRuleManager(os.path.join(output_dir_scen, "transition_rules.csv"))
+        self.scenarios.append([scenario, output_dir_scen, None, self.rule_manager, False])
+
+    def queueScenario(self, make_transition_rules):
+        # Ends the scenario begun with startScenario
+        self.scenarios[-1][2] = self.layers
+        self.scenarios[-1][4] = make_transition_rules
+        self.layers = []
+
+    def runScenarios(self, processes=None):
+        """
+        Tiles the queued scenarios side by side, at most processes at a time,
+        each adding the general layers from tileGeneralLayers. Scenarios run
+        in their own (non daemonic) processes as the tiler starts workers of
+        its own; the cores are divided among the scenarios tiled at once, so
+        each scenario's tiler gets cpu_count() // processes workers. Returns
+        {scenario: TransitionRules or None}.
+
+        On Windows the tiler, the layers and the rule manager of each
+        scenario are pickled into its process, as processes are started by
+        spawning rather than forking. The tiler and layers are checked for
+        that up front there; the rule manager (a manager proxy or
+        TransitionRuleRegistry) pickles by design. Under spawn the calling
+        script is imported again by each process, so it must start the run
+        from an if __name__ == "__main__" block.
+        """
+        pp = self.ProgressPrinter.newProcess(inspect.stack()[0][3], len(self.scenarios)).start()
+        processes = min(processes or max(multiprocessing.cpu_count() - 1, 1), max(len(self.scenarios), 1))
+        workers = max(multiprocessing.cpu_count() // processes, 1)
+        tiler = CompressingTiler2D(self.bbox, use_bounding_box_resolution=True, workers=workers)
+        logging.info("Tiling {} scenarios {} at a time with {} tiler workers each".format(
+            len(self.scenarios), processes, workers))
+        results = {}
+        for i in range(0, len(self.scenarios), processes):
+            batch = self.scenarios[i:i + processes]
+            workers = []
+            for scenario, output_dir_scen, layers, rule_manager, make_transition_rules in batch:
+                logging.info("Tiler output directory: {}".format(output_dir_scen))
+                layers = layers or []
+                if sys.platform == "win32":
+                    try:
+                        cPickle.dumps((tiler, layers), cPickle.HIGHEST_PROTOCOL)
+                    except (cPickle.PicklingError, TypeError) as e:
+                        raise TypeError("The tiler and layers of scenario {} cannot be pickled into its process: {}".format(
+                            scenario, e))
+                worker = multiprocessing.Process(target=_tile_scenario, args=(tiler, layers, rule_manager,
+                    output_dir_scen, self.shared_dir, make_transition_rules))
+                worker.start()
+                workers.append(worker)
+            # Every process of the batch is joined before a failure is raised,
+            # so none is left running
+            for worker in workers:
+                worker.join()
+            failed = ["{} (exit code {})".format(scenario[0], worker.exitcode)
+                      for worker, scenario in zip(workers, batch) if worker.exitcode != 0]
+            if failed:
+                raise RuntimeError("Tiling failed for scenarios {}".format(", ".join(failed)))
+            for scenario, output_dir_scen, _, _, make_transition_rules in batch:
+                transitionRules = None
+                if make_transition_rules:
+                    ccol = {}
+                    for classifier in self.inventory.getClassifiers():
+                        ccol.update({classifier: None})
+                    transitionRules = TransitionRules(path=os.path.join(output_dir_scen, "transition_rules.csv"),
+                        classifier_cols=ccol, header=True, cols={"NameCol": 0, "AgeCol": 2, "DelayCol": 1})
+                results[scenario] = transitionRules
+                pp.updateProgressV()
+        self.scenarios = []
+        pp.finish()
+
+        return results
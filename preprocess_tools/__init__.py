@@ -2,4 +2,9 @@ import progressprinter
 import inputs
 import disturbance_manager
 import licensemanager
-
+import featureio
+import tableio
+import grid
+import rectclip
+import overlay
+import attribute_raster
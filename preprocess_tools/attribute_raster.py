@@ -0,0 +1,177 @@
+'''
+Multi-attribute rasterization of a polygon layer. Feature positions are
+rasterized once, a block of rows at a time, and every attribute raster is
+gathered from its column with a vectorized take, in parallel over the
+attributes. Exporting n fields costs one rasterization instead of n.
+
+Both paths return the value attribute tables they used from memory, in the
+code -> [value] form Inventory.addRaster takes.
+'''
+import os
+import math
+import time
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+# Nodata values of the 32-bit output rasters, the ArcGIS defaults
+INT_NODATA = -2147483648
+FLOAT_NODATA = -3.4028234663852886e+38
+
+class ColumnEncoder(object):
+    '''
+    Builds the lookup of encode_column a value at a time, for columns too
+    large to hold as lists of Python values: values are kept in typed numpy
+    chunks, text values as provisional codes in order of appearance.
+    '''
+    def __init__(self, field_type, chunk_size=65536):
+        # Fiona reports integers as int, int32 or int64 depending on the
+        # driver and width, as tableio._arrow_type handles them
+        self.base = (field_type or "str").split(":")[0]
+        if self.base.startswith("int"):
+            self.base = "int"
+        if self.base == "float":
+            self.dtype, self.nodata = np.float32, FLOAT_NODATA
+        else:
+            self.dtype, self.nodata = np.int32, INT_NODATA
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.pending = []
+        # Provisional code of each text value
+        self.codes = {}
+
+    def append(self, value):
+        if self.base not in ("int", "float"):
+            value = None if value is None else self.codes.setdefault(value, len(self.codes) + 1)
+        self.pending.append(self.nodata if value is None else value)
+        if len(self.pending) >= self.chunk_size:
+            self.chunks.append(np.array(self.pending, dtype=self.dtype))
+            self.pending = []
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def finish(self):
+        # (lookup, nodata, attr_table), see encode_column
+        values = np.concatenate([np.array([self.nodata], dtype=self.dtype)] + self.chunks +
+                                [np.array(self.pending, dtype=self.dtype)])
+        self.chunks = []
+        self.pending = []
+        if self.base in ("int", "float"):
+            return values, self.nodata, None
+        # Provisional codes become 1..n in sorted order of the values
+        ranks = np.empty(len(self.codes) + 1, dtype=np.int32)
+        ranks[0] = INT_NODATA
+        ordered = sorted(self.codes)
+        ranks[[self.codes[v] for v in ordered]] = np.arange(1, len(ordered) + 1)
+        values[values != INT_NODATA] = ranks[values[values != INT_NODATA]]
+        return values, INT_NODATA, dict((i + 1, [v]) for i, v in enumerate(ordered))
+
+def encode_column(values, field_type):
+    '''
+    Converts an attribute column into a lookup of raster values indexed by
+    feature position + 1; position 0 is nodata. Text columns are coded 1..n
+    in sorted order. Returns (lookup, nodata, attr_table) where attr_table
+    maps code -> [value] for text columns and is None otherwise.
+    '''
+    encoder = ColumnEncoder(field_type)
+    encoder.extend(values)
+    return encoder.finish()
+
+def feature_to_raster(arcpy, in_features, field_name, out_raster, cell_size, code_field="RASTER_CODE",
+                      code_table=r"in_memory\raster_codes"):
+    '''
+    FeatureToRaster_conversion that returns the attribute table it used, so
+    callers do not have to read back the .vat.dbf. Text fields are coded 1..n
+    in sorted order of their distinct values, held in code_table, a table of
+    one row per value joined to a layer of the features for rasterizing;
+    other fields are rasterized as they are and return None, as their value
+    attribute tables carry no attribute column. in_features is never
+    modified.
+    '''
+    field = arcpy.ListFields(in_features, field_name)[0]
+    if field.type != "String":
+        arcpy.FeatureToRaster_conversion(in_features, field_name, out_raster, cell_size)
+        return None
+
+    values = np.unique(arcpy.da.TableToNumPyArray(in_features, [field_name], skip_nulls=True)[field_name])
+    _, _, attr_table = encode_column(values.tolist(), "str")
+    if code_field.upper() == field_name.upper():
+        code_field = "{}_1".format(code_field)
+    codes = np.empty(len(values), dtype=[(field_name, values.dtype), (code_field, np.int32)])
+    codes[field_name] = values
+    codes[code_field] = np.arange(1, len(values) + 1)
+    layer = "raster_code_features"
+    if arcpy.Exists(code_table):
+        arcpy.Delete_management(code_table)
+    arcpy.da.NumPyArrayToTable(codes, code_table)
+    try:
+        # Features without a match (null values) get a null code and stay
+        # NoData in the raster
+        arcpy.MakeFeatureLayer_management(in_features, layer)
+        arcpy.AddJoin_management(layer, field_name, code_table, field_name, "KEEP_ALL")
+        arcpy.FeatureToRaster_conversion(layer, "{}.{}".format(os.path.basename(code_table), code_field),
+            out_raster, cell_size)
+    finally:
+        if arcpy.Exists(layer):
+            arcpy.Delete_management(layer)
+        arcpy.Delete_management(code_table)
+    return attr_table
+
+def raster_shape(bounds, resolution):
+    # (nrows, ncols) of a north-up raster covering bounds
+    return (int(math.ceil(round((bounds[3] - bounds[1]) / resolution, 6))),
+            int(math.ceil(round((bounds[2] - bounds[0]) / resolution, 6))))
+
+def rasterize_attributes(geometries, columns, paths, bounds, resolution, crs=None, block_rows=1024,
+                         processes=None):
+    '''
+    Writes one GeoTIFF per attribute column. columns maps a raster name to
+    (values, fiona field type) with one value per geometry, and paths maps
+    the same names to output files. Rasters are north-up from the top left
+    corner of bounds; a cell takes the feature containing its center.
+    Returns {name: attr_table} (see encode_column).
+    '''
+    import rasterio
+    from rasterio.features import rasterize
+    from rasterio.transform import Affine
+    from rasterio.windows import Window
+
+    start = time.time()
+    names = list(columns)
+    encoded = dict((n, encode_column(*columns[n])) for n in names)
+    nrows, ncols = raster_shape(bounds, resolution)
+    transform = Affine(resolution, 0.0, bounds[0], 0.0, -resolution, bounds[3])
+    extents = np.array([g.bounds for g in geometries], dtype=np.float64).reshape(-1, 4)
+
+    sinks = dict((n, rasterio.open(paths[n], "w", driver="GTiff", width=ncols, height=nrows, count=1,
+        dtype=encoded[n][0].dtype.name, crs=crs, transform=transform, nodata=encoded[n][1],
+        tiled=True, compress="lzw")) for n in names)
+    pool = ThreadPool(processes or max(multiprocessing.cpu_count() - 1, 1))
+    try:
+        for row0 in range(0, nrows, block_rows):
+            row1 = min(row0 + block_rows, nrows)
+            top = bounds[3] - row0 * resolution
+            bottom = bounds[3] - row1 * resolution
+            hits = np.flatnonzero((extents[:, 1] < top) & (extents[:, 3] > bottom))
+            if len(hits):
+                ids = rasterize(((geometries[i], i + 1) for i in hits.tolist()), out_shape=(row1 - row0, ncols),
+                    transform=transform * Affine.translation(0, row0), fill=0, all_touched=False, dtype="int32")
+            else:
+                ids = np.zeros((row1 - row0, ncols), dtype=np.int32)
+            # take releases the GIL, so the gathers run side by side
+            blocks = pool.map(lambda n: np.take(encoded[n][0], ids), names)
+            window = Window(0, row0, ncols, row1 - row0)
+            for n, block in zip(names, blocks):
+                sinks[n].write(block, 1, window=window)
+    finally:
+        pool.close()
+        pool.join()
+        for sink in sinks.values():
+            sink.close()
+
+    logging.info("Rasterized {} features into {} attribute rasters ({}x{}) in {:.1f}s".format(
+        len(geometries), len(names), ncols, nrows, time.time() - start))
+    return dict((n, encoded[n][2]) for n in names)
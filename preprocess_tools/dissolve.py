@@ -0,0 +1,93 @@
+'''
+Parallel grouped dissolve. Features are grouped by attribute values and each
+group is unioned in a worker process with a cascaded union, largest groups
+first. Groups are written as they finish, so wall time is bounded by the
+largest group rather than by the sum of all of them.
+'''
+import time
+import logging
+import multiprocessing
+from collections import OrderedDict
+from preprocess_tools.featureio import write_features
+
+def _dissolve_group(args):
+    # Worker: unions the geometries of every dissolve key in one group.
+    # Returns (group, [(key, geometry mapping)]).
+    from shapely.geometry import shape, mapping
+    from shapely.ops import unary_union
+    group, members, single_part = args
+    by_key = OrderedDict()
+    for key, geometry in members:
+        geom = shape(geometry)
+        if not geom.is_valid:
+            geom = geom.buffer(0)
+        by_key.setdefault(key, []).append(geom)
+
+    out = []
+    for key, geoms in by_key.items():
+        merged = unary_union(geoms)
+        if merged.is_empty:
+            continue
+        parts = getattr(merged, "geoms", [merged]) if single_part else [merged]
+        for part in parts:
+            if part.geom_type in ("Polygon", "MultiPolygon") and not part.is_empty:
+                out.append((key, mapping(part)))
+    return group, out
+
+def dissolve(path, layer, out_path, dissolve_fields, group_fields=None, where=None, single_part=True,
+             processes=None, out_layer=None):
+    '''
+    Dissolves the polygons of a layer on dissolve_fields, like
+    Dissolve_management with SINGLE_PART by default. Features are sent to the
+    workers in groups sharing the values of group_fields (a subset of
+    dissolve_fields, all of them by default). where is an optional callable
+    taking the feature properties and returning a bool. Returns the number
+    of features written.
+    '''
+    import fiona
+    group_fields = list(group_fields or dissolve_fields)
+    start = time.time()
+    groups = {}
+    with fiona.open(path, layer=layer) as src:
+        crs = src.crs
+        schema = {
+            "geometry": "Polygon" if single_part else "MultiPolygon",
+            "properties": OrderedDict((f, src.schema["properties"][f]) for f in dissolve_fields)
+        }
+        count = 0
+        for f in src:
+            p = f["properties"]
+            if f["geometry"] is None or (where is not None and not where(p)):
+                continue
+            groups.setdefault(tuple(p[g] for g in group_fields), []).append(
+                (tuple(p[d] for d in dissolve_fields), f["geometry"]))
+            count += 1
+
+    processes = processes or max(multiprocessing.cpu_count() - 1, 1)
+    tasks = [(group, members, single_part) for group, members in
+             sorted(groups.items(), key=lambda g: len(g[1]), reverse=True)]
+    logging.info("Dissolving {} features of {} in {} groups on {} with {} processes".format(
+        count, layer or path, len(tasks), ", ".join(group_fields), processes))
+    del groups
+
+    def features():
+        if processes == 1:
+            results = (_dissolve_group(t) for t in tasks)
+        else:
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(_dissolve_group, tasks)
+        try:
+            for _, parts in results:
+                for key, geometry in parts:
+                    yield {
+                        "geometry": geometry,
+                        "properties": OrderedDict(zip(dissolve_fields, key))
+                    }
+        finally:
+            if processes != 1:
+                pool.close()
+                pool.join()
+
+    written = write_features(out_path, schema, crs, features(), layer=out_layer)
+    logging.info("Dissolved {} features into {} in {:.1f}s".format(count, written, time.time() - start))
+    return written
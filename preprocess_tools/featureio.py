@@ -0,0 +1,293 @@
+'''
+Open-source (fiona/OGR) helpers for reading and bulk writing feature layers
+without an ArcGIS license.
+'''
+import os
+import logging
+import time
+import itertools
+import multiprocessing
+from collections import OrderedDict
+
+# Output drivers keyed by file extension. Shapefile is kept for compatibility
+# but is capped at 2 GB; GeoPackage and FlatGeobuf are not.
+DRIVERS = {
+    ".shp": "ESRI Shapefile",
+    ".gpkg": "GPKG",
+    ".fgb": "FlatGeobuf",
+    ".gdb": "OpenFileGDB",
+    ".geojson": "GeoJSON"
+}
+
+def get_driver(path):
+    ext = os.path.splitext(path.rstrip("\\/"))[1].lower()
+    if ext not in DRIVERS:
+        raise ValueError("No vector driver registered for {}".format(path))
+    driver = DRIVERS[ext]
+    if ext == ".gdb":
+        import fiona
+        # OpenFileGDB can only write with GDAL >= 3.6, the ESRI SDK driver
+        # (FileGDB) can write with older builds when it is available.
+        if "w" not in fiona.supported_drivers.get("OpenFileGDB", "") and \
+                "w" in fiona.supported_drivers.get("FileGDB", ""):
+            driver = "FileGDB"
+    return driver
+
+def read_crs_bounds(path, layer=None):
+    import fiona
+    with fiona.open(path, layer=layer) as src:
+        return src.crs, src.bounds
+
+def write_features(path, schema, crs, features, layer=None, batch_size=100000, **kwargs):
+    '''
+    Writes an iterable of fiona records to path in batches with writerecords.
+    Returns the number of features written.
+    '''
+    import fiona
+    driver = get_driver(path)
+    start = time.time()
+    count = 0
+    with fiona.open(path, "w", driver=driver, schema=schema, crs=crs, layer=layer, **kwargs) as sink:
+        batch = []
+        for f in features:
+            batch.append(f)
+            if len(batch) >= batch_size:
+                sink.writerecords(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            sink.writerecords(batch)
+            count += len(batch)
+    elapsed = time.time() - start
+    logging.info("Wrote {} features to {}{} in {:.1f}s ({:.0f} features/s)".format(
+        count, path, ":{}".format(layer) if layer else "", elapsed, count / max(elapsed, 1e-6)))
+    return count
+
+def read_layer(path, layer=None, columns=None, where=None, geometry=True):
+    '''
+    Reads a layer into memory as {"fid": array, "geometry": [shapely geoms],
+    "properties": {column: list}, "schema": schema, "crs": crs}. where is an
+    optional callable taking the feature properties and returning a bool.
+    '''
+    import fiona
+    import numpy as np
+    from shapely.geometry import shape
+    fids = []
+    geoms = []
+    with fiona.open(path, layer=layer) as src:
+        schema = src.schema
+        crs = src.crs
+        columns = list(schema["properties"].keys()) if columns is None else list(columns)
+        props = dict((c, []) for c in columns)
+        for f in src:
+            p = f["properties"]
+            if where is not None and not where(p):
+                continue
+            if geometry:
+                if f["geometry"] is None:
+                    continue
+                geoms.append(shape(f["geometry"]))
+            fids.append(int(f["id"]))
+            for c in columns:
+                props[c].append(p[c])
+    logging.info("Read {} features from {}{}".format(len(fids), path, ":{}".format(layer) if layer else ""))
+    return {"fid": np.array(fids, dtype=np.int64), "geometry": geoms, "properties": props,
+            "schema": schema, "crs": crs}
+
+def read_schema(path, layer=None):
+    import fiona
+    with fiona.open(path, layer=layer) as src:
+        return src.schema, src.crs
+
+def iter_properties(path, layer=None, columns=None, where=None):
+    '''
+    Yields the values of columns of each feature as a tuple, one feature at a
+    time, for readers that keep them in arrays of their own. where is as for
+    read_layer.
+    '''
+    import fiona
+    with fiona.open(path, layer=layer) as src:
+        columns = list(src.schema["properties"].keys()) if columns is None else list(columns)
+        for f in src:
+            p = f["properties"]
+            if where is None or where(p):
+                yield tuple(p[c] for c in columns)
+
+def normalize_year(value, date_string=False):
+    '''
+    Integer year of a disturbance year value. With date_string the year is
+    the first four characters of the value, as in the NBAC date strings.
+    Returns None for null or unparseable values.
+    '''
+    if value is None:
+        return None
+    try:
+        if date_string:
+            return int(str(value).strip()[:4])
+        if isinstance(value, basestring):
+            return int(float(value.strip()))
+        return int(value)
+    except ValueError:
+        return None
+
+# Fields an FGDB source computes from its geometry, stale once merged
+DERIVED_FIELDS = ("shape_area", "shape_length")
+
+def _widen_type(name, a, b):
+    # Fiona field type holding the values of both types: the wider integer,
+    # float over integer, the longer text. Other mixes cannot be merged.
+    if a == b:
+        return a
+    base_a, base_b = a.split(":")[0], b.split(":")[0]
+    if base_a == base_b == "str":
+        # A text field without a width is the driver's widest
+        if ":" not in a or ":" not in b:
+            return "str"
+        return "str:{}".format(max(int(a.split(":")[1]), int(b.split(":")[1])))
+    if base_a == base_b == "float":
+        return "float"
+    numeric = [t for t in (base_a, base_b) if t.startswith("int") or t == "float"]
+    if len(numeric) == 2:
+        if "float" in numeric:
+            return "float"
+        return "int32" if numeric == ["int32", "int32"] else "int64"
+    raise ValueError("Field {} is {} in one merge source and {} in another".format(name, a, b))
+
+def _read_source(args):
+    # Worker: reads features [start, stop) of one merge source, adding the
+    # normalized year. Returns (path, features, unparseable year count,
+    # seconds).
+    import fiona
+    path, layer, source_year_field, date_string, year_field, start, stop = args
+    started = time.time()
+    features = []
+    invalid = 0
+    with fiona.open(path, layer=layer) as src:
+        for _, f in src.items(start, stop):
+            if f["geometry"] is None:
+                continue
+            p = dict(f["properties"])
+            year = normalize_year(p.get(source_year_field), date_string)
+            if year is None and p.get(source_year_field) is not None:
+                invalid += 1
+            p[year_field] = year
+            geometry = f["geometry"]
+            if geometry["type"] == "Polygon":
+                geometry = {"type": "MultiPolygon", "coordinates": [geometry["coordinates"]]}
+            features.append({"geometry": geometry, "properties": p})
+    return path, features, invalid, time.time() - started
+
+def _imap_bounded(pool, worker, tasks, window):
+    # pool.imap without its unbounded read-ahead: at most window results are
+    # pending or held at any time, so fast readers cannot outrun the writer
+    tasks = iter(tasks)
+    pending = [pool.apply_async(worker, (t,)) for t in itertools.islice(tasks, window)]
+    while pending:
+        result = pending.pop(0).get()
+        for t in itertools.islice(tasks, 1):
+            pending.append(pool.apply_async(worker, (t,)))
+        yield result
+
+def merge_layers(sources, path, layer=None, year_field="DistYEAR", processes=None, chunk_size=50000):
+    '''
+    Merges polygon sources into one layer, like Merge_management with a
+    field mapping of every source year field onto year_field. sources is a
+    list of (path, layer, year field, date_string) read in worker processes
+    (see normalize_year), chunk_size features at a time; chunks stream into
+    the output in source order and only a few are held in memory at once.
+    The output has the fields of all sources, with types widened where the
+    sources disagree (see _widen_type) and without the stale FGDB
+    Shape_Area and Shape_Length, and a spatial index. Returns the number of
+    features written.
+    '''
+    import fiona
+    properties = OrderedDict()
+    crs = None
+    tasks = []
+    for source_path, source_layer, source_year_field, date_string in sources:
+        with fiona.open(source_path, layer=source_layer) as src:
+            crs = crs or src.crs
+            for name, field_type in src.schema["properties"].items():
+                if name.lower() in DERIVED_FIELDS:
+                    continue
+                properties[name] = _widen_type(name, properties.get(name, field_type), field_type)
+            count = len(src)
+        tasks.extend((source_path, source_layer, source_year_field, date_string, year_field, start,
+                      min(start + chunk_size, count)) for start in range(0, count, chunk_size))
+    properties[year_field] = "int"
+    schema = {"geometry": "MultiPolygon", "properties": properties}
+
+    processes = processes or max(multiprocessing.cpu_count() - 1, 1)
+    logging.info("Merging {} sources in {} chunks into {}{} with {} processes".format(
+        len(sources), len(tasks), path, ":{}".format(layer) if layer else "", processes))
+
+    def features():
+        if processes == 1:
+            results = (_read_source(t) for t in tasks)
+        else:
+            pool = multiprocessing.Pool(processes)
+            results = _imap_bounded(pool, _read_source, tasks, 2 * processes)
+        # Read counts per source, logged with the last chunk of the source
+        chunks = dict((t[0], 0) for t in tasks)
+        for t in tasks:
+            chunks[t[0]] += 1
+        totals = dict((source_path, [0, 0, 0.0]) for source_path in chunks)
+        try:
+            for source_path, source_features, invalid, elapsed in results:
+                total = totals[source_path]
+                total[0] += len(source_features)
+                total[1] += invalid
+                total[2] += elapsed
+                chunks[source_path] -= 1
+                if not chunks[source_path]:
+                    logging.info("Read {} features from {} in {:.1f}s{}".format(total[0], source_path,
+                        total[2], " ({} unparseable years)".format(total[1]) if total[1] else ""))
+                for f in source_features:
+                    yield {
+                        "geometry": f["geometry"],
+                        "properties": OrderedDict((name, f["properties"].get(name)) for name in properties)
+                    }
+        finally:
+            if processes != 1:
+                pool.close()
+                pool.join()
+
+    options = {"SPATIAL_INDEX": "YES"} if get_driver(path) in ("GPKG", "ESRI Shapefile") else {}
+    return write_features(path, schema, crs, features(), layer=layer, **options)
+
+def partition_layer(path, out_dir, fields, layer=None, bounds=None, prefix=None, ext=".shp"):
+    '''
+    Splits a layer in one pass into a file per distinct combination of
+    values of fields, named <prefix>_<value>_<value><ext>. Only features
+    whose bounding box meets bounds (xmin, ymin, xmax, ymax) are kept.
+    Returns {values: path}.
+    '''
+    import fiona
+    from shapely.geometry import shape
+    prefix = prefix or os.path.splitext(os.path.basename(path))[0]
+    start = time.time()
+    sinks = {}
+    paths = {}
+    count = 0
+    try:
+        with fiona.open(path, layer=layer) as src:
+            for f in src:
+                if f["geometry"] is None:
+                    continue
+                if bounds is not None:
+                    xmin, ymin, xmax, ymax = shape(f["geometry"]).bounds
+                    if xmin > bounds[2] or xmax < bounds[0] or ymin > bounds[3] or ymax < bounds[1]:
+                        continue
+                key = tuple(f["properties"][field] for field in fields)
+                if key not in sinks:
+                    paths[key] = os.path.join(out_dir, "{}_{}{}".format(prefix, "_".join(str(v) for v in key), ext))
+                    sinks[key] = fiona.open(paths[key], "w", driver=get_driver(paths[key]),
+                                            schema=src.schema, crs=src.crs)
+                sinks[key].write(f)
+                count += 1
+    finally:
+        for sink in sinks.values():
+            sink.close()
+    logging.info("Partitioned {} features of {} on {} into {} files in {:.1f}s".format(
+        count, path, ", ".join(fields), len(paths), time.time() - start))
+    return paths
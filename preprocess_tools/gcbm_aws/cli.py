@@ -1,5 +1,6 @@
 import os
 import csv
+import time
 from math import ceil
 from urlparse import urlparse
 import multiprocessing
@@ -82,6 +83,27 @@ def extract(datalist, like, bbox, dst_crs, out_path):
                                  bbox, dst_crs=dst_crs)
 
 
+def grid_band(args):
+    """Build the grid cell records for rows [row_start, row_stop)
+    """
+    xmin, ymin, cell_size, cols, row_start, row_stop, tile_area = args
+    records = []
+    for row_id in range(row_start, row_stop):
+        y = ymin + (row_id * cell_size)
+        for col_id in range(cols):
+            x = xmin + (col_id * cell_size)
+            # area covered by all cells written before this one
+            area = (row_id * cols + col_id) * (cell_size * cell_size)
+            records.append({
+                'geometry': {'type': 'Polygon',
+                             'coordinates': [[(x, y), (x + cell_size, y),
+                                              (x + cell_size, y + cell_size),
+                                              (x, y + cell_size), (x, y)]]},
+                'properties': {'cell_id': str(col_id + 1)+','+str(row_id + 1),
+                               'tile_id': int(ceil(area / tile_area)) + 1}})
+    return records
+
+
 @cli.command()
 @click.argument('in_file', type=click.Path(exists=True))
 @click.argument('out_file')
@@ -89,7 +111,17 @@ def extract(datalist, like, bbox, dst_crs, out_path):
 @click.option('--layer', '-l', help='Input layer')
 @click.option('--tile_area', '-t', type=int, default='100000',
               help='Max area covered per tile_id (ha)')
-def create_grid(in_file, out_file, cell_size, layer, tile_area):
+@click.option('--batch', is_flag=True,
+              help='Build row bands in worker processes and write in batches')
+@click.option('--band_rows', '-b', type=int, default=100,
+              help='Rows of cells per band in batch mode')
+@click.option('--n_processes', '-p', type=int, default=CONFIG["n_processes"],
+              help='Worker processes in batch mode')
+@click.option('--driver', '-d', default=None,
+              help='Output driver, derived from out_file extension by default '
+                   '(.shp, .gpkg, .fgb)')
+def create_grid(in_file, out_file, cell_size, layer, tile_area, batch,
+                band_rows, n_processes, driver):
     '''Create regular polygon grid shapefile
     '''
     if not layer:
@@ -109,10 +141,17 @@ def create_grid(in_file, out_file, cell_size, layer, tile_area):
     # convert tile area to m2
     tile_area = tile_area * 10000
 
-    # write grid to .shp
+    driver = driver or util.get_driver(out_file)
+    if batch:
+        create_grid_batched(out_file, crs, xmin, ymin, rows, cols, cell_size,
+                            tile_area, band_rows, n_processes, driver)
+        return
+
+    # write grid to out_file with the chosen driver
     schema = {'geometry': 'Polygon', 'properties': {'cell_id': 'str',
                                                     'tile_id': 'int'}}
-    with fiona.open(out_file, 'w', 'ESRI Shapefile', schema, crs=crs) as sink:
+    with fiona.open(out_file, 'w', driver, schema, crs=crs,
+                    **util.layer_options(driver)) as sink:
         with click.progressbar(range(rows)) as bar:
             area = 0
             for row_id in bar:
@@ -130,6 +169,36 @@ def create_grid(in_file, out_file, cell_size, layer, tile_area):
                     area = area + (cell_size * cell_size)
 
 
+def create_grid_batched(out_file, crs, xmin, ymin, rows, cols, cell_size,
+                        tile_area, band_rows, n_processes, driver):
+    """Build bands of rows in a process pool and write each with writerecords
+    """
+    schema = {'geometry': 'Polygon', 'properties': {'cell_id': 'str',
+                                                    'tile_id': 'int'}}
+    bands = [(xmin, ymin, cell_size, cols, r, min(r + band_rows, rows),
+              tile_area) for r in range(0, rows, band_rows)]
+    util.info('Writing %s cells in %s bands to %s (%s)' % (
+        rows * cols, len(bands), out_file, driver))
+    start = time.time()
+    n = 0
+    pool = multiprocessing.Pool(max(n_processes, 1))
+    try:
+        with fiona.open(out_file, 'w', driver, schema, crs=crs,
+                        **util.layer_options(driver)) as sink:
+            with click.progressbar(length=len(bands)) as bar:
+                # imap keeps bands in order so cell and tile ids stay sorted
+                for records in pool.imap(grid_band, bands):
+                    sink.writerecords(records)
+                    n += len(records)
+                    bar.update(1)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    util.success('Wrote %s cells in %.1fs (%.0f cells/sec)' % (
+        n, elapsed, n / max(elapsed, 1e-6)))
+
+
 # load source data to postgres
 # (would be useful for processing rollback on AWS)
 @cli.command()
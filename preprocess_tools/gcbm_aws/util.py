@@ -54,6 +54,26 @@ def sizeof_fmt(num):
     return "%.f%s%s" % (num, 'y', 'b')
 
 
+def get_driver(path):
+    """OGR driver name for an output path, based on its extension
+    """
+    drivers = {'.shp': 'ESRI Shapefile',
+               '.gpkg': 'GPKG',
+               '.fgb': 'FlatGeobuf'}
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in drivers:
+        raise click.BadParameter('Unsupported output format: %s' % path)
+    return drivers[ext]
+
+
+def layer_options(driver):
+    """Layer creation options; GeoPackage and FlatGeobuf get a spatial index
+    """
+    if driver in ('GPKG', 'FlatGeobuf'):
+        return {'SPATIAL_INDEX': 'YES'}
+    return {}
+
+
 def make_sure_path_exists(path):
     """
     Make directories in path if they do not exist.
@@ -0,0 +1,243 @@
+'''
+Vectorized fishnet engine. Cell bounds, row-major cell ids and cell areas are
+computed as NumPy arrays one band of rows at a time and written to an OGR
+datasource in a single bulk pass, replacing CreateFishnet followed by separate
+CalculateField passes.
+
+RegularGrid is the implicit, geometry-free form of the same fishnet: it is
+defined by origin, resolution and shape only and maps coordinates to cell ids
+(and back) arithmetically. Cell polygons are only produced on request.
+
+Cell ids are 1-based and row-major starting from the bottom-left cell. A cell
+id of 0 means "no cell".
+'''
+import os
+import math
+import logging
+from collections import OrderedDict
+import numpy as np
+from preprocess_tools.featureio import write_features
+
+# WGS 1984 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+GRID_SCHEMA = {
+    "geometry": "Polygon",
+    "properties": OrderedDict([("CELL_ID", "int"), ("Shape_Area_Ha", "float")])
+}
+
+def _zone_area(lat, a=WGS84_A, f=WGS84_F):
+    # Area (m2) of the full 360 degree zone between the equator and lat on
+    # the ellipsoid.
+    e2 = f * (2 - f)
+    e = math.sqrt(e2)
+    b = a * (1 - f)
+    s = np.sin(np.radians(lat))
+    return math.pi * b ** 2 * (s / (1 - e2 * s ** 2) + np.log((1 + e * s) / (1 - e * s)) / (2 * e))
+
+def geodesic_cell_area(lat_south, lat_north, width_degrees):
+    '''
+    Ellipsoidal area in m2 of lat/lon cells bounded by the given latitudes and
+    width_degrees of longitude. Accepts arrays.
+    '''
+    return (width_degrees / 360.0) * np.abs(_zone_area(lat_north) - _zone_area(lat_south))
+
+def fishnet_arrays(xmin, ymin, res, nrows, ncols, geographic=True, row_start=0, row_stop=None):
+    '''
+    Returns a dict of flat arrays (CELL_ID, xmin, ymin, xmax, ymax,
+    Shape_Area_Ha) for rows [row_start, row_stop) of the grid.
+    '''
+    row_stop = nrows if row_stop is None else min(row_stop, nrows)
+    rows = np.arange(row_start, row_stop, dtype=np.int64)
+    cols = np.arange(ncols, dtype=np.int64)
+
+    x0 = xmin + cols * res
+    y0 = ymin + rows * res
+    if geographic:
+        # Cell area only varies with latitude, so compute it once per row.
+        row_area = geodesic_cell_area(y0, y0 + res, res) / 10000.0
+    else:
+        row_area = np.full(len(rows), res * res / 10000.0)
+
+    return {
+        "CELL_ID": (rows[:, None] * ncols + cols[None, :] + 1).ravel(),
+        "xmin": np.broadcast_to(x0[None, :], (len(rows), ncols)).ravel(),
+        "ymin": np.repeat(y0, ncols),
+        "xmax": np.broadcast_to(x0[None, :] + res, (len(rows), ncols)).ravel(),
+        "ymax": np.repeat(y0 + res, ncols),
+        "Shape_Area_Ha": np.repeat(row_area, ncols)
+    }
+
+def fishnet_features(arrays):
+    # Builds fiona records directly from the bound arrays; rings are closed
+    # counter-clockwise boxes.
+    for cell_id, x0, y0, x1, y1, area in zip(arrays["CELL_ID"].tolist(), arrays["xmin"].tolist(),
+            arrays["ymin"].tolist(), arrays["xmax"].tolist(), arrays["ymax"].tolist(),
+            arrays["Shape_Area_Ha"].tolist()):
+        yield {
+            "geometry": {"type": "Polygon", "coordinates": [[(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]]},
+            "properties": {"CELL_ID": cell_id, "Shape_Area_Ha": area}
+        }
+
+def write_fishnet(path, xmin, ymin, res, nrows, ncols, crs, layer=None, geographic=True, band_rows=256):
+    '''
+    Writes the full fishnet to path in one pass, generating band_rows rows of
+    cells at a time to bound memory. Returns the number of cells written.
+    '''
+    def features():
+        for row_start in range(0, nrows, band_rows):
+            arrays = fishnet_arrays(xmin, ymin, res, nrows, ncols, geographic, row_start, row_start + band_rows)
+            for f in fishnet_features(arrays):
+                yield f
+    return write_features(path, GRID_SCHEMA, crs, features(), layer=layer)
+
+
+class RegularGrid(object):
+    def __init__(self, xmin, ymin, resolution, nrows, ncols, crs=None, geographic=True):
+        self._xmin = float(xmin)
+        self._ymin = float(ymin)
+        self._res = float(resolution)
+        self._nrows = int(nrows)
+        self._ncols = int(ncols)
+        self._crs = crs
+        self._geographic = geographic
+
+    @classmethod
+    def fromBounds(cls, bounds, resolution, crs=None, geographic=True):
+        # Snaps the bounds outwards to multiples of the resolution, the same
+        # way Fishnet.roundCorner does.
+        xmin = math.floor(float(bounds[0]) / resolution) * resolution
+        ymin = math.floor(float(bounds[1]) / resolution) * resolution
+        xmax = math.ceil(float(bounds[2]) / resolution) * resolution
+        ymax = math.ceil(float(bounds[3]) / resolution) * resolution
+        nrows = int(round((ymax - ymin) / resolution))
+        ncols = int(round((xmax - xmin) / resolution))
+        return cls(xmin, ymin, resolution, nrows, ncols, crs, geographic)
+
+    def __str__(self):
+        return "RegularGrid({}x{} cells of {} from ({},{}))".format(
+            self._ncols, self._nrows, self._res, self._xmin, self._ymin)
+
+    def getResolution(self):
+        return self._res
+
+    def getShape(self):
+        return self._nrows, self._ncols
+
+    def getCellCount(self):
+        return self._nrows * self._ncols
+
+    def getCrs(self):
+        return self._crs
+
+    def isGeographic(self):
+        return self._geographic
+
+    def getBounds(self):
+        return (self._xmin, self._ymin,
+                self._xmin + self._ncols * self._res,
+                self._ymin + self._nrows * self._res)
+
+    def getTransform(self):
+        # GDAL-style geotransform of the grid as a north-up raster
+        return (self._xmin, self._res, 0.0, self.getBounds()[3], 0.0, -self._res)
+
+    def cellIds(self, x, y):
+        '''
+        Cell id containing each (x, y); 0 where the point is off the grid.
+        Points on a shared edge belong to the cell above/right of it.
+        '''
+        col = np.floor((np.asarray(x, dtype=np.float64) - self._xmin) / self._res).astype(np.int64)
+        row = np.floor((np.asarray(y, dtype=np.float64) - self._ymin) / self._res).astype(np.int64)
+        inside = (col >= 0) & (col < self._ncols) & (row >= 0) & (row < self._nrows)
+        return np.where(inside, row * self._ncols + col + 1, 0)
+
+    def rowCol(self, cell_ids):
+        idx = np.asarray(cell_ids, dtype=np.int64) - 1
+        return idx // self._ncols, idx % self._ncols
+
+    def cellCenters(self, cell_ids):
+        row, col = self.rowCol(cell_ids)
+        return self._xmin + (col + 0.5) * self._res, self._ymin + (row + 0.5) * self._res
+
+    def cellBounds(self, cell_ids):
+        row, col = self.rowCol(cell_ids)
+        x0 = self._xmin + col * self._res
+        y0 = self._ymin + row * self._res
+        return x0, y0, x0 + self._res, y0 + self._res
+
+    def cellAreaHa(self, cell_ids):
+        row, _ = self.rowCol(cell_ids)
+        if not self._geographic:
+            return np.full(row.shape, self._res * self._res / 10000.0)
+        y0 = self._ymin + row * self._res
+        return geodesic_cell_area(y0, y0 + self._res, self._res) / 10000.0
+
+    def cellWindow(self, bounds):
+        # (row_start, row_stop, col_start, col_stop) of the cells touched by a
+        # bounding box, clipped to the grid
+        col0 = max(int(math.floor((bounds[0] - self._xmin) / self._res)), 0)
+        row0 = max(int(math.floor((bounds[1] - self._ymin) / self._res)), 0)
+        col1 = min(int(math.floor((bounds[2] - self._xmin) / self._res)) + 1, self._ncols)
+        row1 = min(int(math.floor((bounds[3] - self._ymin) / self._res)) + 1, self._nrows)
+        return row0, max(row1, row0), col0, max(col1, col0)
+
+    def cellIdsInBounds(self, bounds):
+        row0, row1, col0, col1 = self.cellWindow(bounds)
+        rows = np.arange(row0, row1, dtype=np.int64)
+        cols = np.arange(col0, col1, dtype=np.int64)
+        return (rows[:, None] * self._ncols + cols[None, :] + 1).ravel()
+
+    def cellPolygon(self, cell_id):
+        # Geometry is only built here, when a consumer actually needs it
+        from shapely.geometry import box
+        x0, y0, x1, y1 = self.cellBounds(cell_id)
+        return box(float(x0), float(y0), float(x1), float(y1))
+
+    def footprintMask(self, shapes, all_touched=True):
+        '''
+        Rasterizes GeoJSON-like shapes once onto the grid lattice and returns a
+        boolean (nrows, ncols) mask in cell id order (row 0 at the bottom).
+        With all_touched every cell touched by a shape is selected, which
+        matches an INTERSECT selection of the fishnet.
+        '''
+        from rasterio.features import rasterize
+        from rasterio.transform import Affine
+        xmin, ymin, xmax, ymax = self.getBounds()
+        burned = rasterize(((s, 1) for s in shapes), out_shape=(self._nrows, self._ncols),
+            transform=Affine(self._res, 0.0, xmin, 0.0, -self._res, ymax),
+            fill=0, all_touched=all_touched, dtype="uint8")
+        # Raster rows run top-down, cell id rows bottom-up
+        return burned[::-1].astype(bool)
+
+    def footprintCellIds(self, shapes, all_touched=True):
+        return np.flatnonzero(self.footprintMask(shapes, all_touched).ravel()) + 1
+
+    def arrays(self, row_start=0, row_stop=None):
+        return fishnet_arrays(self._xmin, self._ymin, self._res, self._nrows, self._ncols,
+            self._geographic, row_start, row_stop)
+
+    def cellArrays(self, cell_ids):
+        cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        x0, y0, x1, y1 = self.cellBounds(cell_ids)
+        return {"CELL_ID": cell_ids, "xmin": x0, "ymin": y0, "xmax": x1, "ymax": y1,
+                "Shape_Area_Ha": self.cellAreaHa(cell_ids)}
+
+    def materialize(self, path, layer=None, cell_ids=None, band_rows=256):
+        '''
+        Writes cell polygons to path, either the whole grid or only the given
+        cell ids, for consumers that need an actual polygon feature class.
+        '''
+        logging.info("Materializing {} to {}".format(self, os.path.join(path, layer) if layer else path))
+        if cell_ids is None:
+            return write_fishnet(path, self._xmin, self._ymin, self._res, self._nrows, self._ncols,
+                self._crs, layer, self._geographic, band_rows)
+
+        def features():
+            ids = np.unique(np.asarray(cell_ids, dtype=np.int64))
+            step = band_rows * max(self._ncols, 1)
+            for i in range(0, len(ids), step):
+                for f in fishnet_features(self.cellArrays(ids[i:i + step])):
+                    yield f
+        return write_features(path, GRID_SCHEMA, self._crs, features(), layer=layer)
@@ -0,0 +1,398 @@
+'''
+Open-source overlay of polygon layers with a RegularGrid. Grid cells are never
+stored as polygons: the area of each polygon inside the cells it covers comes
+from the rectangle clipping kernel in rectclip, and cell geometry is only
+created for the output.
+
+largest_overlap_tiled and intersect_tiled split the grid into tiles of cells
+and process each tile in a worker process against only the polygons read for
+that tile, so wall time scales with cores and memory with tile size.
+'''
+import time
+import logging
+import operator
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+from preprocess_tools.featureio import write_features
+from preprocess_tools.rectclip import polygon_cell_areas
+
+# Overlaps within this fraction of a cell are ties, so round-off in the
+# clipping does not decide which feature a fully covered cell joins to
+AREA_EPS = 1e-9
+
+def largest_by_group(groups, members, values, decimals=None):
+    '''
+    Vectorized argmax per group: for every distinct value in groups, the
+    member with the largest value. Values are compared after rounding to
+    decimals when given, and ties keep the first occurrence, like the cursor
+    loops this replaces. Returns (groups, members, values) sorted by group.
+    '''
+    groups = np.asarray(groups)
+    members = np.asarray(members)
+    values = np.asarray(values, dtype=np.float64)
+    if not len(groups):
+        return groups, members, values
+    key = values if decimals is None else np.round(values, decimals)
+    # lexsort is stable, so equal values stay in input order
+    order = np.lexsort((-key, groups))
+    sorted_groups = groups[order]
+    first = order[np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])]
+    return groups[first], members[first], values[first]
+
+def largest_overlap(grid, geometries):
+    '''
+    For every grid cell touched by geometries, finds the index of the geometry
+    with the largest overlap area. Returns (cell_ids, join_index, area) arrays
+    sorted by cell id. Ties keep the first geometry, as the arcpy join does.
+    '''
+    cells = []
+    index = []
+    areas = []
+    for i, geom in enumerate(geometries):
+        cell_ids, area = polygon_cell_areas(grid, geom)
+        cells.append(cell_ids)
+        index.append(np.full(len(cell_ids), i, dtype=np.int64))
+        areas.append(area)
+    if not cells:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float64)
+
+    # Compare in cell units so that AREA_EPS decides the ties
+    cell_area = grid.getResolution() ** 2
+    cell_ids, join_index, area = largest_by_group(np.concatenate(cells), np.concatenate(index),
+        np.concatenate(areas) / cell_area, -int(np.log10(AREA_EPS)))
+    return cell_ids, join_index, area * cell_area
+
+def tile_windows(grid, tile_size):
+    # (row_start, row_stop, col_start, col_stop) of square tiles of cells
+    nrows, ncols = grid.getShape()
+    return [(r, min(r + tile_size, nrows), c, min(c + tile_size, ncols))
+            for r in range(0, nrows, tile_size)
+            for c in range(0, ncols, tile_size)]
+
+def _map_tiles(worker, tasks, processes):
+    # Runs worker over the tile tasks, in a process pool unless processes is 1
+    if processes == 1:
+        return [worker(t) for t in tasks]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return list(pool.imap_unordered(worker, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+def _overlap_tile(args):
+    # Worker: largest overlap for the cells of one tile. Returns
+    # (cell_ids, join_fids, areas) for cells with any overlap.
+    import fiona
+    from shapely.geometry import shape, box
+    grid, path, layer, positive_field, window = args
+    row0, row1, col0, col1 = window
+    empty = (np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float64))
+
+    nrows, ncols = grid.getShape()
+    res = grid.getResolution()
+    xmin, ymin = grid.getBounds()[:2]
+    tile = box(xmin + col0 * res, ymin + row0 * res, xmin + col1 * res, ymin + row1 * res)
+    fids = []
+    geoms = []
+    with fiona.open(path, layer=layer) as src:
+        for f in src.filter(bbox=tile.bounds):
+            if f["geometry"] is None:
+                continue
+            if positive_field is not None:
+                value = f["properties"][positive_field]
+                if value is None or value <= 0:
+                    continue
+            geom = shape(f["geometry"])
+            if not geom.is_valid:
+                geom = geom.buffer(0)
+            fids.append(int(f["id"]))
+            geoms.append(geom)
+    if not geoms:
+        return empty
+
+    # Polygons are swept in fid order and a cell only changes hands on a
+    # strictly larger area, so ties keep the first feature
+    eps = AREA_EPS * res * res
+    nc = col1 - col0
+    best_area = np.zeros((row1 - row0) * nc)
+    best_fid = np.full(len(best_area), -1, dtype=np.int64)
+    for i in np.argsort(fids, kind="mergesort").tolist():
+        cell_ids, areas = polygon_cell_areas(grid, geoms[i], window)
+        if not len(cell_ids):
+            continue
+        row, col = grid.rowCol(cell_ids)
+        idx = (row - row0) * nc + (col - col0)
+        better = areas > best_area[idx] + eps
+        best_area[idx[better]] = areas[better]
+        best_fid[idx[better]] = fids[i]
+
+    hit = np.flatnonzero(best_fid >= 0)
+    cell_ids = (row0 + hit // nc) * ncols + (col0 + hit % nc) + 1
+    return cell_ids.astype(np.int64), best_fid[hit], best_area[hit]
+
+def largest_overlap_tiled(grid, path, layer=None, positive_field=None, tile_size=256, processes=None):
+    '''
+    Tile-partitioned, parallel largest overlap join of a polygon layer onto
+    the grid. Only features with positive_field > 0 are used when it is given.
+    Returns (cell_ids, join_fids, area) arrays sorted by cell id, where
+    join_fids are the source feature ids.
+    '''
+    windows = tile_windows(grid, tile_size)
+    processes = processes or max(multiprocessing.cpu_count() - 1, 1)
+    logging.info("Joining {} onto {} in {} tiles with {} processes".format(
+        layer or path, grid, len(windows), processes))
+    start = time.time()
+    results = _map_tiles(_overlap_tile, [(grid, path, layer, positive_field, w) for w in windows], processes)
+
+    # Tiles are disjoint, so merging is a concatenation
+    cell_ids = np.concatenate([r[0] for r in results])
+    join_fids = np.concatenate([r[1] for r in results])
+    area = np.concatenate([r[2] for r in results])
+    order = np.argsort(cell_ids, kind="mergesort")
+    logging.info("Joined {} cells in {:.1f}s".format(len(cell_ids), time.time() - start))
+    return cell_ids[order], join_fids[order], area[order]
+
+def _passes(properties, filters):
+    # filters is a list of (field, operator name, value), e.g. ("age", "lt", 20);
+    # null values never pass
+    for field, op, value in filters or ():
+        v = properties.get(field)
+        if v is None or not getattr(operator, op)(v, value):
+            return False
+    return True
+
+def _polygonal(geom):
+    # Polygon parts of an overlay result as a repaired MultiPolygon, or None
+    # when nothing with area is left (RepairGeometry with DELETE_NULL)
+    from shapely.geometry import MultiPolygon
+    polygons = []
+    for part in getattr(geom, "geoms", [geom]):
+        if part.geom_type == "Polygon":
+            polygons.append(part)
+        elif part.geom_type == "MultiPolygon":
+            polygons.extend(part.geoms)
+    polygons = [p for p in polygons if not p.is_empty]
+    if not polygons:
+        return None
+    geom = MultiPolygon(polygons)
+    if not geom.is_valid:
+        geom = geom.buffer(0)
+        if geom.geom_type == "Polygon":
+            geom = MultiPolygon([geom])
+    return geom if not geom.is_empty and geom.area > 0 else None
+
+def _read_tile(path, layer, bounds, filters):
+    import fiona
+    from shapely.geometry import shape
+    fids = []
+    geoms = []
+    props = []
+    with fiona.open(path, layer=layer) as src:
+        for f in src.filter(bbox=bounds):
+            if f["geometry"] is None or not _passes(f["properties"], filters):
+                continue
+            geom = shape(f["geometry"])
+            if not geom.is_valid:
+                geom = geom.buffer(0)
+            fids.append(int(f["id"]))
+            geoms.append(geom)
+            props.append(f["properties"])
+    return fids, geoms, props
+
+def _intersect_tile(args):
+    # Worker: union of the inventory features whose CELL_ID lies in one tile
+    # with the overlay features. Only pieces inside the inventory are made,
+    # so non-concurring overlay pieces never leave the worker. Returns
+    # (inventory fids, overlay fids or -1, geometries).
+    from shapely.geometry import box
+    from shapely.ops import unary_union
+    grid, path, layer, overlay_path, overlay_layer, filters, overlay_filters, window = args
+    row0, row1, col0, col1 = window
+    empty = (np.empty(0, np.int64), np.empty(0, np.int64), [])
+
+    res = grid.getResolution()
+    xmin, ymin = grid.getBounds()[:2]
+    tile = box(xmin + col0 * res, ymin + row0 * res, xmin + col1 * res, ymin + row1 * res)
+    fids, geoms, props = _read_tile(path, layer, tile.bounds, filters)
+    # Features belong to the tile holding their cell, so none is processed twice
+    cell_ids = np.array([p.get("CELL_ID") or 0 for p in props], dtype=np.int64)
+    keep = np.zeros(len(fids), dtype=bool)
+    concurring = np.flatnonzero(cell_ids > 0)
+    if len(concurring):
+        row, col = grid.rowCol(cell_ids[concurring])
+        keep[concurring] = (row >= row0) & (row < row1) & (col >= col0) & (col < col1)
+    keep = np.flatnonzero(keep)
+    if not len(keep):
+        return empty
+
+    extents = np.array([geoms[i].bounds for i in keep.tolist()], dtype=np.float64)
+    bounds = (extents[:, 0].min(), extents[:, 1].min(), extents[:, 2].max(), extents[:, 3].max())
+    overlay_fids, overlay_geoms, _ = _read_tile(overlay_path, overlay_layer, bounds, overlay_filters)
+    overlay_extents = np.array([g.bounds for g in overlay_geoms], dtype=np.float64).reshape(-1, 4)
+    overlay_order = np.argsort(overlay_fids, kind="mergesort")
+
+    out_fids = []
+    out_overlay_fids = []
+    out_geoms = []
+    for i in keep.tolist():
+        geom = geoms[i]
+        x0, y0, x1, y1 = geom.bounds
+        hits = overlay_order[(overlay_extents[overlay_order, 0] <= x1) & (overlay_extents[overlay_order, 2] >= x0) &
+                             (overlay_extents[overlay_order, 1] <= y1) & (overlay_extents[overlay_order, 3] >= y0)]
+        covering = []
+        for j in hits.tolist():
+            if not geom.intersects(overlay_geoms[j]):
+                continue
+            covering.append(overlay_geoms[j])
+            piece = _polygonal(geom.intersection(overlay_geoms[j]))
+            if piece is not None:
+                out_fids.append(fids[i])
+                out_overlay_fids.append(overlay_fids[j])
+                out_geoms.append(piece)
+        rest = _polygonal(geom.difference(unary_union(covering)) if covering else geom)
+        if rest is not None:
+            out_fids.append(fids[i])
+            out_overlay_fids.append(-1)
+            out_geoms.append(rest)
+    return np.array(out_fids, dtype=np.int64), np.array(out_overlay_fids, dtype=np.int64), out_geoms
+
+def intersect_tiled(grid, path, layer, overlay_path, overlay_layer, out_path, out_layer, filters=None,
+                    overlay_filters=None, tile_size=256, processes=None):
+    '''
+    Tile-partitioned, parallel equivalent of a Union of a gridded layer (with
+    CELL_ID) and an overlay layer followed by selecting CELL_ID > 0: every
+    feature with a cell is split into its pieces under each overlay feature
+    and the piece under none. filters and overlay_filters select the input
+    features (see _passes). Output records carry FID_<layer>, the layer
+    attributes, FID_<overlay_layer> (-1 for no overlay) and the overlay
+    attributes, with clashing names suffixed _1 as Union does. They are
+    written in (fid, overlay fid) order, so the output is the same whatever
+    the tiling and process count. Returns the number of features written.
+    '''
+    from shapely.geometry import mapping
+    from preprocess_tools.featureio import read_layer
+    windows = tile_windows(grid, tile_size)
+    processes = processes or max(multiprocessing.cpu_count() - 1, 1)
+    logging.info("Intersecting {} with {} in {} tiles with {} processes".format(
+        layer, overlay_layer, len(windows), processes))
+    start = time.time()
+    results = _map_tiles(_intersect_tile, [(grid, path, layer, overlay_path, overlay_layer, filters,
+        overlay_filters, w) for w in windows], processes)
+
+    fids = np.concatenate([np.empty(0, np.int64)] + [r[0] for r in results])
+    overlay_fids = np.concatenate([np.empty(0, np.int64)] + [r[1] for r in results])
+    geoms = [g for r in results for g in r[2]]
+    order = np.lexsort((overlay_fids, fids))
+    logging.info("Made {} pieces in {:.1f}s".format(len(fids), time.time() - start))
+
+    # Attributes are joined back by fid, the geometry is not read again
+    source = read_layer(path, layer, where=lambda p: _passes(p, filters), geometry=False)
+    overlay = read_layer(overlay_path, overlay_layer, where=lambda p: _passes(p, overlay_filters), geometry=False)
+
+    def columns(layer_source):
+        return [c for c in layer_source["schema"]["properties"]
+                if c.lower() not in ("shape_area", "shape_length")]
+    source_columns = columns(source)
+    overlay_columns = columns(overlay)
+    fid_field = "FID_{}".format(layer)
+    overlay_fid_field = "FID_{}".format(overlay_layer)
+    names = set([fid_field, overlay_fid_field] + source_columns)
+    renamed = [(c, c if c not in names else "{}_1".format(c)) for c in overlay_columns]
+    schema = {
+        "geometry": "MultiPolygon",
+        "properties": OrderedDict([(fid_field, "int")] +
+            [(c, source["schema"]["properties"][c]) for c in source_columns] +
+            [(overlay_fid_field, "int")] +
+            [(name, overlay["schema"]["properties"][c]) for c, name in renamed])
+    }
+    source_order = np.argsort(source["fid"])
+    source_index = source_order[np.searchsorted(source["fid"], fids, sorter=source_order)]
+    overlay_order = np.argsort(overlay["fid"])
+    overlay_index = np.full(len(overlay_fids), -1, dtype=np.int64)
+    covered = overlay_fids >= 0
+    overlay_index[covered] = overlay_order[np.searchsorted(overlay["fid"], overlay_fids[covered],
+        sorter=overlay_order)]
+
+    def features():
+        for k in order.tolist():
+            i = int(source_index[k])
+            j = int(overlay_index[k])
+            p = OrderedDict([(fid_field, int(fids[k]))])
+            p.update((c, source["properties"][c][i]) for c in source_columns)
+            p[overlay_fid_field] = int(overlay_fids[k])
+            p.update((name, overlay["properties"][c][j] if j >= 0 else None) for c, name in renamed)
+            yield {"geometry": mapping(geoms[k]), "properties": p}
+
+    return write_features(out_path, schema, grid.getCrs() or source["crs"], features(), layer=out_layer)
+
+def centroid_join(grid, geometries, tile_size=1024):
+    '''
+    Cell center join: for every cell whose center falls inside one of the
+    geometries, the index of that geometry (the first one where geometries
+    overlap). Geometry indexes are rasterized at the cell centers one tile at
+    a time. Returns (cell_ids, join_index) arrays sorted by cell id.
+    '''
+    from rasterio.features import rasterize
+    from rasterio.transform import Affine
+    nrows, ncols = grid.getShape()
+    res = grid.getResolution()
+    xmin, ymin = grid.getBounds()[:2]
+    bounds = np.array([g.bounds for g in geometries], dtype=np.float64).reshape(-1, 4)
+
+    cell_ids = [np.empty(0, np.int64)]
+    join_index = [np.empty(0, np.int64)]
+    for row0, row1, col0, col1 in tile_windows(grid, tile_size):
+        x0, y0 = xmin + col0 * res, ymin + row0 * res
+        x1, y1 = xmin + col1 * res, ymin + row1 * res
+        hits = np.flatnonzero((bounds[:, 0] < x1) & (bounds[:, 2] > x0) &
+                              (bounds[:, 1] < y1) & (bounds[:, 3] > y0))
+        if not len(hits):
+            continue
+        # The last shape burned wins, so burn in reverse to keep the first
+        burned = rasterize(((geometries[i], i + 1) for i in hits[::-1].tolist()),
+            out_shape=(row1 - row0, col1 - col0), transform=Affine(res, 0.0, x0, 0.0, -res, y1),
+            fill=0, all_touched=False, dtype="int32")[::-1]
+        row, col = np.nonzero(burned)
+        cell_ids.append((row0 + row) * ncols + col0 + col + 1)
+        join_index.append(burned[row, col].astype(np.int64) - 1)
+
+    cell_ids = np.concatenate(cell_ids)
+    join_index = np.concatenate(join_index)
+    order = np.argsort(cell_ids, kind="mergesort")
+    return cell_ids[order], join_index[order]
+
+def write_gridded(path, layer, grid, cell_ids, join_index, source, batch_size=100000):
+    '''
+    Writes one cell polygon per cell id carrying CELL_ID, Shape_Area_Ha,
+    JOIN_FID and the attributes of the joined source feature (as read by
+    featureio.read_layer).
+    '''
+    props = source["properties"]
+    columns = [c for c in source["schema"]["properties"]
+        if c in props and c not in ("CELL_ID", "Shape_Area_Ha", "JOIN_FID")]
+    schema = {
+        "geometry": "Polygon",
+        "properties": OrderedDict([("CELL_ID", "int"), ("Shape_Area_Ha", "float"), ("JOIN_FID", "int")] +
+            [(c, source["schema"]["properties"][c]) for c in columns])
+    }
+
+    def features():
+        for start in range(0, len(cell_ids), batch_size):
+            ids = cell_ids[start:start + batch_size]
+            joins = join_index[start:start + batch_size]
+            x0, y0, x1, y1 = [a.tolist() for a in grid.cellBounds(ids)]
+            area = grid.cellAreaHa(ids).tolist()
+            fids = source["fid"][joins].tolist()
+            for i, j in enumerate(joins.tolist()):
+                p = dict((c, props[c][j]) for c in columns)
+                p.update({"CELL_ID": int(ids[i]), "Shape_Area_Ha": area[i], "JOIN_FID": fids[i]})
+                yield {
+                    "geometry": {"type": "Polygon", "coordinates": [[(x0[i], y0[i]), (x1[i], y0[i]),
+                        (x1[i], y1[i]), (x0[i], y1[i]), (x0[i], y0[i])]]},
+                    "properties": p
+                }
+
+    logging.info("Writing {} gridded features to {}".format(len(cell_ids), layer or path))
+    return write_features(path, schema, grid.getCrs() or source["crs"], features(), layer=layer)
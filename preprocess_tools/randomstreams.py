@@ -0,0 +1,97 @@
+'''
+Counter-based random streams shared by the stochastic preprocessing steps.
+
+A draw is a pure function of (seed, stage, year, key), where key is a cell or
+feature id, computed by hashing with the SplitMix64 finalizer instead of by
+advancing a sequential generator. The same records therefore get the same
+draws however the work is split into chunks, tiles or worker processes, and
+in whatever order they are visited.
+'''
+import os
+import zlib
+import struct
+import numpy as np
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+# Seed of the steps that are reproducible run to run unless given another
+DEFAULT_SEED = 0
+
+def _mix(z):
+    # SplitMix64 finalizer on uint64 arrays; multiplication wraps mod 2**64
+    with np.errstate(over="ignore"):
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+def _as_uint64(values):
+    # Negative ids and years wrap around instead of failing the cast
+    return np.asarray(values, dtype=np.int64).astype(np.uint64)
+
+class RandomStreams(object):
+    def __init__(self, seed=None):
+        # Without a seed one is drawn from the OS, so runs differ as they
+        # did with the sequential generators
+        if seed is None:
+            seed = struct.unpack("<Q", os.urandom(8))[0]
+        self._seed = int(seed) & MASK64
+
+    def __str__(self):
+        return "RandomStreams(seed={})".format(self._seed)
+
+    def getSeed(self):
+        return self._seed
+
+    def hash(self, stage, year, keys):
+        '''
+        uint64 hash of every key for the stage (a name) and year; year may be
+        a scalar or an array matching keys.
+        '''
+        stage_id = zlib.crc32(stage.encode("utf-8") if not isinstance(stage, bytes) else stage) & 0xFFFFFFFF
+        z = _mix(np.array([self._seed], dtype=np.uint64))
+        z = _mix(z ^ np.uint64(stage_id))
+        z = _mix(z ^ _as_uint64(0 if year is None else year))
+        return _mix(z ^ _as_uint64(keys))
+
+    def uniform(self, stage, year, keys):
+        # Floats in [0, 1) from the top 53 bits of the hash
+        return (self.hash(stage, year, keys) >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+    def bernoulli(self, stage, year, keys, p):
+        return self.uniform(stage, year, keys) < p
+
+    def choice(self, stage, year, keys, p):
+        # Index into p (probabilities summing to one) for every key
+        cumulative = np.cumsum(p)
+        picks = np.searchsorted(cumulative / cumulative[-1], self.uniform(stage, year, keys), side="right")
+        return np.minimum(picks, len(p) - 1)
+
+    def sample(self, stage, year, keys, k):
+        '''
+        k of the keys without replacement: the keys with the k smallest
+        draws, ties broken by key, returned in key order. The result does not
+        depend on the order the keys are given in.
+        '''
+        keys = np.asarray(keys)
+        k = max(min(int(k), len(keys)), 0)
+        order = np.lexsort((keys, self.uniform(stage, year, keys)))
+        return np.sort(keys[order[:k]])
+
+    def sampleGroups(self, stage, groups, keys, k):
+        '''
+        Sampling without replacement for every group (e.g. year) in one pass:
+        the k[group] keys of each group with the smallest draws, the same
+        keys sample(stage, group, ...) picks. k maps group -> count. Returns
+        the selected keys sorted by group, then key.
+        '''
+        groups = np.asarray(groups)
+        keys = np.asarray(keys)
+        if not len(keys):
+            return keys
+        order = np.lexsort((keys, self.uniform(stage, groups, keys), groups))
+        sorted_groups = groups[order]
+        starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        sizes = np.diff(np.r_[starts, len(order)])
+        rank = np.arange(len(order)) - np.repeat(starts, sizes)
+        limit = np.repeat([k.get(g, 0) for g in sorted_groups[starts].tolist()], sizes)
+        chosen = order[rank < limit]
+        return keys[chosen[np.lexsort((keys[chosen], groups[chosen]))]]
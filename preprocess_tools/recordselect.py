@@ -0,0 +1,66 @@
+'''
+Record selection by object id for arcpy tables that leaves the input tables
+as they are. Records are copied out first and the selection is applied to
+the copy, which the caller owns, so a failed run cannot leave helper fields
+behind in its inputs and existing fields are never dropped.
+'''
+import os
+import numpy as np
+
+def unique_field_name(arcpy, table, name):
+    # name, or name_<n> if table already has a field of that name
+    existing = set(f.name.upper() for f in arcpy.ListFields(table))
+    candidate = name
+    n = 1
+    while candidate.upper() in existing:
+        candidate = "{}_{}".format(name, n)
+        n += 1
+    return candidate
+
+def copy_with_oids(arcpy, in_features, out_features, where_clause="", fields=None, oid_field="ORIG_FID"):
+    '''
+    Copies the records of in_features matching where_clause to out_features
+    with their object ids in a new field, which is returned. fields limits
+    the copied attributes (all of them by default).
+    '''
+    oid_field = unique_field_name(arcpy, in_features, oid_field)
+    fieldmappings = arcpy.FieldMappings()
+    if fields is None:
+        fieldmappings.addTable(in_features)
+    else:
+        for field in fields:
+            fieldmap = arcpy.FieldMap()
+            fieldmap.addInputField(in_features, field)
+            fieldmappings.addFieldMap(fieldmap)
+    fieldmap = arcpy.FieldMap()
+    fieldmap.addInputField(in_features, arcpy.Describe(in_features).OIDFieldName)
+    fld = fieldmap.outputField
+    fld.type, fld.name, fld.aliasName = "LONG", oid_field, oid_field
+    fieldmap.outputField = fld
+    fieldmappings.addFieldMap(fieldmap)
+    # A bare name is created in the current workspace, as with CopyFeatures
+    arcpy.conversion.FeatureClassToFeatureClass(in_features, os.path.dirname(out_features) or arcpy.env.workspace,
+        os.path.basename(out_features), where_clause, fieldmappings)
+    return oid_field
+
+def delete_records(arcpy, table, oids, flag_field="DELETE_FLAG"):
+    '''
+    Deletes the records of table whose object ids are in oids. table must be
+    a copy owned by the caller: the ids are flagged in a temporary field of
+    it. Returns the number of records deleted.
+    '''
+    oids = np.unique(np.asarray(oids, dtype=np.int32))
+    if not len(oids):
+        return 0
+    oid = arcpy.Describe(table).OIDFieldName
+    flag_field = unique_field_name(arcpy, table, flag_field)
+    flags = np.empty(len(oids), dtype=[(oid, np.int32), (flag_field, np.int16)])
+    flags[oid] = oids
+    flags[flag_field] = 1
+    arcpy.da.ExtendTable(table, oid, flags, oid)
+    arcpy.MakeFeatureLayer_management(table, "flagged_records",
+        "{} = 1".format(arcpy.AddFieldDelimiters(table, flag_field)))
+    arcpy.DeleteFeatures_management("flagged_records")
+    arcpy.Delete_management("flagged_records")
+    arcpy.DeleteField_management(table, flag_field)
+    return len(oids)
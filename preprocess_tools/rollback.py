@@ -0,0 +1,112 @@
+'''
+Rollback age drawing and attribute calculation shared by the cursor based
+rollback (02_rollback/update_inventory.py) and the raster rollback
+(02_rollback/raster_rollback.py).
+'''
+import csv
+import sys
+import logging
+import numpy as np
+from preprocess_tools.randomstreams import RandomStreams, DEFAULT_SEED
+
+def load_age_distributors(path=None, seed=DEFAULT_SEED):
+    # One RollbackDistributor per disturbance type from DistAgeProp.csv,
+    # all drawing from the random streams of seed (None for a new seed
+    # every run)
+    path = path or "{}\\02_rollback\\DistAgeProp.csv".format(sys.path[0])
+    logging.info('Calculating pre disturbance age using {} to select age'.format(path))
+    dist_age_props = {}
+    with open(path, "r") as age_prop_file:
+        reader = csv.reader(age_prop_file)
+        reader.next() # skip header
+        for dist_type, age, prop in reader:
+            dist_type = int(dist_type)
+            dist_ages = dist_age_props.get(dist_type)
+            if not dist_ages:
+                dist_age_props[dist_type] = {}
+                dist_ages = dist_age_props[dist_type]
+            dist_ages[age] = float(prop)
+
+    streams = RandomStreams(seed)
+    logging.info("Drawing pre disturbance ages with {}".format(streams))
+    age_distributors = {}
+    for dist_type, age_props in dist_age_props.iteritems():
+        age_distributors[dist_type] = RollbackDistributor(streams, **age_props)
+    return age_distributors
+
+def rollback_attributes(age, dist_year, harv_year, inv_vintage, rollback_start, age_distributors, keys=None):
+    '''
+    Column form of the CalculateDistDEdifference and CalculateNewDistYr
+    cursor passes over the disturbed inventory. Takes equal length arrays
+    (nulls in dist_year and harv_year replaced by the same value) and returns
+    a dict of arrays: establishment_date, dist_date_diff, dist_type,
+    regen_delay, new_disturbance_yr, pre_dist_age and rollback_age. The last
+    two are only set where has_pre_dist_age is True, i.e. there is an age
+    distributor for the disturbance type. keys are the record ids the pre
+    disturbance ages are drawn for (default: the record positions).
+    '''
+    age = np.asarray(age)
+    dist_year = np.asarray(dist_year)
+    harv_year = np.asarray(harv_year)
+    keys = np.arange(len(age)) if keys is None else np.asarray(keys)
+
+    establishment_date = inv_vintage - age
+    dist_date_diff = np.where(dist_year > 0, establishment_date - dist_year, 0)
+    dist_type = np.where(dist_year == harv_year, 2, 1)
+    # Disturbance can't occur after establishment year - set to year before establishment.
+    after_establishment = dist_date_diff > 0
+    regen_delay = np.where(after_establishment, dist_date_diff, 0)
+    new_disturbance_yr = np.where(after_establishment, dist_year, establishment_date)
+
+    pre_dist_age = np.zeros(len(age), dtype=np.int64)
+    has_pre_dist_age = np.zeros(len(age), dtype=bool)
+    for t in np.unique(dist_type).tolist():
+        age_distributor = age_distributors.get(t)
+        if not age_distributor:
+            logging.warning("No age distributor for layer disturbance type {} - skipping.".format(t))
+            continue
+        rows = np.flatnonzero(dist_type == t)
+        pre_dist_age[rows] = age_distributor.sample(keys[rows], new_disturbance_yr[rows])
+        has_pre_dist_age[rows] = True
+
+    return {
+        "establishment_date": establishment_date,
+        "dist_date_diff": dist_date_diff,
+        "dist_type": dist_type,
+        "regen_delay": regen_delay,
+        "new_disturbance_yr": new_disturbance_yr,
+        "pre_dist_age": pre_dist_age,
+        "rollback_age": pre_dist_age + rollback_start - new_disturbance_yr,
+        "has_pre_dist_age": has_pre_dist_age
+    }
+
+
+
+class RollbackDistributor(object):
+    def __init__(self, streams=None, **age_proportions):
+        # Ages are drawn with their exact proportions (normalized to sum to
+        # one) from the "rollback_age" random stream of each record, so a
+        # record gets the same age however the records are processed.
+        logging.info("Initializing class {}".format(self.__class__.__name__))
+        self._streams = streams or RandomStreams(DEFAULT_SEED)
+        self._keys = sorted(age_proportions.keys(), key=int)
+        self._ages = np.array([int(age) for age in self._keys], dtype=np.int64)
+        proportions = np.array([float(age_proportions[age]) for age in self._keys])
+        self._p = proportions / proportions.sum()
+        self._counts = np.zeros(len(self._keys), dtype=np.int64)
+        self._next_key = 0
+
+    def __str__(self):
+        return str(dict(zip(self._keys, self._counts.tolist())))
+
+    def sample(self, keys, year=None):
+        # Draws the ages of all keys (record ids) in one call
+        picks = self._streams.choice("rollback_age", year, keys, self._p)
+        self._counts += np.bincount(picks, minlength=len(self._ages))
+        return self._ages[picks]
+
+    def next(self, key=None, year=None):
+        if key is None:
+            key = self._next_key
+            self._next_key += 1
+        return int(self.sample([key], year)[0])
@@ -0,0 +1,181 @@
+'''
+Transition rule registry for the Tiler that needs no manager process. It is
+a drop-in for mojadata's TransitionRuleManager: DisturbanceLayer calls
+get_or_add(regen_delay, age_after, classifier_values) and write_rules writes
+transition_rules.csv with the same columns.
+
+Rules are deduplicated on a hash of their content. Each process remembers
+the ids it has seen, so a rule only reaches the shared rule store, a file
+guarded by a file lock, the first time a process meets it. Under the lock
+the process reads only what was appended since its last visit, picking up
+every rule other processes registered in the meantime in one read, and
+appends the rules still missing with the next sequential ids.
+
+Ids follow the order rules are first registered in, which depends on the
+order the tiling processes meet them when there are several: DisturbanceLayer
+writes an id into the tiles as soon as it gets it, so ids cannot be derived
+from the full rule set afterwards.
+'''
+import os
+import csv
+import json
+import hashlib
+import logging
+import tempfile
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+def _plain(value):
+    # Python value of a numpy scalar, which json cannot serialize
+    return value.item() if hasattr(value, "item") else value
+
+def _classifier_items(classifier_values):
+    # (column, value) pairs of a rule's classifier values: a mapping of
+    # classifier name to value, (name, value) pairs, or a list of values
+    # taken by position
+    if not classifier_values:
+        return ()
+    if hasattr(classifier_values, "items"):
+        return tuple(sorted((str(c), _plain(v)) for c, v in classifier_values.items()))
+    values = list(classifier_values)
+    if all(isinstance(v, (tuple, list)) and len(v) == 2 for v in values):
+        return tuple(sorted((str(c), _plain(v)) for c, v in values))
+    return tuple((str(i), _plain(v)) for i, v in enumerate(values))
+
+class _FileLock(object):
+    # Exclusive lock on a file, held by the with block; released by the OS
+    # if the holding process dies
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.lock_file = open(self.path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    # LK_LOCK gives up after 10 seconds
+                    pass
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.lock_file.seek(0)
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.lock_file.close()
+
+class TransitionRuleRegistry(object):
+    def __init__(self, output_path="transition_rules.csv", store=None):
+        # Relative output paths resolve against the working directory of
+        # the process calling write_rules, like TransitionRuleManager's. The
+        # store must be reachable by every tiling process; by default a new
+        # temporary file, removed again by write_rules.
+        self.output_path = output_path
+        self._owned = store is None
+        if store is None:
+            handle, store = tempfile.mkstemp(prefix="transition_rules_", suffix=".jsonl")
+            os.close(handle)
+        else:
+            open(store, "wb").close()
+        self.store = os.path.abspath(store)
+        self.lock_path = "{}.lock".format(self.store)
+        # Rule ids known to this process by rule hash, the rule keys in id
+        # order, and how far into the store this process has read
+        self._ids = {}
+        self._keys = []
+        self._offset = 0
+
+    @staticmethod
+    def ruleKey(regen_delay, age_after, classifier_values):
+        return [_plain(regen_delay), _plain(age_after), [list(c) for c in _classifier_items(classifier_values)]]
+
+    @staticmethod
+    def ruleHash(key):
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _line(rule_id, key):
+        return json.dumps([rule_id, key]) + "\n"
+
+    def _readStore(self, store_file):
+        # Takes in the rules appended to the store since this process last
+        # read it. A store removed by write_rules is restored from the rules
+        # known here, which are all of them in the process that wrote them.
+        store_file.seek(0, os.SEEK_END)
+        if store_file.tell() < self._offset:
+            store_file.seek(0)
+            store_file.truncate()
+            store_file.write("".join(self._line(i + 1, key) for i, key in enumerate(self._keys)))
+            return
+        store_file.seek(self._offset)
+        for line in store_file.read().splitlines():
+            rule_id, key = json.loads(line)
+            self._ids[self.ruleHash(key)] = rule_id
+            self._keys.append(key)
+        self._offset = store_file.tell()
+
+    def get_or_add_many(self, rules):
+        '''
+        Ids of the (regen_delay, age_after, classifier_values) rules, adding
+        the new ones to the store together under a single lock.
+        '''
+        keys = [self.ruleKey(*rule) for rule in rules]
+        hashes = [self.ruleHash(key) for key in keys]
+        if any(h not in self._ids for h in hashes):
+            with _FileLock(self.lock_path):
+                with open(self.store, "a+b") as store_file:
+                    self._readStore(store_file)
+                    added = []
+                    for key, rule_hash in zip(keys, hashes):
+                        if rule_hash not in self._ids:
+                            self._keys.append(key)
+                            self._ids[rule_hash] = len(self._keys)
+                            added.append(self._line(len(self._keys), key))
+                    store_file.seek(0, os.SEEK_END)
+                    store_file.write("".join(added))
+                    self._offset = store_file.tell()
+        return [self._ids[h] for h in hashes]
+
+    def get_or_add(self, regen_delay, age_after, classifier_values):
+        return self.get_or_add_many([(regen_delay, age_after, classifier_values)])[0]
+
+    def getRules(self):
+        # All registered rules as (id, regen_delay, age_after, {column: value}),
+        # in id order
+        with _FileLock(self.lock_path):
+            with open(self.store, "a+b") as store_file:
+                self._readStore(store_file)
+        return [(i + 1, regen_delay, age_after, dict((c, v) for c, v in classifiers))
+                for i, (regen_delay, age_after, classifiers) in enumerate(self._keys)]
+
+    def write_rules(self):
+        rules = self.getRules()
+        classifiers = []
+        for _, _, _, values in rules:
+            classifiers.extend(sorted(c for c in values if c not in classifiers))
+        header = ["id", "regen_delay", "age_after"] + classifiers
+        with open(self.output_path, "wb") as out_file:
+            # Classifiers a rule does not set are left blank
+            writer = csv.DictWriter(out_file, header, restval="")
+            writer.writeheader()
+            for rule_id, regen_delay, age_after, values in rules:
+                row = {"id": rule_id, "regen_delay": regen_delay, "age_after": age_after}
+                row.update(values)
+                writer.writerow(row)
+        logging.info("Wrote {} transition rules to {}".format(len(rules), self.output_path))
+        if self._owned:
+            # Rules registered after this restore the store (see _readStore)
+            for path in (self.store, self.lock_path):
+                if os.path.exists(path):
+                    os.remove(path)
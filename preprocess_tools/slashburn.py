@@ -0,0 +1,49 @@
+'''
+Slashburn selection shared by the rollback and the historic harvest steps.
+Harvest records of every year are read in one table scan, the percent subset
+of each year is drawn in one vectorized pass, and the candidates are copied
+out once with the records not picked deleted from the copy, instead of a
+select / count / copy / append round trip per year. The input is only read.
+'''
+import time
+import logging
+import numpy as np
+from preprocess_tools.recordselect import copy_with_oids, delete_records
+
+SLASHBURN_DIST_TYPE = 13
+
+def slashburn_counts(years, percent):
+    # Records to pick in each year: percent of the year's records, rounded
+    # to the nearest record
+    unique, counts = np.unique(years, return_counts=True)
+    return dict((year, int(np.ceil(round(float(count * percent) / 100))))
+                for year, count in zip(unique.tolist(), counts.tolist()))
+
+def generate_slashburn(arcpy, streams, stage, in_features, year_field, where_clause, year_range, percent,
+                       out_features):
+    '''
+    Copies percent of the in_features records matching where_clause in each
+    year of year_range to out_features, with DistType set to slashburn. The
+    picks are drawn from streams under stage, keyed on the object id and
+    year. Returns the number of records copied.
+    '''
+    start = time.time()
+    table = arcpy.Describe(in_features).catalogPath
+    year_delimited = arcpy.AddFieldDelimiters(table, year_field)
+    where = "({}) AND {} >= {} AND {} <= {}".format(where_clause, year_delimited, year_range[0],
+                                                   year_delimited, year_range[-1])
+    # The candidates are copied out with their object ids, which key the
+    # draws, and the records not picked are deleted from the copy, so
+    # in_features is only read
+    orig_fid = copy_with_oids(arcpy, table, out_features, where)
+    oid = arcpy.Describe(out_features).OIDFieldName
+    records = arcpy.da.TableToNumPyArray(out_features, [oid, orig_fid, year_field], skip_nulls=True)
+    years = records[year_field].astype(np.int64)
+    picks = streams.sampleGroups(stage, years, records[orig_fid], slashburn_counts(years, percent))
+    delete_records(arcpy, out_features, records[oid][~np.in1d(records[orig_fid], picks)])
+    arcpy.DeleteField_management(out_features, orig_fid)
+    arcpy.CalculateField_management(out_features, "DistType", SLASHBURN_DIST_TYPE, "PYTHON", "")
+
+    logging.info("Selected {} of {} harvest records as slashburn over {} years in {:.1f}s".format(
+        len(picks), len(records), len(np.unique(years)), time.time() - start))
+    return len(picks)
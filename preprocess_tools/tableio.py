@@ -0,0 +1,82 @@
+'''
+Columnar table export (Parquet or Arrow IPC) written in record batches, so
+tables of any size stream to disk without the 2 GB cap and string padding of
+DBF. Readers can memory map the output and load columns without copying.
+'''
+import os
+import time
+import logging
+
+# Table formats keyed by name, with their file extension
+FORMATS = {
+    "parquet": ".parquet",
+    "arrow": ".arrow"
+}
+
+def get_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    for name, format_ext in FORMATS.items():
+        if ext == format_ext:
+            return name
+    raise ValueError("No table format registered for {}".format(path))
+
+def _arrow_type(pa, field_type):
+    # Maps fiona field types ("int:10", "float:19.11", "str:80") to arrow
+    # types; untyped (all null) columns are written as strings
+    base = (field_type or "str").split(":")[0]
+    if base in ("int", "int32", "int64"):
+        return pa.int64()
+    if base == "float":
+        return pa.float64()
+    return pa.string()
+
+def write_table(path, schema, batches):
+    '''
+    Writes record batches to a Parquet or Arrow IPC file, chosen by the
+    extension of path. schema is a list of (column, fiona type) pairs and
+    each batch a dict of column -> list of values. Returns the row count.
+    '''
+    import pyarrow as pa
+    table_format = get_format(path)
+    names = [name for name, _ in schema]
+    arrow_schema = pa.schema([pa.field(name, _arrow_type(pa, t)) for name, t in schema])
+    start = time.time()
+    count = 0
+
+    if table_format == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path, arrow_schema)
+    else:
+        sink = pa.OSFile(path, "wb")
+        writer = pa.RecordBatchFileWriter(sink, arrow_schema)
+    try:
+        for batch in batches:
+            arrays = [pa.array(batch[name], type=field.type) for name, field in zip(names, arrow_schema)]
+            record_batch = pa.RecordBatch.from_arrays(arrays, names)
+            if table_format == "parquet":
+                writer.write_table(pa.Table.from_batches([record_batch]))
+            else:
+                writer.write_batch(record_batch)
+            count += record_batch.num_rows
+    finally:
+        writer.close()
+        if table_format != "parquet":
+            sink.close()
+
+    elapsed = time.time() - start
+    logging.info("Wrote {} rows to {} in {:.1f}s ({:.0f} rows/s)".format(
+        count, path, elapsed, count / max(elapsed, 1e-6)))
+    return count
+
+def read_table(path, columns=None):
+    '''
+    Reads a table written by write_table as a pyarrow Table, memory mapping
+    the file so the columns are not copied.
+    '''
+    import pyarrow as pa
+    if get_format(path) == "parquet":
+        import pyarrow.parquet as pq
+        return pq.read_table(path, columns=columns, memory_map=True)
+    table = pa.RecordBatchFileReader(pa.memory_map(path, "r")).read_all()
+    return table if columns is None else pa.Table.from_arrays(
+        [table.column(c) for c in columns], names=columns)
@@ -0,0 +1,128 @@
+'''
+Content-addressed cache of tiled layer outputs (<layer>_moja.zip). An entry
+is keyed by a hash of the contents of the layer's source files and of the
+parameters that shape its tiles (filters, attribute table, bounding box,
+resolution), so a layer is only tiled again when one of those changes.
+Entries are evicted least recently used first once the cache outgrows
+max_bytes.
+'''
+import os
+import glob
+import json
+import shutil
+import hashlib
+import logging
+
+class TileCache(object):
+    def __init__(self, cache_dir, max_bytes=50 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Content hashes by (path, size, mtime), so a file is read once a run
+        self._file_hashes = {}
+
+    def __str__(self):
+        return "TileCache({}, {} hits, {} misses, {} evictions)".format(
+            self.cache_dir, self.hits, self.misses, self.evictions)
+
+    def _sourceFiles(self, path):
+        # A shapefile is all the files sharing its stem, a directory (e.g. a
+        # file geodatabase) all of the files in it
+        if os.path.isdir(path):
+            return sorted(os.path.join(root, f) for root, _, files in os.walk(path) for f in files)
+        return sorted(glob.glob("{}.*".format(os.path.splitext(path)[0]))) or [path]
+
+    def _fileHash(self, path):
+        stat = os.stat(path)
+        memo = (path, stat.st_size, stat.st_mtime)
+        if memo not in self._file_hashes:
+            digest = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            self._file_hashes[memo] = digest.hexdigest()
+        return self._file_hashes[memo]
+
+    def key(self, sources, params):
+        '''
+        Cache key of a layer tiled from the files or directories in sources
+        with params, any value with a stable repr (lists, dicts, numbers and
+        strings).
+        '''
+        digest = hashlib.sha1()
+        for source in sources:
+            for path in self._sourceFiles(source):
+                digest.update("{}:{}\n".format(os.path.basename(path), self._fileHash(path)).encode("utf-8"))
+        digest.update(json.dumps(params, sort_keys=True, default=repr).encode("utf-8"))
+        return digest.hexdigest()
+
+    def fetch(self, key, name, output_dir):
+        '''
+        Links (or copies) the cached output of layer name into output_dir.
+        Returns the layer's study area entry, or None on a miss.
+        '''
+        entry = os.path.join(self.cache_dir, key)
+        zip_path = os.path.join(entry, "{}_moja.zip".format(name))
+        meta_path = os.path.join(entry, "study_area.json")
+        if not (os.path.exists(zip_path) and os.path.exists(meta_path)):
+            self.misses += 1
+            return None
+        dst = os.path.join(output_dir, os.path.basename(zip_path))
+        try:
+            os.link(zip_path, dst)
+        except (AttributeError, OSError):
+            shutil.copy2(zip_path, dst)
+        # The entry's mtime orders the eviction
+        os.utime(entry, None)
+        self.hits += 1
+        with open(meta_path, "rb") as meta_file:
+            return json.load(meta_file)
+
+    def store(self, key, name, output_dir, study_area):
+        # Copies the tiled output of layer name from output_dir into the
+        # cache with its study area (the tiler's study_area.json, holding
+        # only this layer's entry)
+        zip_path = os.path.join(output_dir, "{}_moja.zip".format(name))
+        if not os.path.exists(zip_path):
+            return
+        layers = [l for l in study_area.get("layers", []) if l.get("name") == name]
+        meta = dict(study_area, layers=layers)
+        entry = os.path.join(self.cache_dir, key)
+        tmp = "{}.tmp".format(entry)
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        shutil.copy2(zip_path, tmp)
+        with open(os.path.join(tmp, "study_area.json"), "wb") as meta_file:
+            json.dump(meta, meta_file, indent=4)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+
+    def evict(self):
+        # Removes the least recently used entries until the cache fits
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            if os.path.isdir(entry) and not key.endswith(".tmp"):
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry)
+            total -= size
+            self.evictions += 1
+        return total
+
+    def logStats(self):
+        total = self.evict()
+        requests = self.hits + self.misses
+        logging.info("Tile cache {}: {} hits, {} misses ({:.0%} hit rate), {} evictions, {:.1f} MB in use".format(
+            self.cache_dir, self.hits, self.misses, self.hits / float(requests) if requests else 0.0,
+            self.evictions, total / float(1024 ** 2)))
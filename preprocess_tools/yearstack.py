@@ -0,0 +1,124 @@
+'''
+Year-coded raster stacks of disturbance events. Each band of a stack holds,
+per cell, the year of the last event of one disturbance source (0 where
+there is none), so a source is rasterized once instead of once per year.
+Per-year event rasters are then split off a band with equality masks, a
+block of rows at a time.
+'''
+import time
+import logging
+from collections import OrderedDict
+import numpy as np
+from preprocess_tools.featureio import normalize_year
+
+def _read_years(path, layer, year_field, date_string):
+    # Geometries and years of the features of a source with a valid year,
+    # in ascending year order so that later events are burned last
+    import fiona
+    from shapely.geometry import shape
+    events = []
+    with fiona.open(path, layer=layer) as src:
+        for f in src:
+            if f["geometry"] is None:
+                continue
+            year = normalize_year(f["properties"].get(year_field), date_string)
+            if year is not None and 0 < year < 65536:
+                events.append((year, shape(f["geometry"])))
+    events.sort(key=lambda e: e[0])
+    return [g for _, g in events], np.array([y for y, _ in events], dtype=np.uint16)
+
+def rasterize_years(template, out_path, bands, block_rows=1024):
+    '''
+    Writes a uint16 GeoTIFF aligned to the template raster with one band per
+    (path, layer, year_field, date_string) source in bands. A cell holds the
+    latest year of the events of the source covering its center, 0 if none;
+    cells covered by events of several years lose the earlier ones, which
+    is counted and logged as a warning. Returns {band: sorted list of the
+    years present}.
+    '''
+    import rasterio
+    from rasterio.features import rasterize
+    from rasterio.transform import Affine
+    from rasterio.windows import Window
+
+    start = time.time()
+    with rasterio.open(template) as ref:
+        profile = dict(driver="GTiff", width=ref.width, height=ref.height, crs=ref.crs,
+                       transform=ref.transform)
+    nrows, ncols = profile["height"], profile["width"]
+    transform = profile["transform"]
+    present = OrderedDict()
+    with rasterio.open(out_path, "w", count=len(bands), dtype="uint16", nodata=0, tiled=True,
+                       compress="lzw", **profile) as sink:
+        for band, (path, layer, year_field, date_string) in enumerate(bands, 1):
+            geometries, years = _read_years(path, layer, year_field, date_string)
+            extents = np.array([g.bounds for g in geometries], dtype=np.float64).reshape(-1, 4)
+            found = set()
+            overwritten = 0
+            for row0 in range(0, nrows, block_rows):
+                row1 = min(row0 + block_rows, nrows)
+                block_transform = transform * Affine.translation(0, row0)
+                top = block_transform.f
+                bottom = top + (row1 - row0) * transform.e
+                hits = np.flatnonzero((extents[:, 1] < top) & (extents[:, 3] > bottom))
+                if len(hits):
+                    # Hits keep the ascending year order, so the last event wins
+                    block = rasterize(((geometries[i], int(years[i])) for i in hits.tolist()),
+                        out_shape=(row1 - row0, ncols), transform=block_transform, fill=0,
+                        all_touched=False, dtype="uint16")
+                    found.update(np.unique(block).tolist())
+                    # Burning in reverse keeps the earliest year instead;
+                    # where the two differ earlier events were overwritten
+                    earliest = rasterize(((geometries[i], int(years[i])) for i in hits[::-1].tolist()),
+                        out_shape=(row1 - row0, ncols), transform=block_transform, fill=0,
+                        all_touched=False, dtype="uint16")
+                    overwritten += int(np.count_nonzero(earliest != block))
+                else:
+                    block = np.zeros((row1 - row0, ncols), dtype=np.uint16)
+                sink.write(block, band, window=Window(0, row0, ncols, row1 - row0))
+            found.discard(0)
+            present[band] = sorted(found)
+            logging.info("Rasterized {} events of {} ({}) into band {} of {}".format(
+                len(geometries), layer or path, year_field, band, out_path))
+            if overwritten:
+                logging.warning("{} cells of band {} of {} have events of {} ({}) in several years; "
+                    "only the latest year is kept".format(overwritten, band, out_path, layer or path, year_field))
+
+    logging.info("Rasterized {} year bands ({}x{}) in {:.1f}s".format(
+        len(bands), ncols, nrows, time.time() - start))
+    return present
+
+def split_years(stack_path, band, years, out_pattern, block_rows=1024):
+    '''
+    Splits the years of a band of a year stack into single-year event
+    rasters (1 where the year's event is, nodata elsewhere) at
+    out_pattern.format(year). Years without events are left out. Returns
+    {year: path} in year order.
+    '''
+    import rasterio
+    from rasterio.windows import Window
+
+    start = time.time()
+    with rasterio.open(stack_path) as src:
+        nrows, ncols = src.height, src.width
+        windows = [Window(0, row0, ncols, min(block_rows, nrows - row0)) for row0 in range(0, nrows, block_rows)]
+        found = set()
+        for window in windows:
+            found.update(np.unique(src.read(band, window=window)).tolist())
+        paths = OrderedDict((year, out_pattern.format(year)) for year in sorted(years) if year in found)
+
+        profile = dict(driver="GTiff", width=ncols, height=nrows, count=1, dtype="uint8", nodata=0,
+                       crs=src.crs, transform=src.transform, tiled=True, compress="lzw")
+        sinks = OrderedDict((year, rasterio.open(path, "w", **profile)) for year, path in paths.items())
+        try:
+            for window in windows:
+                block = src.read(band, window=window)
+                for year, sink in sinks.items():
+                    sink.write((block == year).view(np.uint8), 1, window=window)
+        finally:
+            for sink in sinks.values():
+                sink.close()
+
+    logging.info("Split {} years off band {} of {} in {:.1f}s".format(
+        len(paths), band, stack_path, time.time() - start))
+    return paths
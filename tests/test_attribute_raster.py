@@ -0,0 +1,39 @@
+import numpy as np
+from shapely.geometry import box
+from preprocess_tools.attribute_raster import INT_NODATA, FLOAT_NODATA, encode_column, rasterize_attributes
+
+def test_encode_column():
+    lookup, nodata, attr_table = encode_column(["pine", None, "fir", "pine"], "str:10")
+    assert lookup.tolist() == [INT_NODATA, 2, INT_NODATA, 1, 2]
+    assert attr_table == {1: ["fir"], 2: ["pine"]}
+    lookup, nodata, attr_table = encode_column([3, None], "int")
+    assert lookup.tolist() == [INT_NODATA, 3, INT_NODATA] and attr_table is None
+    for field_type in ("int:9", "int32", "int64", "int16"):
+        lookup, nodata, attr_table = encode_column([30, None, 7], field_type)
+        assert lookup.tolist() == [INT_NODATA, 30, INT_NODATA, 7] and attr_table is None
+    lookup, nodata, attr_table = encode_column([0.5, None], "float")
+    assert nodata == FLOAT_NODATA and lookup[2] == np.float32(FLOAT_NODATA)
+
+def test_rasterize_attributes_does_not_depend_on_blocks(tmpdir):
+    import rasterio
+    geometries = [box(0, 0, 4, 3), box(4, 0, 6, 6), box(1, 4, 3, 5.5)]
+    columns = {"species": (["pine", "fir", None], "str"), "age": ([10, 20, 30], "int")}
+    bounds = (0, 0, 7, 6)
+    results = []
+    for block_rows in (1, 4, 1024):
+        paths = dict((n, str(tmpdir.join("{}_{}.tif".format(n, block_rows)))) for n in columns)
+        attr_tables = rasterize_attributes(geometries, columns, paths, bounds, 1.0, block_rows=block_rows, processes=2)
+        assert attr_tables == {"species": {1: ["fir"], 2: ["pine"]}, "age": None}
+        rasters = {}
+        for n, path in paths.items():
+            with rasterio.open(path) as src:
+                rasters[n] = src.read(1)
+        results.append(rasters)
+    age = results[0]["age"]
+    assert age.shape == (6, 7)
+    # Rows run top-down
+    assert age[5].tolist() == [10] * 4 + [20] * 2 + [INT_NODATA]
+    assert age[1].tolist() == [INT_NODATA, 30, 30, INT_NODATA, 20, 20, INT_NODATA]
+    assert (results[0]["species"][age == 30] == INT_NODATA).all()
+    for rasters in results[1:]:
+        assert all((rasters[n] == results[0][n]).all() for n in columns)
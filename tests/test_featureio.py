@@ -0,0 +1,51 @@
+from collections import OrderedDict
+import pytest
+from shapely.geometry import box, mapping
+from preprocess_tools.featureio import write_features, merge_layers, normalize_year
+
+CRS = {"init": "epsg:3005"}
+
+def write_source(path, properties, rows):
+    schema = {"geometry": "Polygon", "properties": OrderedDict(properties)}
+    write_features(path, schema, CRS, ({"geometry": mapping(box(i, 0, i + 1, 1)), "properties": p}
+                                       for i, p in enumerate(rows)))
+
+def read_merged(path, layer):
+    import fiona
+    with fiona.open(path, layer=layer) as src:
+        return src.schema["properties"], [f["properties"] for f in src]
+
+def test_normalize_year():
+    assert [normalize_year(v) for v in (1990, "1991", " 1992.0", None, "n/a")] == [1990, 1991, 1992, None, None]
+    assert normalize_year("2001/06/01", date_string=True) == 2001
+
+def test_merge_layers(tmpdir):
+    fires = str(tmpdir.join("fires.gpkg"))
+    nbac = str(tmpdir.join("nbac.gpkg"))
+    write_source(fires, [("YEAR", "int32"), ("CODE", "int32"), ("Shape_Area", "float")],
+                 [{"YEAR": 1990 + i, "CODE": i, "Shape_Area": 1.0} for i in range(5)])
+    write_source(nbac, [("EDATE", "str:10"), ("CODE", "float"), ("SHAPE_LENGTH", "float")],
+                 [{"EDATE": "{}/06/01".format(2000 + i) if i else "bad", "CODE": 0.5, "SHAPE_LENGTH": 4.0}
+                  for i in range(3)])
+    sources = [(fires, None, "YEAR", False), (nbac, None, "EDATE", True)]
+    results = []
+    for processes, chunk_size in ((1, 50000), (2, 2), (3, 1)):
+        out = str(tmpdir.join("merged_{}_{}.gpkg".format(processes, chunk_size)))
+        assert merge_layers(sources, out, "merged", processes=processes, chunk_size=chunk_size) == 8
+        results.append(read_merged(out, "merged"))
+    schema, rows = results[0]
+    # The FGDB shape fields are dropped, CODE is widened to float
+    assert list(schema) == ["YEAR", "CODE", "EDATE", "DistYEAR"]
+    assert schema["CODE"] == "float"
+    assert [r["DistYEAR"] for r in rows] == [1990, 1991, 1992, 1993, 1994, None, 2001, 2002]
+    assert [r["CODE"] for r in rows] == [0.0, 1.0, 2.0, 3.0, 4.0, 0.5, 0.5, 0.5]
+    assert all(result == results[0] for result in results[1:])
+
+def test_merge_layers_type_conflict(tmpdir):
+    first = str(tmpdir.join("first.gpkg"))
+    second = str(tmpdir.join("second.gpkg"))
+    write_source(first, [("YEAR", "int")], [{"YEAR": 1990}])
+    write_source(second, [("YEAR", "str:4")], [{"YEAR": "1991"}])
+    with pytest.raises(ValueError):
+        merge_layers([(first, None, "YEAR", False), (second, None, "YEAR", False)],
+                     str(tmpdir.join("merged.gpkg")), "merged", processes=1)
@@ -0,0 +1,31 @@
+import numpy as np
+from shapely.geometry import shape
+from preprocess_tools.grid import RegularGrid, fishnet_arrays, geodesic_cell_area, write_fishnet
+
+def test_fishnet_arrays_bands_concatenate():
+    whole = fishnet_arrays(-120.0, 50.0, 0.5, 9, 4)
+    bands = [fishnet_arrays(-120.0, 50.0, 0.5, 9, 4, row_start=r, row_stop=r + 2) for r in range(0, 9, 2)]
+    for field in whole:
+        assert (np.concatenate([b[field] for b in bands]) == whole[field]).all()
+    assert whole["CELL_ID"].tolist() == list(range(1, 37))
+
+def test_geodesic_area():
+    # A one degree cell at the equator is about 12308 km2 on WGS84
+    assert abs(geodesic_cell_area(0.0, 1.0, 1.0) / 1e6 - 12308.5) < 1.0
+    # Projected cells are square
+    arrays = fishnet_arrays(0.0, 0.0, 100.0, 2, 2, geographic=False)
+    assert (arrays["Shape_Area_Ha"] == 1.0).all()
+
+def test_write_fishnet(tmpdir):
+    import fiona
+    path = str(tmpdir.join("grid.gpkg"))
+    count = write_fishnet(path, -120.0, 50.0, 0.5, 5, 3, {"init": "epsg:4326"}, layer="XYgrid", band_rows=2)
+    assert count == 15
+    grid = RegularGrid(-120.0, 50.0, 0.5, 5, 3)
+    with fiona.open(path, layer="XYgrid") as src:
+        features = list(src)
+    assert [f["properties"]["CELL_ID"] for f in features] == list(range(1, 16))
+    for f in features:
+        x, y = shape(f["geometry"]).centroid.coords[0]
+        assert grid.cellIds([x], [y])[0] == f["properties"]["CELL_ID"]
+        assert np.isclose(f["properties"]["Shape_Area_Ha"], grid.cellAreaHa([f["properties"]["CELL_ID"]])[0])
@@ -0,0 +1,54 @@
+import numpy as np
+from preprocess_tools.grid import RegularGrid, fishnet_arrays
+
+def make_grid():
+    return RegularGrid(-120.25, 49.5, 0.25, 7, 11, geographic=True)
+
+def test_cell_ids_round_trip_through_centers():
+    grid = make_grid()
+    cell_ids = np.arange(1, grid.getCellCount() + 1)
+    x, y = grid.cellCenters(cell_ids)
+    assert (grid.cellIds(x, y) == cell_ids).all()
+
+def test_cell_ids_are_row_major_from_bottom_left():
+    grid = make_grid()
+    xmin, ymin, xmax, ymax = grid.getBounds()
+    res = grid.getResolution()
+    corners = grid.cellIds([xmin + res / 2, xmax - res / 2, xmin + res / 2, xmax - res / 2],
+                           [ymin + res / 2, ymin + res / 2, ymax - res / 2, ymax - res / 2])
+    assert corners.tolist() == [1, 11, 67, 77]
+    row, col = grid.rowCol(corners)
+    assert row.tolist() == [0, 0, 6, 6] and col.tolist() == [0, 10, 0, 10]
+
+def test_cell_bounds_round_trip():
+    grid = make_grid()
+    cell_ids = np.arange(1, grid.getCellCount() + 1)
+    x0, y0, x1, y1 = grid.cellBounds(cell_ids)
+    # Lower left corners belong to their cell, upper right ones to the next
+    assert (grid.cellIds(x0, y0) == cell_ids).all()
+    assert (grid.cellIds(x1, y0)[x1 < grid.getBounds()[2]] == cell_ids[x1 < grid.getBounds()[2]] + 1).all()
+    assert (grid.cellIdsInBounds(grid.getBounds()) == cell_ids).all()
+
+def test_off_grid_points():
+    grid = make_grid()
+    xmin, ymin, xmax, ymax = grid.getBounds()
+    assert grid.cellIds([xmin - 0.1, xmax, xmin, xmin], [ymin, ymin, ymin - 0.1, ymax]).tolist() == [0, 0, 0, 0]
+
+def test_from_bounds_snaps_outwards():
+    grid = RegularGrid.fromBounds((0.3, 1.1, 9.9, 4.0), 1.0)
+    assert grid.getBounds() == (0.0, 1.0, 10.0, 4.0)
+    assert grid.getShape() == (3, 10)
+
+def test_matches_fishnet_arrays():
+    grid = make_grid()
+    nrows, ncols = grid.getShape()
+    xmin, ymin, _, _ = grid.getBounds()
+    arrays = fishnet_arrays(xmin, ymin, grid.getResolution(), nrows, ncols, row_start=2, row_stop=5)
+    cells = grid.cellArrays(arrays["CELL_ID"])
+    for field in ("xmin", "ymin", "xmax", "ymax", "Shape_Area_Ha"):
+        assert np.allclose(arrays[field], cells[field])
+
+def test_footprint_cell_ids():
+    grid = RegularGrid(0, 0, 1.0, 4, 5, geographic=False)
+    footprint = {"type": "Polygon", "coordinates": [[(1.5, 0.5), (3.5, 0.5), (3.5, 1.5), (1.5, 1.5), (1.5, 0.5)]]}
+    assert grid.footprintCellIds([footprint]).tolist() == [2, 3, 4, 7, 8, 9]
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+import numpy as np
+import pytest
+from shapely.geometry import Polygon, box, mapping
+from shapely.ops import unary_union
+from preprocess_tools.grid import RegularGrid
+from preprocess_tools.featureio import write_features
+from preprocess_tools.overlay import largest_by_group, largest_overlap, largest_overlap_tiled, intersect_tiled
+
+GRID = RegularGrid(0.0, 0.0, 1.0, 12, 15, geographic=False)
+
+def write_polygons(path, layer, geometries, properties):
+    schema = {"geometry": "Polygon", "properties": OrderedDict((k, "int") for k, _ in properties[0])}
+    write_features(path, schema, None, ({"geometry": mapping(g), "properties": OrderedDict(p)}
+                                        for g, p in zip(geometries, properties)), layer=layer)
+
+def random_polygons(n, seed):
+    rs = np.random.RandomState(seed)
+    polygons = []
+    for _ in range(n):
+        x, y = rs.uniform(-1, 14), rs.uniform(-1, 11)
+        polygons.append(Polygon([(x, y), (x + rs.uniform(0.5, 4), y + rs.uniform(-1, 1)),
+                                 (x + rs.uniform(0.5, 4), y + rs.uniform(1, 4)), (x + rs.uniform(-1, 1), y + 3)]).convex_hull)
+    return polygons
+
+def test_largest_by_group_keeps_first_of_ties():
+    groups = [3, 1, 3, 1, 2, 3, 2]
+    members = [10, 11, 12, 13, 14, 15, 16]
+    values = [0.5, 2.0, 0.7, 2.0, 1.0, 0.7, 1.0000000001]
+    assert [a.tolist() for a in largest_by_group(groups, members, values)] == [
+        [1, 2, 3], [11, 16, 12], [2.0, 1.0000000001, 0.7]]
+    # Rounded to 6 decimals 1.0 and 1.0000000001 tie, so 14 comes first
+    assert largest_by_group(groups, members, values, 6)[1].tolist() == [11, 14, 12]
+
+def test_largest_by_group_empty():
+    assert [len(a) for a in largest_by_group([], [], [])] == [0, 0, 0]
+
+def test_largest_overlap_ties_keep_first_geometry():
+    # Both halves of cell 1 are equal, so the first geometry wins it
+    geometries = [box(0.0, 0.0, 0.5, 1.0), box(0.5, 0.0, 3.0, 1.0)]
+    cell_ids, join_index, area = largest_overlap(GRID, geometries)
+    assert cell_ids.tolist() == [1, 2, 3] and join_index.tolist() == [0, 1, 1]
+    cell_ids, join_index, area = largest_overlap(GRID, geometries[::-1])
+    assert join_index.tolist() == [0, 0, 0]
+
+@pytest.mark.parametrize("tile_size,processes", [(1, 1), (4, 1), (5, 3), (256, 2)])
+def test_largest_overlap_tiled_matches_untiled(tmpdir, tile_size, processes):
+    path = str(tmpdir.join("inventory.gpkg"))
+    polygons = random_polygons(40, 0)
+    values = [i % 4 for i in range(len(polygons))]
+    write_polygons(path, "inventory", polygons, [[("age", v)] for v in values])
+    positive = [i for i, v in enumerate(values) if v > 0]
+    expected = largest_overlap(GRID, [polygons[i] for i in positive])
+
+    cell_ids, join_fids, area = largest_overlap_tiled(GRID, path, "inventory", "age", tile_size, processes)
+    assert cell_ids.tolist() == expected[0].tolist()
+    # GeoPackage feature ids start at 1
+    assert (join_fids - 1).tolist() == [positive[i] for i in expected[1].tolist()]
+    assert np.allclose(area, expected[2])
+
+def read_output(path, layer):
+    import fiona
+    from shapely.geometry import shape
+    with fiona.open(path, layer=layer) as src:
+        return [(tuple(f["properties"].items()), shape(f["geometry"])) for f in src]
+
+def test_intersect_tiled_does_not_depend_on_tiling(tmpdir):
+    inventory_path = str(tmpdir.join("inventory.gpkg"))
+    overlay_path = str(tmpdir.join("disturbances.gpkg"))
+    # Gridded inventory: pieces of polygons split on the cells, with the id
+    # of their cell; a few pieces have no cell
+    pieces = []
+    properties = []
+    for i, polygon in enumerate(random_polygons(25, 1)):
+        for cell_id in GRID.cellIdsInBounds(polygon.bounds).tolist():
+            piece = polygon.intersection(GRID.cellPolygon(cell_id))
+            if piece.geom_type == "Polygon" and piece.area > 1e-6:
+                pieces.append(piece)
+                properties.append([("CELL_ID", cell_id if cell_id % 17 else 0), ("age", i)])
+    write_polygons(inventory_path, "inventory", pieces, properties)
+    disturbances = random_polygons(15, 2)
+    write_polygons(overlay_path, "disturbances", disturbances,
+                   [[("age", i), ("year", 1990 + i)] for i in range(len(disturbances))])
+
+    outputs = []
+    for tile_size, processes in [(256, 1), (1, 1), (3, 2), (7, 4)]:
+        out_path = str(tmpdir.join("union_{}_{}.gpkg".format(tile_size, processes)))
+        count = intersect_tiled(GRID, inventory_path, "inventory", overlay_path, "disturbances", out_path, "union",
+                                filters=[("age", "lt", 20)], overlay_filters=[("year", "ge", 1992)],
+                                tile_size=tile_size, processes=processes)
+        outputs.append(read_output(out_path, "union"))
+        assert count == len(outputs[-1])
+
+    first = outputs[0]
+    # The clashing overlay field is renamed as Union does
+    assert [k for k, _ in first[0][0]] == ["FID_inventory", "CELL_ID", "age", "FID_disturbances", "age_1", "year"]
+    for output in outputs[1:]:
+        assert [p for p, _ in output] == [p for p, _ in first]
+        assert all(g.symmetric_difference(h).area < 1e-9 for (_, g), (_, h) in zip(output, first))
+
+    # The pieces of every selected inventory feature, one per covering
+    # disturbance and one for the rest, cover the feature
+    kept = [i for i, p in enumerate(properties) if p[0][1] > 0 and p[1][1] < 20]
+    covered = {}
+    for p, g in first:
+        p = dict(p)
+        covered.setdefault(p["FID_inventory"], []).append(g)
+        if p["FID_disturbances"] >= 0:
+            assert p["year"] >= 1992
+    assert sorted(covered) == [i + 1 for i in kept]
+    assert all(unary_union(covered[i + 1]).symmetric_difference(pieces[i]).area < 1e-9 for i in kept)
@@ -0,0 +1,50 @@
+import numpy as np
+from preprocess_tools.randomstreams import RandomStreams
+
+KEYS = np.arange(1, 5001)
+
+def test_draws_do_not_depend_on_chunking():
+    streams = RandomStreams(42)
+    whole = streams.uniform("rollback_age", 2010, KEYS)
+    for chunk_size in (1, 7, 1000, 4999):
+        chunks = [streams.uniform("rollback_age", 2010, KEYS[i:i + chunk_size])
+                  for i in range(0, len(KEYS), chunk_size)]
+        assert (np.concatenate(chunks) == whole).all()
+
+def test_draws_do_not_depend_on_order():
+    streams = RandomStreams(42)
+    order = np.random.RandomState(0).permutation(len(KEYS))
+    assert (streams.uniform("harvest", 1995, KEYS[order]) == streams.uniform("harvest", 1995, KEYS)[order]).all()
+    p = [0.2, 0.5, 0.3]
+    assert (streams.choice("dist", 1995, KEYS[order], p) == streams.choice("dist", 1995, KEYS, p)[order]).all()
+
+def test_streams_are_independent():
+    streams = RandomStreams(42)
+    draws = streams.uniform("harvest", 1995, KEYS)
+    assert (draws >= 0).all() and (draws < 1).all()
+    assert not (draws == streams.uniform("harvest", 1996, KEYS)).any()
+    assert not (draws == streams.uniform("slashburn", 1995, KEYS)).any()
+    assert not (draws == RandomStreams(43).uniform("harvest", 1995, KEYS)).any()
+    assert (draws == RandomStreams(42).uniform("harvest", 1995, KEYS)).all()
+
+def test_sample_does_not_depend_on_chunking_or_order():
+    streams = RandomStreams(7)
+    picked = streams.sample("slashburn", 2001, KEYS, 250)
+    assert len(picked) == 250 and (np.diff(picked) > 0).all()
+    assert (streams.sample("slashburn", 2001, KEYS[::-1], 250) == picked).all()
+    # The k smallest draws of the whole set are the k smallest of the
+    # chunks' own k smallest draws
+    candidates = np.concatenate([streams.sample("slashburn", 2001, KEYS[i:i + 600], 250)
+                                 for i in range(0, len(KEYS), 600)])
+    assert (streams.sample("slashburn", 2001, candidates, 250) == picked).all()
+
+def test_sample_groups_matches_sample():
+    streams = RandomStreams(7)
+    groups = 1990 + KEYS % 5
+    k = {1990: 10, 1991: 0, 1993: 2000, 1994: 25}
+    picked = streams.sampleGroups("slashburn", groups, KEYS, k)
+    expected = np.concatenate([streams.sample("slashburn", g, KEYS[groups == g], k.get(g, 0))
+                               for g in range(1990, 1995)])
+    assert (picked == expected).all()
+    order = np.random.RandomState(1).permutation(len(KEYS))
+    assert (streams.sampleGroups("slashburn", groups[order], KEYS[order], k) == picked).all()
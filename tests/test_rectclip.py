@@ -0,0 +1,48 @@
+import numpy as np
+from shapely.geometry import Polygon, MultiPolygon, box
+from preprocess_tools.grid import RegularGrid
+from preprocess_tools.rectclip import polygon_cell_areas
+
+GRID = RegularGrid(10.0, 20.0, 2.0, 8, 9, geographic=False)
+
+def shapely_cell_areas(grid, geom):
+    cell_ids = np.arange(1, grid.getCellCount() + 1)
+    areas = np.array([grid.cellPolygon(c).intersection(geom).area for c in cell_ids])
+    keep = areas > 1e-9
+    return cell_ids[keep], areas[keep]
+
+def window_bounds(grid, window):
+    res = grid.getResolution()
+    xmin, ymin = grid.getBounds()[:2]
+    return xmin + window[2] * res, ymin + window[0] * res, xmin + window[3] * res, ymin + window[1] * res
+
+def assert_matches_shapely(geom, grid=GRID, window=None):
+    cell_ids, areas = polygon_cell_areas(grid, geom, window)
+    expected_ids, expected_areas = shapely_cell_areas(grid, geom if window is None else geom.intersection(
+        box(*window_bounds(grid, window))))
+    assert cell_ids.tolist() == expected_ids.tolist()
+    assert np.allclose(areas, expected_areas)
+
+def test_irregular_polygon():
+    assert_matches_shapely(Polygon([(11.3, 21.7), (24.9, 20.4), (27.1, 33.8), (17.2, 30.05), (13.0, 35.5)]))
+
+def test_polygon_with_holes():
+    hole = [(15.5, 25.5), (19.0, 24.1), (18.2, 29.9)]
+    square_hole = [(22.0, 26.0), (24.0, 26.0), (24.0, 28.0), (22.0, 28.0)]
+    assert_matches_shapely(Polygon([(12.1, 21.3), (26.7, 22.2), (25.4, 33.3), (13.3, 32.2)], [hole, square_hole]))
+
+def test_partial_overlap_with_grid():
+    # Sticks out of the grid on the left and the top
+    assert_matches_shapely(Polygon([(5.0, 25.3), (21.1, 22.7), (23.9, 41.0), (8.2, 39.0)]))
+
+def test_multipolygon_on_grid_lines():
+    assert_matches_shapely(MultiPolygon([box(12.0, 22.0, 16.0, 26.0), box(17.0, 30.5, 27.0, 31.0)]))
+
+def test_window():
+    geom = Polygon([(11.3, 21.7), (24.9, 20.4), (27.1, 33.8), (17.2, 30.05), (13.0, 35.5)],
+                   [[(15.5, 25.5), (19.0, 24.1), (18.2, 29.9)]])
+    assert_matches_shapely(geom, window=(2, 6, 1, 5))
+
+def test_off_grid():
+    cell_ids, areas = polygon_cell_areas(GRID, box(0.0, 0.0, 5.0, 5.0))
+    assert len(cell_ids) == 0 and len(areas) == 0
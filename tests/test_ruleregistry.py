@@ -0,0 +1,110 @@
+import os
+import csv
+import pickle
+import multiprocessing
+import pytest
+from preprocess_tools.ruleregistry import TransitionRuleRegistry
+
+RULES = [
+    (0, -1, ["?", "?"]),
+    (5, 0, ["PLI", "?"]),
+    (0, -1, ["?", "?"]),
+    (3, 10, ["SW", "Boreal"]),
+    (5, 0, ["PLI", "?"]),
+]
+
+def read_csv(path):
+    with open(path, "rb") as f:
+        return list(csv.reader(f))
+
+def register(args):
+    registry, rules = args
+    return [registry.get_or_add(*rule) for rule in rules]
+
+def test_ids_are_sequential_from_one(tmpdir):
+    registry = TransitionRuleRegistry(str(tmpdir.join("transition_rules.csv")), store=str(tmpdir.join("store")))
+    assert [registry.get_or_add(*rule) for rule in RULES] == [1, 2, 1, 3, 2]
+
+def test_classifier_forms(tmpdir):
+    registry = TransitionRuleRegistry(str(tmpdir.join("transition_rules.csv")), store=str(tmpdir.join("store")))
+    first = registry.get_or_add(0, -1, {"LdSpp": "SW", "Eco": "B"})
+    assert registry.get_or_add(0, -1, [("Eco", "B"), ("LdSpp", "SW")]) == first
+    assert registry.get_or_add(0, -1, ["SW", "B"]) != first
+
+def test_missing_classifiers_are_blank(tmpdir):
+    out = tmpdir.join("transition_rules.csv")
+    registry = TransitionRuleRegistry(str(out), store=str(tmpdir.join("store")))
+    registry.get_or_add(0, -1, {"LdSpp": "SW"})
+    registry.get_or_add(5, 0, None)
+    registry.write_rules()
+    assert read_csv(str(out)) == [
+        ["id", "regen_delay", "age_after", "LdSpp"],
+        ["1", "0", "-1", "SW"],
+        ["2", "5", "0", ""]]
+
+def test_add_many(tmpdir):
+    registry = TransitionRuleRegistry(str(tmpdir.join("transition_rules.csv")), store=str(tmpdir.join("store")))
+    assert registry.get_or_add_many(RULES) == [1, 2, 1, 3, 2]
+    assert registry.get_or_add_many([RULES[3], (1, 1, None)]) == [3, 4]
+
+def test_reads_only_new_rules(tmpdir):
+    store = str(tmpdir.join("store"))
+    registry = TransitionRuleRegistry(str(tmpdir.join("transition_rules.csv")), store=store)
+    other = pickle.loads(pickle.dumps(registry))
+    registry.get_or_add(*RULES[0])
+    other.get_or_add(*RULES[1])
+    offset = other._offset
+    # Rules the other process added are picked up when the next one is added
+    assert registry.get_or_add(*RULES[3]) == 3
+    assert registry._keys == [other._keys[0], other._keys[1], registry._keys[2]]
+    assert other._offset == offset == registry._offset - len(TransitionRuleRegistry._line(3, registry._keys[2]))
+
+def test_removes_default_store(tmpdir):
+    out = tmpdir.join("transition_rules.csv")
+    registry = TransitionRuleRegistry(str(out))
+    registry.get_or_add(*RULES[0])
+    registry.write_rules()
+    assert not os.path.exists(registry.store) and not os.path.exists(registry.lock_path)
+    # Rules keep accumulating across scenarios, as with TransitionRuleManager
+    worker = pickle.loads(pickle.dumps(registry))
+    assert worker.get_or_add(*RULES[1]) == 2
+    assert registry.get_or_add(*RULES[3]) == 3
+    registry.write_rules()
+    assert [row[0] for row in read_csv(str(out))] == ["id", "1", "2", "3"]
+    assert not os.path.exists(registry.store)
+
+def test_processes_share_ids(tmpdir):
+    out = tmpdir.join("transition_rules.csv")
+    registry = TransitionRuleRegistry(str(out), store=str(tmpdir.join("store")))
+    registry.get_or_add(*RULES[1])
+    # The registry is pickled into each process along with its cache
+    assert pickle.loads(pickle.dumps(registry)).get_or_add(*RULES[1]) == 1
+    rules = [(delay, delay * 2, ["C{}".format(delay % 3)]) for delay in range(40)]
+    pool = multiprocessing.Pool(4)
+    try:
+        results = pool.map(register, [(registry, rules[i::3] + rules) for i in range(6)])
+    finally:
+        pool.close()
+        pool.join()
+    # Every process sees the same id for a rule, whoever registered it
+    assert all(r[-len(rules):] == results[0][-len(rules):] for r in results)
+    assert sorted(results[0][-len(rules):]) == range(2, len(rules) + 2)
+    registry.write_rules()
+    rows = read_csv(str(out))[1:]
+    assert [int(row[0]) for row in rows] == range(1, len(rules) + 2)
+    assert [row[1:4] for row in rows[1:]] == [
+        [str(rules[i][0]), str(rules[i][1]), rules[i][2][0]]
+        for i in sorted(range(len(rules)), key=lambda i: results[0][-len(rules):][i])]
+
+def test_matches_transition_rule_manager(tmpdir):
+    # The registry stands in for mojadata's TransitionRuleManager: fed the
+    # same rules in the same order, both write the same transition_rules.csv
+    manager_module = pytest.importorskip("mojadata.layer.gcbm.transitionrulemanager")
+    manager_path = str(tmpdir.join("manager.csv"))
+    registry_path = str(tmpdir.join("registry.csv"))
+    manager = manager_module.TransitionRuleManager(manager_path)
+    registry = TransitionRuleRegistry(registry_path, store=str(tmpdir.join("store")))
+    assert [registry.get_or_add(*rule) for rule in RULES] == [manager.get_or_add(*rule) for rule in RULES]
+    manager.write_rules()
+    registry.write_rules()
+    assert read_csv(registry_path) == read_csv(manager_path)
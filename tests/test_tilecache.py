@@ -0,0 +1,67 @@
+import os
+from collections import OrderedDict
+from preprocess_tools.tilecache import TileCache
+
+def write(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+
+def make_shapefile(directory, name="fires"):
+    for ext, content in ((".shp", b"geometry"), (".dbf", b"attributes"), (".prj", b"crs")):
+        write(str(directory.join(name + ext)), content)
+    return str(directory.join(name + ".shp"))
+
+def test_key_is_stable(tmpdir):
+    shapefile = make_shapefile(tmpdir.mkdir("a"))
+    params = {"filter": {"year": 2010}, "attributes": ["year", "type"], "resolution": 0.001}
+    key = TileCache(str(tmpdir.join("cache"))).key([shapefile], params)
+    # A new cache, the same files elsewhere and reordered params give the same key
+    copy = make_shapefile(tmpdir.mkdir("b"))
+    reordered = OrderedDict([("resolution", 0.001), ("attributes", ["year", "type"]), ("filter", {"year": 2010})])
+    assert TileCache(str(tmpdir.join("cache"))).key([copy], reordered) == key
+
+def test_key_changes_with_contents_and_params(tmpdir):
+    cache = TileCache(str(tmpdir.join("cache")))
+    shapefile = make_shapefile(tmpdir)
+    params = {"filter": {"year": 2010}}
+    key = cache.key([shapefile], params)
+    assert cache.key([shapefile], {"filter": {"year": 2011}}) != key
+    # A change to any of the shapefile's files is picked up
+    write(str(tmpdir.join("fires.dbf")), b"new attributes")
+    os.utime(str(tmpdir.join("fires.dbf")), (1, 1))
+    changed = cache.key([shapefile], params)
+    assert changed != key
+    gdb = tmpdir.mkdir("inventory.gdb")
+    write(str(gdb.join("a00000001.gdbtable")), b"table")
+    gdb_key = cache.key([str(gdb)], params)
+    write(str(gdb.join("a00000002.gdbtable")), b"another table")
+    assert cache.key([str(gdb)], params) != gdb_key
+
+def store_entry(cache, tmpdir, key, name, size):
+    output_dir = tmpdir.join("output_{}".format(name))
+    output_dir.ensure(dir=True)
+    write(str(output_dir.join("{}_moja.zip".format(name))), b"x" * size)
+    study_area = {"tile_size": 1.0, "layers": [{"name": name}, {"name": "other"}]}
+    cache.store(key, name, str(output_dir), study_area)
+
+def test_store_and_fetch(tmpdir):
+    cache = TileCache(str(tmpdir.join("cache")))
+    store_entry(cache, tmpdir, "k1", "fires", 10)
+    output_dir = tmpdir.mkdir("scenario")
+    assert cache.fetch("k2", "fires", str(output_dir)) is None
+    assert cache.fetch("k1", "fires", str(output_dir)) == {"tile_size": 1.0, "layers": [{"name": "fires"}]}
+    assert output_dir.join("fires_moja.zip").read_binary() == b"x" * 10
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_evicts_least_recently_used(tmpdir):
+    cache_dir = tmpdir.join("cache")
+    cache = TileCache(str(cache_dir), max_bytes=2500)
+    for i, key in enumerate(["k1", "k2", "k3"]):
+        store_entry(cache, tmpdir, key, "layer{}".format(i), 1000)
+        os.utime(str(cache_dir.join(key)), (1000 + i, 1000 + i))
+    # Fetching k1 makes k2 the least recently used entry
+    cache.fetch("k1", "layer0", str(tmpdir.mkdir("scenario")))
+    total = cache.evict()
+    assert sorted(os.listdir(str(cache_dir))) == ["k1", "k3"]
+    assert cache.evictions == 1
+    assert 2000 <= total <= 2500
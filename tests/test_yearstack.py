@@ -0,0 +1,39 @@
+import logging
+from collections import OrderedDict
+from shapely.geometry import box, mapping
+from preprocess_tools.featureio import write_features
+from preprocess_tools.yearstack import rasterize_years, split_years
+
+def make_template(path):
+    import rasterio
+    from rasterio.transform import from_origin
+    with rasterio.open(path, "w", driver="GTiff", width=10, height=8, count=1, dtype="uint8",
+                       transform=from_origin(0, 8, 1, 1)):
+        pass
+
+def test_overwritten_events_are_counted(tmpdir, caplog):
+    import rasterio
+    template = str(tmpdir.join("template.tif"))
+    make_template(template)
+    events = str(tmpdir.join("fires.shp"))
+    schema = {"geometry": "Polygon", "properties": OrderedDict([("YEAR", "int")])}
+    # 1995 overlaps 4 cells of 1990; the two 2000 fires overlap each other only
+    write_features(events, schema, None, [
+        {"geometry": mapping(box(0, 0, 4, 4)), "properties": {"YEAR": 1995}},
+        {"geometry": mapping(box(2, 2, 6, 6)), "properties": {"YEAR": 1990}},
+        {"geometry": mapping(box(7, 0, 9, 2)), "properties": {"YEAR": 2000}},
+        {"geometry": mapping(box(8, 0, 10, 2)), "properties": {"YEAR": 2000}}])
+    stack = str(tmpdir.join("stack.tif"))
+    with caplog.at_level(logging.WARNING):
+        present = rasterize_years(template, stack, [(events, None, "YEAR", False)], block_rows=3)
+    assert present == {1: [1990, 1995, 2000]}
+    assert [r.getMessage().split()[0] for r in caplog.records] == ["4"]
+    with rasterio.open(stack) as src:
+        years = src.read(1)[::-1]
+    assert years[2:4, 2:4].tolist() == [[1995, 1995], [1995, 1995]]
+    assert years[0, 7:10].tolist() == [2000, 2000, 2000]
+
+    paths = split_years(stack, 1, [1990, 1995, 1996, 2000], str(tmpdir.join("fire_{}.tif")), block_rows=5)
+    assert list(paths) == [1990, 1995, 2000]
+    with rasterio.open(paths[1990]) as src:
+        assert int(src.read(1).sum()) == 12